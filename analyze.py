@@ -1,39 +1,98 @@
-from json import loads
+import os
 from typing import Dict, List
 from argparse import ArgumentParser
-from dacite import from_dict, Config
 
-from core.evaluator import evaluate
 from core.types import GenerationOutput
-from core.utils import print_scores, plot_perf_metrics
+from core.evaluator import TaskEvaluation, evaluate, validator_cache
+from core.outputs import METRIC_FIELDS, iter_outputs, read_header
+from core.columnar import iter_columnar_outputs, read_columnar_header
+from core.utils import BOOTSTRAP_SAMPLES, BOOTSTRAP_SEED, print_scores
+from core.utils import plot_perf_metrics, print_complexity_scores
+from core.evaluator import is_generation_valid
+from core.dataset import DATASET_NAMES, cached_complexities
+from core.complexity import (
+    COMPLEXITY_FEATURES,
+    DEFAULT_COMPLEXITY_BINS,
+    ComplexityReport,
+)
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--outputs", type=str, required=True)
     parser.add_argument("--details", action="store_true")
+    parser.add_argument("--num_workers", type=int, required=False)
+    parser.add_argument("--bootstrap_samples", type=int, default=BOOTSTRAP_SAMPLES)
+    parser.add_argument("--bootstrap_seed", type=int, default=BOOTSTRAP_SEED)
+    parser.add_argument("--complexity", action="store_true")
+    parser.add_argument(
+        "--complexity_feature",
+        type=str,
+        default="node_count",
+        choices=COMPLEXITY_FEATURES,
+    )
+    parser.add_argument("--complexity_bins", type=int, default=DEFAULT_COMPLEXITY_BINS)
     args = parser.parse_args()
 
-    dacite_config = Config(check_types=False)
-    with open(args.outputs, "r") as f:
-        engine_config = loads(f.readline())
-        outputs = [
-            from_dict(GenerationOutput, loads(line), config=dacite_config)
-            for line in f.readlines()[1:]
-        ]
+    if os.path.isdir(args.outputs):
+        engine_config = read_columnar_header(args.outputs)
+        outputs = iter_columnar_outputs(args.outputs, fields=METRIC_FIELDS)
+    else:
+        engine_config = read_header(args.outputs)
+        outputs = iter_outputs(args.outputs, fields=METRIC_FIELDS)
 
+    # outputs are aggregated as they are read, unless they are validated in
+    # parallel, in which case only the fields needed for the metrics are kept
+    task_evaluations: Dict[str, TaskEvaluation] = {}
     task_outputs: Dict[str, List[GenerationOutput]] = {}
+    complexity_report = None
+    if args.complexity:
+        # reuse the complexities computed when bench loaded the datasets
+        complexity_report = ComplexityReport(
+            {
+                key: complexity
+                for dataset_name in DATASET_NAMES
+                for key, complexity in cached_complexities(dataset_name).items()
+            }
+        )
     for output in outputs:
-        if output.task not in task_outputs:
-            task_outputs[output.task] = []
-        task_outputs[output.task].append(output)
+        if args.num_workers is None:
+            # validated once for both the scores and the complexity report
+            valid = None
+            if complexity_report is not None:
+                if output.schema is not None and output.generation is not None:
+                    valid = is_generation_valid(output.generation, output.schema)
+                complexity_report.add(output, valid)
+
+            if output.task not in task_evaluations:
+                task_evaluations[output.task] = TaskEvaluation()
+            task_evaluations[output.task].add(output, valid)
+        else:
+            if output.task not in task_outputs:
+                task_outputs[output.task] = []
+            task_outputs[output.task].append(output)
+
+    tasks = list(task_evaluations.keys()) + list(task_outputs.keys())
 
     compliance = []
     perf_metrics = []
     output_tokens = []
     declared_coverage = []
     empirical_coverage = []
-    for outputs in task_outputs.values():
-        dc, ec, cl, pm, ot = evaluate(outputs)
+    for task in tasks:
+        if task in task_evaluations:
+            dc, ec, cl, pm, ot = task_evaluations[task].result(
+                args.bootstrap_samples, args.bootstrap_seed
+            )
+        else:
+            dc, ec, cl, pm, ot = evaluate(
+                task_outputs.pop(task),
+                num_workers=args.num_workers,
+                n_bootstrap_samples=args.bootstrap_samples,
+                seed=args.bootstrap_seed,
+                on_validated=(
+                    complexity_report.add if complexity_report is not None else None
+                ),
+            )
 
         compliance.append(cl)
         perf_metrics.append(pm)
@@ -48,14 +107,23 @@ if __name__ == "__main__":
         compliance,
         perf_metrics,
         output_tokens,
-        list(task_outputs.keys()),
+        tasks,
         args.details,
     )
+    print(validator_cache.info())
+
+    if complexity_report is not None:
+        print_complexity_scores(
+            complexity_report.bins(args.complexity_feature, args.complexity_bins),
+            args.complexity_feature,
+            complexity_report.gct_correlations(),
+            args.details,
+        )
 
     if args.details:
         plot_perf_metrics(
             perf_metrics,
-            list(task_outputs.keys()),
+            tasks,
             f"{args.outputs.split('.')[0]}.png",
             engine_config["engine"],
         )
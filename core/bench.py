@@ -1,16 +1,25 @@
 import os
 import sys
+import asyncio
+from contextlib import ExitStack
 from tqdm import tqdm
-from json import dumps
+from time import perf_counter
+from json import dumps, loads
 from dataclasses import asdict
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
 from core.engine import Engine
-from core.evaluator import evaluate
-from core.types import GenerationOutput
+from core.prompts import prompt_cache
+from core.types import GenerationOutput, Schema
 from core.dataset import Dataset, DatasetConfig
-from core.utils import disable_print, nanoid, safe_min, print_scores
-from core.messages import MessagesFormatter, FEW_SHOTS_MESSAGES_FORMATTER
+from core.columnar import convert_to_columnar
+from core.outputs import METRIC_FIELDS, FlushPolicy, OutputsWriter
+from core.outputs import completed_sample_indices, iter_outputs, read_header
+from core.scheduler import Scheduler, SchedulerConfig
+from core.evaluator import CompilationEvaluation, TaskEvaluation, validator_cache
+from core.utils import batched, disable_print, nanoid, safe_min, print_scores
+from core.utils import print_compilation_scores
+from core.messages import Message, MessagesFormatter, FEW_SHOTS_MESSAGES_FORMATTER
 
 
 def bench(
@@ -22,6 +31,14 @@ def bench(
     ] = FEW_SHOTS_MESSAGES_FORMATTER,
     close_engine: bool = True,
     save_outputs: bool = False,
+    scheduler_config: Optional[SchedulerConfig] = None,
+    flush_policy: FlushPolicy = FlushPolicy.FLUSH,
+    retain_outputs: bool = True,
+    resume_from: Optional[str] = None,
+    save_columnar: bool = False,
+    snapshot_dir: Optional[str] = None,
+    batch_size: int = 1,
+    asynchronous: bool = False,
 ) -> List[List[GenerationOutput]]:
     """Benchmarks an engine with specified tasks and datasets.
 
@@ -39,39 +56,188 @@ def bench(
     :param close_engine: bool
         Whether to close the engine after the benchmark.
     :param save_outputs: bool
-        Whether to save the generation outputs after the benchmark.
+        Whether to save the generation outputs. Each output is appended to
+        `outputs/<engine>/<id>.jsonl` as soon as it is generated.
+    :param scheduler_config: Optional[SchedulerConfig]
+        The configuration to run generations concurrently under a rate limit.
+        More than one generation in flight is only supported by engines with
+        `supports_concurrency` set. The samples are generated one at a time if
+        None.
+    :param flush_policy: FlushPolicy
+        When the saved outputs are pushed to disk.
+    :param retain_outputs: bool
+        Whether to keep the generation outputs in memory to return them. The
+        scores are computed from running aggregates either way.
+    :param resume_from: Optional[str]
+        The path of the outputs file of an interrupted run of the same engine.
+        Only the samples missing from it are generated and appended to it, and
+        the scores cover both the previous and the new outputs. The file must
+        come from the same engine with the same config.
+    :param save_columnar: bool
+        Whether to also convert the saved outputs to Parquet files, in a
+        directory next to the JSONL file, once the benchmark is done.
+    :param snapshot_dir: Optional[str]
+        The local snapshot directory to read the tasks from instead of the
+        Hugging Face hub, see `core.dataset.create_snapshot`.
+    :param batch_size: int
+        The number of samples submitted to the engine at once with
+        `generate_batch`. Engines without `supports_batching` still generate
+        the samples of a batch one by one. Cannot be combined with a scheduler.
+    :param asynchronous: bool
+        Whether to generate with `Engine.agenerate` on the event loop of the
+        scheduler, so that engines with `supports_async` have all the requests
+        of `max_in_flight` in flight without a thread each. The other engines
+        generate in threads of the loop.
 
     :return: List[List[GenerationOutput]]
-        The generation outputs for each sample for each task.
+        The generation outputs for each sample for each task, empty lists if
+        `retain_outputs` is False.
     """
     id = nanoid()
 
     if not isinstance(messages_formatter, list):
         messages_formatter = [messages_formatter] * len(tasks)
 
+    scheduler = None
+    if scheduler_config is not None and scheduler_config.enabled:
+        if scheduler_config.max_in_flight > 1 and not engine.supports_concurrency:
+            raise ValueError(f"Engine {engine.name} does not support concurrency")
+        scheduler = Scheduler(scheduler_config)
+
+    if asynchronous and scheduler is None:
+        scheduler = Scheduler(scheduler_config or SchedulerConfig())
+    engine.rate_limiter = scheduler.rate_limiter if scheduler is not None else None
+
+    if batch_size < 1:
+        raise ValueError(f"Batch size must be at least 1, got {batch_size}")
+    if batch_size > 1 and scheduler is not None:
+        raise ValueError("Batched generation cannot be combined with a scheduler")
+
+    completed_indices: Dict[str, Set[int]] = {}
+    if resume_from is not None:
+        header = read_header(resume_from)
+        if header["engine"] != engine.name:
+            raise ValueError(
+                f"Cannot resume outputs of engine {header['engine']} with {engine.name}"
+            )
+        # the header went through JSON, so is the config it is compared to
+        if header.get("engine_config") != loads(dumps(asdict(engine.config))):
+            raise ValueError(
+                f"Cannot resume outputs generated with another config of {engine.name}"
+            )
+        completed_indices = completed_sample_indices(resume_from)
+
     all_outputs = []
-    for task, mf in zip(tasks, messages_formatter):
-        task_outputs = []
-        dataset = Dataset(DatasetConfig(task, limit=limit))
-        for messages, schema in tqdm(
-            dataset.iter(mf),
-            total=safe_min(len(dataset), limit),
-            desc=task,
-            file=sys.stdout,
-        ):
-            with disable_print():
+    evaluations = []
+    # the outputs file is closed even when a generation raises
+    with ExitStack() as stack:
+        writer = None
+        if save_outputs or resume_from is not None:
+            writer = stack.enter_context(
+                OutputsWriter(
+                    resume_from or f"outputs/{engine.name}/{id}.jsonl",
+                    {"engine": engine.name, "engine_config": asdict(engine.config)},
+                    flush_policy=flush_policy,
+                    resume=resume_from is not None,
+                )
+            )
+
+        for task, mf in zip(tasks, messages_formatter):
+            task_outputs = []
+            evaluation = TaskEvaluation()
+            dataset = Dataset(
+                DatasetConfig(task, limit=limit, snapshot_dir=snapshot_dir)
+            )
+            total = safe_min(len(dataset), limit)
+
+            completed = {
+                index for index in completed_indices.get(task, ()) if index < total
+            }
+            if completed:
+                # the completed outputs are streamed back from the file, only the
+                # fields needed for the scores unless they are returned
+                for output in iter_outputs(
+                    resume_from, fields=None if retain_outputs else METRIC_FIELDS
+                ):
+                    if output.task != task or output.sample_index not in completed:
+                        continue
+                    evaluation.add(output)
+                    if retain_outputs:
+                        task_outputs.append(output)
+
+            def generate(
+                sample: Tuple[int, Tuple[List[Message], Schema]],
+            ) -> GenerationOutput:
+                index, (messages, schema) = sample
                 schema = engine.adapt_schema(schema)
-                result = engine.generate(task, messages, schema)
-                task_outputs.append(result)
-        all_outputs.append(task_outputs)
+                output = engine.generate(task, messages, schema)
+                output.sample_index = index
+                return output
+
+            async def agenerate(
+                sample: Tuple[int, Tuple[List[Message], Schema]],
+            ) -> GenerationOutput:
+                index, (messages, schema) = sample
+                schema = engine.adapt_schema(schema)
+                output = await engine.agenerate(task, messages, schema)
+                output.sample_index = index
+                return output
+
+            def generate_batch(
+                batch: List[Tuple[int, Tuple[List[Message], Schema]]],
+            ) -> List[GenerationOutput]:
+                outputs = engine.generate_batch(task, [sample for _, sample in batch])
+                for (index, _), output in zip(batch, outputs):
+                    output.sample_index = index
+                return outputs
+
+            samples = (
+                sample
+                for sample in enumerate(dataset.iter(mf))
+                if sample[0] not in completed
+            )
+
+            # the progress bar must hold the real stdout before printing is disabled
+            progress_bar = tqdm(
+                total=total, initial=len(completed), desc=task, file=sys.stdout
+            )
+            with disable_print():
+                if batch_size > 1:
+                    outputs = (
+                        output
+                        for batch in batched(samples, batch_size)
+                        for output in generate_batch(batch)
+                    )
+                elif asynchronous:
+                    outputs = scheduler.map_async(agenerate, samples)
+                elif scheduler is not None:
+                    outputs = scheduler.map(generate, samples)
+                else:
+                    outputs = map(generate, samples)
+                for output in outputs:
+                    progress_bar.update()
+                    if writer is not None or retain_outputs:
+                        engine.materialize_tokens(output)
+                    if writer is not None:
+                        writer.write(output)
+                    evaluation.add(output)
+                    if retain_outputs:
+                        task_outputs.append(output)
+            progress_bar.close()
+
+            all_outputs.append(task_outputs)
+            evaluations.append(evaluation)
+
+    if scheduler is not None:
+        scheduler.close()
 
     compliance = []
     perf_metrics = []
     output_tokens = []
     declared_coverage = []
     empirical_coverage = []
-    for outputs in all_outputs:
-        dc, ec, cl, pm, ot = evaluate(outputs)
+    for evaluation in evaluations:
+        dc, ec, cl, pm, ot = evaluation.result()
 
         compliance.append(cl)
         perf_metrics.append(pm)
@@ -87,24 +253,125 @@ def bench(
         output_tokens,
         tasks,
     )
+    print(validator_cache.info())
+    if engine.prompt_cache_key is not None:
+        print(prompt_cache.info())
+    if engine.grammar_cache is not None:
+        print(engine.grammar_cache.info())
 
-    if save_outputs:
-        if not os.path.exists("outputs"):
-            os.makedirs("outputs")
+    if writer is not None:
+        print(f"Outputs saved to {writer.path}")
 
-        if not os.path.exists(f"outputs/{engine.name}"):
-            os.makedirs(f"outputs/{engine.name}")
+        if save_columnar:
+            directory = os.path.splitext(writer.path)[0]
+            convert_to_columnar(writer.path, directory)
+            print(f"Columnar outputs saved to {directory}")
 
-        with open(f"outputs/{engine.name}/{id}.jsonl", "w") as f:
-            f.write(
-                f"{dumps({"engine": engine.name, "engine_config": asdict(engine.config)})}\n"
-            )
+    if close_engine:
+        engine.close()
 
-            for outputs in all_outputs:
-                for output in outputs:
-                    f.write(f"{dumps(asdict(output))}\n")
+    return all_outputs
+
+
+async def abench(
+    engine: Engine, tasks: List[str], **kwargs: Any
+) -> List[List[GenerationOutput]]:
+    """Coroutine version of `bench` with `asynchronous` set, for callers that
+    already run an event loop. The generations run on the event loop of the
+    scheduler and the outputs are consumed in a thread, so that neither blocks
+    the loop of the caller.
+
+    :param engine: Engine
+        The engine to benchmark.
+    :param tasks: List[str]
+        The tasks to benchmark.
+    :param kwargs: Any
+        The other arguments of `bench`.
+    :return: List[List[GenerationOutput]]
+        The generation outputs for each sample for each task.
+    """
+    return await asyncio.to_thread(bench, engine, tasks, asynchronous=True, **kwargs)
+
+
+def bench_compilation(
+    engine: Engine,
+    tasks: List[str],
+    limit: Optional[int] = None,
+    close_engine: bool = True,
+    max_in_flight: int = 1,
+    retain_outputs: bool = True,
+    snapshot_dir: Optional[str] = None,
+) -> List[List[GenerationOutput]]:
+    """Benchmarks the grammar compilation of an engine alone, without prompting
+    the model. Every schema of the tasks is compiled with `Engine.compile`, and
+    the compilation time, the share of schemas compiled and the number of schemas
+    compiled per second are reported for each task.
+
+    :param engine: Engine
+        The engine to benchmark, with `supports_compile_only` set. It can be
+        created with `compile_only=True` to skip loading the model weights.
+    :param tasks: List[str]
+        The tasks to benchmark.
+    :param limit: Optional[int]
+        The limit on the number of schemas to compile per task.
+    :param close_engine: bool
+        Whether to close the engine after the benchmark.
+    :param max_in_flight: int
+        The number of schemas compiled at once. Engines that compile in a worker
+        pool only compile as many schemas in parallel as they have workers.
+    :param retain_outputs: bool
+        Whether to keep the outputs in memory to return them.
+    :param snapshot_dir: Optional[str]
+        The local snapshot directory to read the tasks from instead of the
+        Hugging Face hub, see `core.dataset.create_snapshot`.
+
+    :return: List[List[GenerationOutput]]
+        The compilation outputs for each schema for each task, empty lists if
+        `retain_outputs` is False.
+    """
+    if not engine.supports_compile_only:
+        raise ValueError(f"Engine {engine.name} does not support compile-only mode")
+    if max_in_flight < 1:
+        raise ValueError(f"Max in flight must be at least 1, got {max_in_flight}")
+
+    scheduler = None
+    if max_in_flight > 1:
+        scheduler = Scheduler(SchedulerConfig(max_in_flight=max_in_flight))
+
+    all_outputs = []
+    compilation_metrics = []
+    for task in tasks:
+        task_outputs = []
+        evaluation = CompilationEvaluation()
+        dataset = Dataset(DatasetConfig(task, limit=limit, snapshot_dir=snapshot_dir))
+        total = safe_min(len(dataset), limit)
+
+        def compile_sample(index: int) -> GenerationOutput:
+            output = engine.compile(task, dataset[index])
+            output.sample_index = index
+            return output
+
+        progress_bar = tqdm(total=total, desc=task, file=sys.stdout)
+        start_time = perf_counter()
+        with disable_print():
+            if scheduler is not None:
+                outputs = scheduler.map(compile_sample, range(total))
+            else:
+                outputs = map(compile_sample, range(total))
+            for output in outputs:
+                progress_bar.update()
+                evaluation.add(output)
+                if retain_outputs:
+                    task_outputs.append(output)
+        duration = perf_counter() - start_time
+        progress_bar.close()
+
+        all_outputs.append(task_outputs)
+        compilation_metrics.append(evaluation.result(duration))
 
-        print(f"Outputs saved to outputs/{engine.name}/{id}.jsonl")
+    print_compilation_scores(compilation_metrics, tasks)
+    if engine.grammar_cache is not None:
+        print(engine.grammar_cache.info())
 
     if close_engine:
         engine.close()
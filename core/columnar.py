@@ -0,0 +1,253 @@
+import os
+import pyarrow as pa
+from enum import Enum
+import pyarrow.parquet as pq
+from json import dumps, loads
+from dacite import from_dict
+from dataclasses import asdict, fields, is_dataclass
+from typing import get_args, get_origin, get_type_hints
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from core.utils import schema_hash
+from core.types import GenerationOutput
+from core.outputs import DACITE_CONFIG, iter_outputs, read_header
+
+HEADER_FILE = "header.json"
+OUTPUTS_FILE = "outputs.parquet"
+SCHEMAS_FILE = "schemas.parquet"
+MESSAGES_FILE = "messages.parquet"
+
+# number of outputs per row group of the outputs file
+ROW_GROUP_SIZE = 10_000
+
+# schemas and messages are stored once in side tables and referenced by hash
+SCHEMA_COLUMN = "schema_id"
+MESSAGES_COLUMN = "message_ids"
+SIDE_TABLE_FIELDS = ("schema", "messages")
+
+
+def _unwrap_optional(type_: Any) -> Any:
+    if get_origin(type_) is Union:
+        args = [arg for arg in get_args(type_) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return type_
+
+
+def _arrow_type(type_: Any) -> Tuple[pa.DataType, bool]:
+    """Returns the arrow type of a field and whether it is stored as JSON."""
+    if type_ is bool:
+        return pa.bool_(), False
+    if type_ is int or (isinstance(type_, type) and issubclass(type_, Enum)):
+        return pa.int64(), False
+    if type_ is float:
+        return pa.float64(), False
+    if type_ is str:
+        return pa.string(), False
+    if get_origin(type_) in (list, List) and get_args(type_) == (float,):
+        return pa.list_(pa.float64()), False
+    if get_origin(type_) in (list, List) and get_args(type_) == (int,):
+        return pa.list_(pa.int64()), False
+    return pa.string(), True
+
+
+def _flatten_fields(cls: type, prefix: str = "") -> List[Tuple[str, Any]]:
+    columns = []
+    type_hints = get_type_hints(cls)
+    for f in fields(cls):
+        if not prefix and f.name in SIDE_TABLE_FIELDS:
+            continue
+        type_ = _unwrap_optional(type_hints[f.name])
+        if is_dataclass(type_):
+            columns.extend(_flatten_fields(type_, f"{prefix}{f.name}."))
+        else:
+            columns.append((f"{prefix}{f.name}", type_))
+    return columns
+
+
+def _outputs_schema() -> Tuple[pa.Schema, Dict[str, bool]]:
+    arrow_fields = [
+        pa.field(SCHEMA_COLUMN, pa.string()),
+        pa.field(MESSAGES_COLUMN, pa.list_(pa.string())),
+    ]
+    json_columns = {}
+    for name, type_ in _flatten_fields(GenerationOutput):
+        arrow_type, is_json = _arrow_type(type_)
+        arrow_fields.append(pa.field(name, arrow_type))
+        json_columns[name] = is_json
+    return pa.schema(arrow_fields), json_columns
+
+
+def _get_path(data: Dict[str, Any], path: str) -> Any:
+    for key in path.split("."):
+        if data is None:
+            return None
+        data = data.get(key)
+    return data
+
+
+def _set_path(data: Dict[str, Any], path: str, value: Any) -> None:
+    *parents, key = path.split(".")
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    data[key] = value
+
+
+class ColumnarOutputsWriter:
+    def __init__(self, directory: str, header: Dict[str, Any]):
+        """Writes generation outputs to a directory of Parquet files. Each
+        nested field of the outputs is stored in its own column, e.g.
+        `perf_metrics.ttft`, so that the metrics can be read without the rest.
+        Schemas and messages are deduplicated into side tables.
+
+        :param directory: str
+            The directory of the Parquet files.
+        :param header: Dict[str, Any]
+            The header describing the engine.
+        """
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(os.path.join(directory, HEADER_FILE), "w") as f:
+            f.write(dumps(header))
+
+        self._schema, self._json_columns = _outputs_schema()
+        self._writer = pq.ParquetWriter(
+            os.path.join(directory, OUTPUTS_FILE), self._schema
+        )
+        self._rows: List[Dict[str, Any]] = []
+        self._schemas: Dict[str, str] = {}
+        self._messages: Dict[str, str] = {}
+
+    def write(self, output: GenerationOutput) -> None:
+        data = asdict(output)
+
+        schema_id = schema_hash(data["schema"])
+        self._schemas.setdefault(schema_id, dumps(data["schema"]))
+
+        message_ids = []
+        for message in data["messages"]:
+            message_id = schema_hash(message)
+            self._messages.setdefault(message_id, dumps(message))
+            message_ids.append(message_id)
+
+        row = {SCHEMA_COLUMN: schema_id, MESSAGES_COLUMN: message_ids}
+        for name, is_json in self._json_columns.items():
+            value = _get_path(data, name)
+            row[name] = dumps(value) if is_json and value is not None else value
+        self._rows.append(row)
+
+        if len(self._rows) >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._rows:
+            self._writer.write_table(
+                pa.Table.from_pylist(self._rows, schema=self._schema)
+            )
+            self._rows = []
+
+    def close(self) -> None:
+        self._flush()
+        self._writer.close()
+
+        pq.write_table(
+            pa.table(
+                {
+                    "id": list(self._schemas.keys()),
+                    "schema": list(self._schemas.values()),
+                }
+            ),
+            os.path.join(self.directory, SCHEMAS_FILE),
+        )
+        pq.write_table(
+            pa.table(
+                {
+                    "id": list(self._messages.keys()),
+                    "message": list(self._messages.values()),
+                }
+            ),
+            os.path.join(self.directory, MESSAGES_FILE),
+        )
+
+    def __enter__(self) -> "ColumnarOutputsWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def convert_to_columnar(path: str, directory: str) -> None:
+    """Converts a JSONL outputs file to a directory of Parquet files.
+
+    :param path: str
+        The path of the JSONL file.
+    :param directory: str
+        The directory of the Parquet files.
+    """
+    with ColumnarOutputsWriter(directory, read_header(path)) as writer:
+        for output in iter_outputs(path):
+            writer.write(output)
+
+
+def read_columnar_header(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, HEADER_FILE), "r") as f:
+        return loads(f.read())
+
+
+def _read_side_table(path: str, column: str) -> Dict[str, Any]:
+    table = pq.read_table(path)
+    return {
+        id: loads(value)
+        for id, value in zip(
+            table.column("id").to_pylist(), table.column(column).to_pylist()
+        )
+    }
+
+
+def iter_columnar_outputs(
+    directory: str, fields: Optional[Sequence[str]] = None
+) -> Iterator[GenerationOutput]:
+    """Streams the outputs of a directory of Parquet files, one row group at a
+    time.
+
+    :param directory: str
+        The directory of the Parquet files.
+    :param fields: Optional[Sequence[str]]
+        The fields of `GenerationOutput` to load, e.g. `METRIC_FIELDS`. Only
+        the corresponding columns are read, the other fields keep their
+        default value and the messages are empty. All the fields are loaded if
+        None.
+    :return: Iterator[GenerationOutput]
+        The outputs, in the order they were written.
+    """
+    _, json_columns = _outputs_schema()
+    columns = [
+        name for name in json_columns if fields is None or name.split(".")[0] in fields
+    ]
+
+    schemas = {}
+    if fields is None or "schema" in fields:
+        columns.append(SCHEMA_COLUMN)
+        schemas = _read_side_table(os.path.join(directory, SCHEMAS_FILE), "schema")
+
+    messages = {}
+    if fields is None or "messages" in fields:
+        columns.append(MESSAGES_COLUMN)
+        messages = _read_side_table(os.path.join(directory, MESSAGES_FILE), "message")
+
+    parquet_file = pq.ParquetFile(os.path.join(directory, OUTPUTS_FILE))
+    for batch in parquet_file.iter_batches(columns=columns):
+        for row in batch.to_pylist():
+            data: Dict[str, Any] = {"messages": []}
+            for name, value in row.items():
+                if name == SCHEMA_COLUMN:
+                    data["schema"] = schemas[value]
+                elif name == MESSAGES_COLUMN:
+                    data["messages"] = [messages[id] for id in value]
+                else:
+                    if json_columns[name] and value is not None:
+                        value = loads(value)
+                    _set_path(data, name, value)
+            yield from_dict(GenerationOutput, data, config=DACITE_CONFIG)
@@ -0,0 +1,224 @@
+import multiprocessing as mp
+from enum import Enum
+from queue import Queue
+from threading import Thread
+from dataclasses import dataclass
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Optional, Tuple, TYPE_CHECKING
+
+from core.profile import timestamp
+
+if TYPE_CHECKING:
+    from core.types import GenerationOutput
+
+# workers are spawned rather than forked so that they do not inherit the model
+# weights and the CUDA state of the parent. Spawned workers import the main
+# module of the parent, so scripts must guard their entry point with
+# `if __name__ == "__main__":`
+MP_CONTEXT = mp.get_context("spawn")
+# how long to wait for a killed or crashed worker to exit, in s
+WORKER_JOIN_TIMEOUT = 5
+
+
+class CompileResultStatus(str, Enum):
+    OK = "ok"
+    # the compile function raised an exception
+    ERROR = "error"
+    # the worker died, e.g. with a segmentation fault
+    CRASH = "crash"
+    TIMEOUT = "timeout"
+
+
+@dataclass
+class CompileResult:
+    status: CompileResultStatus
+    artifact: Any = None
+    message: Optional[str] = None
+    # time spent compiling in the worker in s, without the round trip
+    compile_time: Optional[float] = None
+    # time spent waiting for a worker in s, e.g. one being restarted
+    wait_time: float = 0.0
+
+
+def record_compile_phases(
+    output: "GenerationOutput", result: CompileResult, round_trip_time: float
+) -> None:
+    """Splits the time spent waiting for the pool between the compilation in the
+    worker and the cost of isolating it in a separate process. The time spent
+    waiting for a worker is left out of both, and of the GCT, since it is due
+    to an earlier compilation."""
+    output.metadata.compile_wait_time = result.wait_time
+    round_trip_time -= result.wait_time
+    if result.compile_time is None:
+        output.metadata.phases.compilation = round_trip_time
+        return
+    output.metadata.phases.compilation = result.compile_time
+    output.metadata.phases.safety_check = round_trip_time - result.compile_time
+
+
+def _worker_main(
+    connection: Connection,
+    initializer: Callable[..., Any],
+    initargs: Tuple[Any, ...],
+    compile_fn: Callable[[Any, Any], Any],
+) -> None:
+    state = initializer(*initargs)
+    connection.send(None)
+    while True:
+        try:
+            payload = connection.recv()
+        except EOFError:
+            return
+        start_time = timestamp()
+        try:
+            artifact = compile_fn(state, payload)
+        except Exception as e:
+            connection.send((CompileResultStatus.ERROR, str(e), None))
+            continue
+        connection.send((CompileResultStatus.OK, artifact, timestamp() - start_time))
+
+
+class _Worker:
+    def __init__(
+        self,
+        initializer: Callable[..., Any],
+        initargs: Tuple[Any, ...],
+        compile_fn: Callable[[Any, Any], Any],
+    ):
+        self.connection, child_connection = MP_CONTEXT.Pipe()
+        self.process = MP_CONTEXT.Process(
+            target=_worker_main,
+            args=(child_connection, initializer, initargs, compile_fn),
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+        # wait for the initializer so that its cost is not attributed to the
+        # first compilation
+        self.connection.recv()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join(WORKER_JOIN_TIMEOUT)
+        self.connection.close()
+
+
+class CompileWorkerPool:
+    def __init__(
+        self,
+        initializer: Callable[..., Any],
+        initargs: Tuple[Any, ...],
+        compile_fn: Callable[[Any, Any], Any],
+        num_workers: int = 1,
+    ):
+        """Long-lived worker processes that compile grammars in isolation, so
+        that a compilation that crashes or hangs does not take the benchmark
+        down with it. Each worker builds its state (e.g. a grammar compiler)
+        once with `initializer(*initargs)`, then runs `compile_fn(state,
+        payload)` for each payload and returns the artifact to the parent. A
+        worker that crashes or times out is replaced by a new one, started in
+        the background so that the compilation that lost the worker does not
+        wait for its initializer.
+
+        The initializer, its arguments, the compile function, the payloads and
+        the artifacts must be picklable.
+
+        :param initializer: Callable[..., Any]
+            Builds the state of a worker.
+        :param initargs: Tuple[Any, ...]
+            The arguments of the initializer.
+        :param compile_fn: Callable[[Any, Any], Any]
+            Compiles a payload with the state of a worker.
+        :param num_workers: int
+            The number of worker processes.
+        """
+        self.initializer = initializer
+        self.initargs = initargs
+        self.compile_fn = compile_fn
+        self.num_workers = num_workers
+
+        # None stands for a worker that could not be replaced
+        self._workers: Queue[Optional[_Worker]] = Queue()
+        for _ in range(num_workers):
+            self._workers.put(self._start_worker())
+
+    def _start_worker(self) -> _Worker:
+        return _Worker(self.initializer, self.initargs, self.compile_fn)
+
+    def _replace_worker(self) -> None:
+        def start() -> None:
+            try:
+                self._workers.put(self._start_worker())
+            except Exception:
+                self._workers.put(None)
+
+        Thread(target=start, daemon=True).start()
+
+    def compile(self, payload: Any, timeout: float) -> CompileResult:
+        """Compiles a payload in the first available worker.
+
+        :param payload: Any
+            The input of the compile function, e.g. a JSON schema string.
+        :param timeout: float
+            The maximum time in seconds the compilation may take.
+        :return: CompileResult
+            The artifact returned by the compile function, or the reason why
+            there is none, with the time spent waiting for a worker.
+        """
+        wait_start_time = timestamp()
+        worker = self._workers.get()
+        wait_time = timestamp() - wait_start_time
+
+        if worker is None:
+            self._replace_worker()
+            result = CompileResult(
+                status=CompileResultStatus.CRASH,
+                message="The compile worker could not be restarted",
+            )
+        else:
+            result = self._compile_in_worker(worker, payload, timeout)
+        result.wait_time = wait_time
+        return result
+
+    def _compile_in_worker(
+        self, worker: _Worker, payload: Any, timeout: float
+    ) -> CompileResult:
+        try:
+            worker.connection.send(payload)
+            if not worker.connection.poll(timeout):
+                worker.kill()
+                self._replace_worker()
+                return CompileResult(
+                    status=CompileResultStatus.TIMEOUT,
+                    message="Grammar compilation timed out",
+                )
+            status, value, compile_time = worker.connection.recv()
+        except (EOFError, OSError):
+            worker.process.join(WORKER_JOIN_TIMEOUT)
+            exit_code = worker.process.exitcode
+            worker.kill()
+            self._replace_worker()
+            return CompileResult(
+                status=CompileResultStatus.CRASH,
+                message=(
+                    f"Process terminated by signal {-exit_code}"
+                    if exit_code is not None and exit_code < 0
+                    else f"Process exited with code {exit_code}"
+                ),
+            )
+        except BaseException:
+            # e.g. a payload that cannot be pickled, the worker is still usable
+            self._workers.put(worker)
+            raise
+        self._workers.put(worker)
+
+        if status == CompileResultStatus.ERROR:
+            return CompileResult(status=status, message=value)
+        return CompileResult(status=status, artifact=value, compile_time=compile_time)
+
+    def close(self) -> None:
+        # waits for the workers being replaced
+        for _ in range(self.num_workers):
+            worker = self._workers.get()
+            if worker is not None:
+                worker.kill()
@@ -0,0 +1,332 @@
+import numpy as np
+from dataclasses import dataclass, field, fields
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from core.utils import schema_hash
+from core.types import CompileStatusCode, GenerationOutput, Metric, Schema
+from core.types import optional_metric
+
+# keywords whose value is a subschema
+SUBSCHEMA_KEYWORDS = (
+    "additionalItems",
+    "additionalProperties",
+    "contains",
+    "else",
+    "if",
+    "items",
+    "not",
+    "propertyNames",
+    "then",
+    "unevaluatedItems",
+    "unevaluatedProperties",
+)
+# keywords whose value is a list of subschemas
+SUBSCHEMA_LIST_KEYWORDS = ("allOf", "anyOf", "oneOf", "prefixItems", "items")
+# keywords whose value maps names to subschemas
+SUBSCHEMA_MAP_KEYWORDS = (
+    "$defs",
+    "definitions",
+    "dependentSchemas",
+    "patternProperties",
+    "properties",
+)
+DEFINITIONS_KEYWORDS = ("$defs", "definitions")
+
+DEFAULT_COMPLEXITY_BINS = 4
+
+
+@dataclass
+class SchemaComplexity:
+    """Structural features of a schema that drive the cost of compiling it."""
+
+    # number of subschemas, including the root
+    node_count: int = 0
+    # maximum nesting of subschemas, without following references
+    depth: int = 0
+    ref_count: int = 0
+    # number of definitions that reference themselves, directly or not
+    recursive_definitions: int = 0
+    # number of anyOf/oneOf and the number of branches of the largest one
+    union_count: int = 0
+    max_union_width: int = 0
+    # number of regular expressions, in `pattern` and `patternProperties`
+    pattern_count: int = 0
+    # number of enums and the number of values of the largest one
+    enum_count: int = 0
+    max_enum_size: int = 0
+
+
+COMPLEXITY_FEATURES = [f.name for f in fields(SchemaComplexity)]
+
+
+def _walk(
+    schema: Any,
+    pointer: str,
+    definition: str,
+    depth: int,
+    complexity: SchemaComplexity,
+    definitions: Set[str],
+    references: List[Tuple[str, str]],
+) -> None:
+    if not isinstance(schema, dict):
+        return
+
+    complexity.node_count += 1
+    complexity.depth = max(complexity.depth, depth)
+
+    ref = schema.get("$ref")
+    if isinstance(ref, str):
+        complexity.ref_count += 1
+        # only local references can form cycles within the schema
+        if ref.startswith("#"):
+            references.append((definition, ref[1:]))
+
+    for keyword in ("anyOf", "oneOf"):
+        if isinstance(schema.get(keyword), list):
+            complexity.union_count += 1
+            complexity.max_union_width = max(
+                complexity.max_union_width, len(schema[keyword])
+            )
+    if isinstance(schema.get("pattern"), str):
+        complexity.pattern_count += 1
+    if isinstance(schema.get("patternProperties"), dict):
+        complexity.pattern_count += len(schema["patternProperties"])
+    if isinstance(schema.get("enum"), list):
+        complexity.enum_count += 1
+        complexity.max_enum_size = max(complexity.max_enum_size, len(schema["enum"]))
+
+    def walk(subschema: Any, subpointer: str, subdefinition: str = definition):
+        _walk(
+            subschema,
+            subpointer,
+            subdefinition,
+            depth + 1,
+            complexity,
+            definitions,
+            references,
+        )
+
+    for keyword in SUBSCHEMA_KEYWORDS:
+        if isinstance(schema.get(keyword), dict):
+            walk(schema[keyword], f"{pointer}/{keyword}")
+    for keyword in SUBSCHEMA_LIST_KEYWORDS:
+        if isinstance(schema.get(keyword), list):
+            for i, subschema in enumerate(schema[keyword]):
+                walk(subschema, f"{pointer}/{keyword}/{i}")
+    for keyword in SUBSCHEMA_MAP_KEYWORDS:
+        if isinstance(schema.get(keyword), dict):
+            for name, subschema in schema[keyword].items():
+                subpointer = f"{pointer}/{keyword}/{_escape(name)}"
+                if keyword in DEFINITIONS_KEYWORDS:
+                    definitions.add(subpointer)
+                    walk(subschema, subpointer, subpointer)
+                else:
+                    walk(subschema, subpointer)
+
+
+def _escape(name: str) -> str:
+    return name.replace("~", "~0").replace("/", "~1")
+
+
+def _count_recursive_definitions(
+    definitions: Set[str], references: List[Tuple[str, str]]
+) -> int:
+    """Counts the definitions (and the root) that can reach themselves by
+    following references."""
+
+    def resolve(target: str) -> str:
+        # a reference into a definition belongs to the definition
+        matches = [d for d in definitions if target == d or target.startswith(d + "/")]
+        return max(matches, key=len) if matches else ""
+
+    edges: Dict[str, Set[str]] = {}
+    for source, target in references:
+        edges.setdefault(source, set()).add(resolve(target))
+
+    recursive = 0
+    for start in edges:
+        stack = list(edges[start])
+        seen: Set[str] = set()
+        while stack:
+            node = stack.pop()
+            if node == start:
+                recursive += 1
+                break
+            if node in seen:
+                continue
+            seen.add(node)
+            stack.extend(edges.get(node, ()))
+    return recursive
+
+
+def analyze_schema(schema: Schema) -> SchemaComplexity:
+    """Computes the structural features of a schema. Only local references are
+    resolved to detect recursion, remote references are counted but not
+    followed.
+
+    :param schema: Schema
+        The schema to analyze.
+    :return: SchemaComplexity
+        The features of the schema.
+    """
+    complexity = SchemaComplexity()
+    definitions: Set[str] = set()
+    references: List[Tuple[str, str]] = []
+    _walk(schema, "", "", 0, complexity, definitions, references)
+    complexity.recursive_definitions = _count_recursive_definitions(
+        definitions, references
+    )
+    return complexity
+
+
+@dataclass
+class ComplexityBin:
+    # range of the feature of the schemas of the bin, inclusive
+    low: float
+    high: float
+    count: int = 0
+    declared_coverage: Optional[float] = None
+    empirical_coverage: Optional[float] = None
+    # in s, like `PerfMetrics`
+    gct: Metric = field(default_factory=Metric)
+    tgt: Metric = field(default_factory=Metric)
+
+
+def _ranks(values: np.ndarray) -> np.ndarray:
+    """Ranks of the values, ties share the average of their ranks."""
+    order = np.argsort(values, kind="stable")
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(len(values))
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    return np.bincount(inverse, weights=ranks)[inverse] / counts[inverse]
+
+
+def rank_correlation(x: List[float], y: List[float]) -> Optional[float]:
+    """Spearman correlation of two lists of values, None if either is constant."""
+    if len(x) < 2:
+        return None
+    rx, ry = _ranks(np.asarray(x, dtype=float)), _ranks(np.asarray(y, dtype=float))
+    if np.std(rx) == 0 or np.std(ry) == 0:
+        return None
+    return float(np.corrcoef(rx, ry)[0, 1])
+
+
+class ComplexityReport:
+    def __init__(
+        self, known_complexities: Optional[Dict[str, SchemaComplexity]] = None
+    ):
+        """Relates the latency and the coverage of the outputs to the complexity
+        of their schema, to tell which schemas are slow to compile or likely to
+        fail from their structure alone.
+
+        :param known_complexities: Optional[Dict[str, SchemaComplexity]]
+            The complexities already computed, by schema hash, e.g. read from
+            the schema caches of the dataset. Other schemas are analyzed once.
+        """
+        self.known_complexities = dict(known_complexities or {})
+        self.complexities: List[SchemaComplexity] = []
+        self.gct_list: List[Optional[float]] = []
+        self.tgt_list: List[Optional[float]] = []
+        self.declared_list: List[int] = []
+        self.empirical_list: List[Optional[int]] = []
+
+    def add(self, output: GenerationOutput, valid: Optional[bool]) -> None:
+        """Adds an output to the report.
+
+        :param output: GenerationOutput
+            The output to add.
+        :param valid: Optional[bool]
+            Whether the generation matches the schema, None if there is none.
+        """
+        if output.schema is None:
+            return
+
+        key = schema_hash(output.schema)
+        if key not in self.known_complexities:
+            self.known_complexities[key] = analyze_schema(output.schema)
+        self.complexities.append(self.known_complexities[key])
+        self.gct_list.append(output.perf_metrics.gct)
+        self.tgt_list.append(output.perf_metrics.tgt)
+        self.declared_list.append(
+            int(output.metadata.compile_status.code == CompileStatusCode.OK)
+        )
+        self.empirical_list.append(None if valid is None else int(valid))
+
+    def bins(
+        self, feature: str, num_bins: int = DEFAULT_COMPLEXITY_BINS
+    ) -> List[ComplexityBin]:
+        """Splits the outputs into bins of about the same size by a feature of
+        their schema. Features with few distinct values yield fewer bins.
+
+        :param feature: str
+            The feature of `SchemaComplexity` to bin by.
+        :param num_bins: int
+            The maximum number of bins.
+        :return: List[ComplexityBin]
+            The bins, by increasing complexity.
+        """
+        if feature not in COMPLEXITY_FEATURES:
+            raise ValueError(
+                f"Invalid feature: {feature}, available: {COMPLEXITY_FEATURES}"
+            )
+        if not self.complexities:
+            return []
+
+        values = np.array([getattr(c, feature) for c in self.complexities])
+        edges = np.unique(np.quantile(values, np.linspace(0, 1, num_bins + 1)))
+        indices = np.searchsorted(edges[1:-1], values, side="right")
+
+        bins = []
+        for i in range(max(len(edges) - 1, 1)):
+            members = np.flatnonzero(indices == i)
+            if len(members) == 0:
+                continue
+            empirical = [
+                self.empirical_list[j]
+                for j in members
+                if self.empirical_list[j] is not None
+            ]
+            bins.append(
+                ComplexityBin(
+                    low=float(values[members].min()),
+                    high=float(values[members].max()),
+                    count=len(members),
+                    declared_coverage=float(
+                        np.mean([self.declared_list[j] for j in members])
+                    ),
+                    empirical_coverage=(
+                        float(np.mean(empirical)) if empirical else None
+                    ),
+                    gct=optional_metric(
+                        [
+                            self.gct_list[j]
+                            for j in members
+                            if self.gct_list[j] is not None
+                        ]
+                    ),
+                    tgt=optional_metric(
+                        [
+                            self.tgt_list[j]
+                            for j in members
+                            if self.tgt_list[j] is not None
+                        ]
+                    ),
+                )
+            )
+        return bins
+
+    def gct_correlations(self) -> Dict[str, Optional[float]]:
+        """Rank correlation of each feature with the grammar compilation time,
+        over the outputs whose grammar compiled."""
+        compiled = [
+            (c, gct)
+            for c, gct in zip(self.complexities, self.gct_list)
+            if gct is not None
+        ]
+        return {
+            feature: rank_correlation(
+                [getattr(c, feature) for c, _ in compiled],
+                [gct for _, gct in compiled],
+            )
+            for feature in COMPLEXITY_FEATURES
+        }
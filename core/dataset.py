@@ -1,14 +1,37 @@
-from json import loads
+import os
+import pickle
+import random
+import struct
+import pyarrow as pa
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+from hashlib import sha256
+from json import dumps, loads
 from dataclasses import dataclass
 from datasets import load_dataset
-from typing import Callable, Iterator, Tuple, Optional, List
+from mmap import mmap, ACCESS_READ
+from datasets.table import InMemoryTable
+from datasets import Dataset as HuggingFaceDataset
+from typing import Any, Callable, Dict, Iterator, Tuple, Optional, List, Sequence
 
 from core.types import Schema
+from core.utils import nanoid, schema_hash
+from core.complexity import SchemaComplexity, analyze_schema
 from core.messages import Message, MessagesFormatter
 
 DATASET_SCHEMA_COLUMN = "json_schema"
 DATASET_HUGGINGFACE_PATH = "epfl-dlab/JSONSchemaBench"
 
+SNAPSHOT_INDEX_FILE = "index.json"
+
+SCHEMA_CACHE_DIR = os.getenv(
+    "JSB_SCHEMA_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "jsb", "schemas"),
+)
+# a schema cache file holds the pickled schemas one after the other, then the
+# pickled index of the rows, then the offset of the index
+SCHEMA_CACHE_FOOTER = struct.Struct("<Q")
+
 DATASET_NAMES = [
     "Github_easy",
     "Github_hard",
@@ -28,47 +51,291 @@ DATASET_NAMES = [
 class DatasetConfig:
     dataset_name: str
     limit: Optional[int] = None
+    cache_schemas: bool = True
+    snapshot_dir: Optional[str] = None
 
 
 class Dataset:
     def __init__(self, config: DatasetConfig):
         """Represents the dataset that is used to benchmark the engine.
 
+        The tasks are downloaded from the Hugging Face hub, or read from a local
+        snapshot directory (see `create_snapshot`) to run without network
+        access. The schemas are parsed once and cached on disk, keyed by the
+        fingerprint of the dataset so that a new revision of the dataset
+        invalidates the cache. Each schema is kept pickled, along with its
+        canonical hash, the size of its canonical JSON and its complexity. The
+        cache is memory-mapped and a schema is only unpickled, into a fresh
+        object, when it is accessed since engines may modify schemas in place.
+
         :param config: DatasetConfig
             The configuration for the dataset.
         """
         self.config = config
-        self.dataset = load_dataset(
-            path=DATASET_HUGGINGFACE_PATH, name=config.dataset_name, split="test"
+        if config.snapshot_dir is not None:
+            self.dataset, self.fingerprint = load_snapshot(
+                config.snapshot_dir, config.dataset_name
+            )
+        else:
+            self.dataset = load_dataset(
+                path=DATASET_HUGGINGFACE_PATH, name=config.dataset_name, split="test"
+            )
+            self.fingerprint = dataset_fingerprint(self.dataset)
+
+        self._schemas: Sequence[bytes] = []
+        self.schema_hashes: List[str] = []
+        self.schema_sizes: List[int] = []
+        self.schema_complexities: List[SchemaComplexity] = []
+        self._load_schemas()
+
+    def _cache_path(self) -> str:
+        return os.path.join(
+            SCHEMA_CACHE_DIR, self.config.dataset_name, f"{self.fingerprint}.schemas"
         )
 
+    def _load_schemas(self) -> None:
+        cache_path = self._cache_path()
+        if self.config.cache_schemas and os.path.exists(cache_path):
+            try:
+                self._read_cache(cache_path)
+                return
+            except (ValueError, EOFError, pickle.UnpicklingError, struct.error):
+                # a cache truncated or written in another format is rebuilt
+                pass
+
+        self._set_schemas([loads(item) for item in self.dataset[DATASET_SCHEMA_COLUMN]])
+        if self.config.cache_schemas:
+            self._write_cache(cache_path)
+
+    def _read_cache(self, cache_path: str) -> None:
+        buffer, index = _read_cache_index(cache_path)
+        self._schemas = _SchemaRecords(buffer, index["offsets"])
+        self.schema_hashes = index["hashes"]
+        self.schema_sizes = index["sizes"]
+        self.schema_complexities = index["complexities"]
+
+    def _write_cache(self, cache_path: str) -> None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # unique to the process, so that concurrent runs do not write the same
+        # file, the last one to finish replaces the cache
+        tmp_path = f"{cache_path}.{os.getpid()}.{nanoid()}.tmp"
+        offsets = [0]
+        with open(tmp_path, "wb") as f:
+            for schema in self._schemas:
+                f.write(schema)
+                offsets.append(offsets[-1] + len(schema))
+            pickle.dump(
+                {
+                    "offsets": offsets,
+                    "hashes": self.schema_hashes,
+                    "sizes": self.schema_sizes,
+                    "complexities": self.schema_complexities,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            f.write(SCHEMA_CACHE_FOOTER.pack(offsets[-1]))
+        os.replace(tmp_path, cache_path)
+
+    def _set_schemas(self, schemas: List[Schema]) -> None:
+        self._schemas = [
+            pickle.dumps(schema, protocol=pickle.HIGHEST_PROTOCOL) for schema in schemas
+        ]
+        self.schema_hashes = [schema_hash(schema) for schema in schemas]
+        self.schema_sizes = [
+            len(dumps(schema, sort_keys=True, separators=(",", ":")))
+            for schema in schemas
+        ]
+        self.schema_complexities = [analyze_schema(schema) for schema in schemas]
+
+    def _select(self, indices: List[int]) -> None:
+        self.dataset = self.dataset.select(indices)
+        self._schemas = [self._schemas[i] for i in indices]
+        self.schema_hashes = [self.schema_hashes[i] for i in indices]
+        self.schema_sizes = [self.schema_sizes[i] for i in indices]
+        self.schema_complexities = [self.schema_complexities[i] for i in indices]
+
     def __len__(self):
-        return len(self.dataset)
+        return len(self._schemas)
 
     def __getitem__(self, idx: int) -> Schema:
-        return loads(self.dataset[idx][DATASET_SCHEMA_COLUMN])
+        return pickle.loads(self._schemas[idx])
 
     def filter(self, filter_fn: Callable[[Schema], bool]) -> None:
-        self.dataset = self.dataset.filter(
-            lambda x: filter_fn(loads(x[DATASET_SCHEMA_COLUMN]))
-        )
+        self._select([i for i in range(len(self)) if filter_fn(self[i])])
 
     def map(self, map_fn: Callable[[Schema], Schema]) -> None:
+        schemas = [map_fn(self[i]) for i in range(len(self))]
+        self._set_schemas(schemas)
         self.dataset = self.dataset.map(
-            lambda x: map_fn(loads(x[DATASET_SCHEMA_COLUMN]))
+            lambda _, i: {DATASET_SCHEMA_COLUMN: dumps(schemas[i])},
+            with_indices=True,
         )
 
     def shuffle(self) -> None:
-        self.dataset = self.dataset.shuffle()
+        indices = list(range(len(self)))
+        random.shuffle(indices)
+        self._select(indices)
 
     def iter(
         self, messages_formatter: MessagesFormatter
     ) -> Iterator[Tuple[List[Message], Schema]]:
-        iterator = (
-            self.dataset
+        n = (
+            len(self)
             if self.config.limit is None
-            else self.dataset.take(self.config.limit)
+            else min(len(self), self.config.limit)
         )
-        for item in iterator:
-            schema = loads(item[DATASET_SCHEMA_COLUMN])
+        for idx in range(n):
+            schema = self[idx]
             yield messages_formatter(self.config.dataset_name, schema), schema
+
+
+class _SchemaRecords(Sequence[bytes]):
+    def __init__(self, buffer: Any, offsets: List[int]):
+        """The pickled schemas of a memory-mapped schema cache, read on access.
+
+        :param buffer: Any
+            The mapped cache file.
+        :param offsets: List[int]
+            The offsets of the schemas in the buffer, followed by their end.
+        """
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> bytes:
+        return self.buffer[self.offsets[idx] : self.offsets[idx + 1]]
+
+
+def _read_cache_index(cache_path: str) -> Tuple[Any, Dict[str, Any]]:
+    """Maps a schema cache file and reads its index, without the schemas."""
+    with open(cache_path, "rb") as f:
+        buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+    (index_offset,) = SCHEMA_CACHE_FOOTER.unpack(buffer[-SCHEMA_CACHE_FOOTER.size :])
+    return buffer, pickle.loads(buffer[index_offset : -SCHEMA_CACHE_FOOTER.size])
+
+
+def cached_complexities(dataset_name: str) -> Dict[str, SchemaComplexity]:
+    """Reads the complexities of the schemas of a dataset from its schema
+    caches, for every revision of the dataset that was loaded.
+
+    :param dataset_name: str
+        The name of the dataset.
+    :return: Dict[str, SchemaComplexity]
+        The complexity of each cached schema, by schema hash.
+    """
+    cache_dir = os.path.join(SCHEMA_CACHE_DIR, dataset_name)
+    if not os.path.isdir(cache_dir):
+        return {}
+
+    complexities: Dict[str, SchemaComplexity] = {}
+    for filename in sorted(os.listdir(cache_dir)):
+        if not filename.endswith(".schemas"):
+            continue
+        try:
+            _, index = _read_cache_index(os.path.join(cache_dir, filename))
+        except (ValueError, EOFError, pickle.UnpicklingError, struct.error):
+            continue
+        complexities.update(zip(index["hashes"], index["complexities"]))
+    return complexities
+
+
+def dataset_fingerprint(dataset: HuggingFaceDataset) -> str:
+    """Identifies the content of a dataset. The files a downloaded dataset is
+    read from are named after its revision, so their names and sizes identify
+    it, while the rows of a dataset held in memory are hashed.
+
+    :param dataset: HuggingFaceDataset
+        The dataset to identify.
+    :return: str
+        The fingerprint of the dataset.
+    """
+    digest = sha256()
+    if dataset.cache_files:
+        for cache_file in dataset.cache_files:
+            digest.update(cache_file["filename"].encode("utf-8"))
+            digest.update(str(os.path.getsize(cache_file["filename"])).encode())
+    else:
+        for item in dataset[DATASET_SCHEMA_COLUMN]:
+            digest.update(item.encode("utf-8"))
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def create_snapshot(
+    snapshot_dir: str, dataset_names: List[str] = DATASET_NAMES
+) -> None:
+    """Downloads tasks from the Hugging Face hub into a local snapshot directory,
+    with one Parquet file per task and an index holding the number of rows and
+    the hash of each file.
+
+    :param snapshot_dir: str
+        The directory of the snapshot.
+    :param dataset_names: List[str]
+        The tasks to download.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    index_path = os.path.join(snapshot_dir, SNAPSHOT_INDEX_FILE)
+
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = loads(f.read())
+
+    for dataset_name in dataset_names:
+        dataset = load_dataset(
+            path=DATASET_HUGGINGFACE_PATH, name=dataset_name, split="test"
+        )
+        file_name = f"{dataset_name}.parquet"
+        pq.write_table(
+            pa.table({DATASET_SCHEMA_COLUMN: dataset[DATASET_SCHEMA_COLUMN]}),
+            os.path.join(snapshot_dir, file_name),
+        )
+        with open(os.path.join(snapshot_dir, file_name), "rb") as f:
+            file_hash = sha256(f.read()).hexdigest()
+        index[dataset_name] = {
+            "file": file_name,
+            "num_rows": len(dataset),
+            "sha256": file_hash,
+        }
+
+    with open(index_path, "w") as f:
+        f.write(dumps(index, indent=2))
+
+
+def load_snapshot(
+    snapshot_dir: str, dataset_name: str
+) -> Tuple[HuggingFaceDataset, str]:
+    """Loads a task from a local snapshot directory. The index maps each task to
+    a Parquet or JSONL file with a `json_schema` column. The file is hashed to
+    fingerprint the dataset, so that a file edited in place does not reuse the
+    schemas cached for its previous content.
+
+    :param snapshot_dir: str
+        The directory of the snapshot.
+    :param dataset_name: str
+        The task to load.
+    :return: Tuple[HuggingFaceDataset, str]
+        The task dataset and the hash of its file.
+    """
+    with open(os.path.join(snapshot_dir, SNAPSHOT_INDEX_FILE), "r") as f:
+        index = loads(f.read())
+
+    if dataset_name not in index:
+        raise ValueError(f"Task {dataset_name} not found in snapshot {snapshot_dir}")
+
+    entry = index[dataset_name]
+    path = os.path.join(snapshot_dir, entry["file"])
+    with open(path, "rb") as f:
+        file_hash = sha256(f.read()).hexdigest()
+    if file_hash != entry["sha256"]:
+        print(f"The file of task {dataset_name} does not match the snapshot index.")
+
+    if path.endswith(".parquet"):
+        table = pq.read_table(path, columns=[DATASET_SCHEMA_COLUMN])
+    else:
+        table = pa_json.read_json(path).select([DATASET_SCHEMA_COLUMN])
+
+    return HuggingFaceDataset(InMemoryTable(table), fingerprint=file_hash), file_hash
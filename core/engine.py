@@ -1,9 +1,21 @@
+import asyncio
+from threading import Lock
 from dataclasses import dataclass
 from abc import ABC, abstractmethod
-from typing import List, Optional, TypeVar, Generic
+from typing import List, Optional, Tuple, TypeVar, Generic
 
 from core.messages import Message
-from core.profile import profile_generation
+from core.scheduler import RateLimiter
+from core.grammar_cache import GrammarCache
+from core.prompts import PreparedPrompt, prompt_cache
+from core.profile import (
+    measure_phase,
+    profile_generation,
+    profile_async_generation,
+    profile_batch_generation,
+    profile_compilation,
+    timestamp,
+)
 from core.types import (
     Schema,
     TokenUsage,
@@ -21,8 +33,16 @@ T = TypeVar("T", bound=EngineConfig)
 
 class Engine(ABC, Generic[T]):
     name: str
-
-    def __init__(self, config: T):
+    # whether `generate` can be called from several threads at once
+    supports_concurrency: bool = False
+    # whether the engine implements `_generate_batch`
+    supports_batching: bool = False
+    # whether the engine implements `_compile`
+    supports_compile_only: bool = False
+    # whether the engine implements `_agenerate`
+    supports_async: bool = False
+
+    def __init__(self, config: T, compile_only: bool = False):
         """Defines the interface that should be implemented by all engines.
         Engines are assumed to take a schema and generate a JSON object that
         matches the schema.
@@ -30,10 +50,25 @@ class Engine(ABC, Generic[T]):
         :param config: EngineConfig
             Configuration for the engine. This config is passed to the
             engine constructor and is used to configure the engine.
+        :param compile_only: bool
+            Whether the engine is only used to compile grammars with `compile`,
+            in which case the engines that can do without the model weights do
+            not load them.
         """
 
         self.config = config
+        self.compile_only = compile_only
         self.total_usage = TokenUsage()
+        self._usage_lock = Lock()
+        # set by engines that store their compiled grammars on disk
+        self.grammar_cache: Optional[GrammarCache] = None
+        # identifies the chat template and the tokenizer of the engines that
+        # implement `render_prompt` and `tokenize_prompt`, the engines with the
+        # same key share their prepared prompts
+        self.prompt_cache_key: Optional[str] = None
+        # set by `bench` to the rate limiter of its scheduler, which the engines
+        # that retry their requests use to admit the retries
+        self.rate_limiter: Optional[RateLimiter] = None
 
     @profile_generation
     def generate(
@@ -64,9 +99,163 @@ class Engine(ABC, Generic[T]):
 
         self._generate(output)
 
-        self.total_usage += output.token_usage
+        with self._usage_lock:
+            self.total_usage += output.token_usage
+        return output
+
+    async def agenerate(
+        self,
+        task: str,
+        messages: List[Message],
+        schema: Schema,
+    ) -> GenerationOutput:
+        """Coroutine version of `generate`, to have many generations in flight
+        on a single event loop.
+
+        Engines that support it generate on the event loop with `_agenerate`,
+        the other engines run `generate` in a thread of the default executor of
+        the loop, which requires `supports_concurrency` to run more than one at
+        a time.
+
+        :param task: str
+            The task to generate the JSON object for.
+        :param messages: List[Message]
+            The messages to generate the JSON object for.
+        :param schema: Schema
+            The schema to generate the JSON object for.
+        :return: GenerationOutput
+            The generation output.
+        """
+        if not self.supports_async:
+            return await asyncio.to_thread(self.generate, task, messages, schema)
+        return await self._profiled_agenerate(task, messages, schema)
+
+    @profile_async_generation
+    async def _profiled_agenerate(
+        self,
+        task: str,
+        messages: List[Message],
+        schema: Schema,
+    ) -> GenerationOutput:
+        schema = self.adapt_schema(schema)
+        output = GenerationOutput(
+            task=task, messages=messages, generation="", schema=schema
+        )
+
+        await self._agenerate(output)
+
+        with self._usage_lock:
+            self.total_usage += output.token_usage
+        return output
+
+    async def _agenerate(self, output: GenerationOutput) -> None:
+        """The method that should be implemented by engines that support
+        `agenerate`. It is the coroutine version of `_generate`, and must not
+        block the event loop: the timestamps of the outputs in flight are only
+        recorded when the loop gets to them.
+
+        :param output: GenerationOutput
+            The generation output.
+        :return: None
+            The generation output is modified in place.
+        """
+        raise NotImplementedError
+
+    def generate_batch(
+        self,
+        task: str,
+        samples: List[Tuple[List[Message], Schema]],
+    ) -> List[GenerationOutput]:
+        """Generates a JSON object for each (messages, schema) pair of a batch.
+
+        Engines that support batching generate the whole batch at once with
+        `_generate_batch`, the other engines generate the samples one by one.
+
+        :param task: str
+            The task to generate the JSON objects for.
+        :param samples: List[Tuple[List[Message], Schema]]
+            The messages and the schema of each sample of the batch.
+        :return: List[GenerationOutput]
+            The generation outputs, in the same order as the samples.
+        """
+        if not self.supports_batching:
+            return [
+                self.generate(task, messages, schema) for messages, schema in samples
+            ]
+        return self._profiled_generate_batch(task, samples)
+
+    @profile_batch_generation
+    def _profiled_generate_batch(
+        self,
+        task: str,
+        samples: List[Tuple[List[Message], Schema]],
+    ) -> List[GenerationOutput]:
+        outputs = [
+            GenerationOutput(
+                task=task,
+                messages=messages,
+                generation="",
+                schema=self.adapt_schema(schema),
+            )
+            for messages, schema in samples
+        ]
+
+        self._generate_batch(outputs)
+
+        with self._usage_lock:
+            for output in outputs:
+                self.total_usage += output.token_usage
+        return outputs
+
+    def _generate_batch(self, outputs: List[GenerationOutput]) -> None:
+        """The method that should be implemented by engines that support
+        batching. It takes the generation outputs of a batch and modifies them
+        in place. Since all the sequences of a batch start together, the
+        engine should set the `last_token_arrival_time` of each output, and
+        the `grammar_compilation_start_time` if the grammars are compiled one
+        after the other.
+
+        :param outputs: List[GenerationOutput]
+            The generation outputs.
+        :return: None
+            The generation outputs are modified in place.
+        """
+        raise NotImplementedError
+
+    @profile_compilation
+    def compile(self, task: str, schema: Schema) -> GenerationOutput:
+        """Compiles the grammar of a schema without generating anything, to
+        benchmark the grammar compilation alone.
+
+        :param task: str
+            The task the schema belongs to.
+        :param schema: Schema
+            The schema to compile.
+        :return: GenerationOutput
+            An output holding the compile status and the grammar compilation
+            time, with an empty generation.
+        """
+        if not self.supports_compile_only:
+            raise ValueError(f"Engine {self.name} does not support compile-only mode")
+
+        schema = self.adapt_schema(schema)
+        output = GenerationOutput(task=task, messages=[], generation="", schema=schema)
+
+        self._compile(output)
         return output
 
+    def _compile(self, output: GenerationOutput) -> None:
+        """The method that should be implemented by engines that support the
+        compile-only mode. It compiles the grammar of the schema of the output,
+        and sets its compile status and `grammar_compilation_end_time`.
+
+        :param output: GenerationOutput
+            The generation output.
+        :return: None
+            The generation output is modified in place.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def _generate(
         self,
@@ -92,6 +281,83 @@ class Engine(ABC, Generic[T]):
         """
         raise NotImplementedError
 
+    def prepare_prompt(self, output: GenerationOutput) -> PreparedPrompt:
+        """Renders the messages of an output with the chat template of the model
+        and tokenizes them, once for all the engines with the same
+        `prompt_cache_key`, and sets the number of input tokens of the output.
+        When the prompt was already prepared, the lookup is measured as the
+        prompt formatting phase and the tokenization takes no time, so that
+        both phases are recorded for every output.
+
+        :param output: GenerationOutput
+            The generation output.
+        :return: PreparedPrompt
+            The text and the token ids of the prompt.
+        """
+
+        def prepare() -> PreparedPrompt:
+            with measure_phase("prompt_formatting", output):
+                text = self.render_prompt(output.messages)
+            with measure_phase("tokenization", output):
+                token_ids = self.tokenize_prompt(text)
+            return PreparedPrompt(text=text, token_ids=token_ids)
+
+        if self.prompt_cache_key is None:
+            prompt = prepare()
+        else:
+            lookup_start_time = timestamp()
+            prompt, hit = prompt_cache.get(
+                self.prompt_cache_key, output.messages, prepare
+            )
+            if hit:
+                output.metadata.phases.prompt_formatting = (
+                    timestamp() - lookup_start_time
+                )
+                output.metadata.phases.tokenization = 0.0
+
+        output.token_usage.input_tokens = len(prompt.token_ids)
+        return prompt
+
+    def render_prompt(self, messages: List[Message]) -> str:
+        """Renders messages with the chat template of the model. This should be
+        implemented by the engines that use `prepare_prompt`.
+
+        :param messages: List[Message]
+            The messages to render.
+        :return: str
+            The prompt.
+        """
+        raise NotImplementedError
+
+    def tokenize_prompt(self, prompt: str) -> List[int]:
+        """Tokenizes a rendered prompt the way the model expects it, e.g. without
+        adding special tokens the chat template already contains. This should
+        be implemented by the engines that use `prepare_prompt`.
+
+        :param prompt: str
+            The prompt to tokenize.
+        :return: List[int]
+            The token ids of the prompt.
+        """
+        raise NotImplementedError
+
+    def materialize_tokens(self, output: GenerationOutput) -> None:
+        """Fills in the ids of the generated tokens that the engine only kept as
+        text while decoding, e.g. the chunks streamed by an API. This is done
+        once the output is saved or returned rather than in the generation, so
+        that the tokenizer round trip of each token is not part of the measured
+        latency. Engines without a tokenizer leave the ids empty.
+
+        :param output: GenerationOutput
+            The generation output, modified in place.
+        """
+        for token in output.generated_tokens:
+            if token.id is not None or not token.text:
+                continue
+            token.id = self.convert_token_to_id(token.text)
+            if token.id is None:
+                return
+
     def adapt_schema(self, schema: Schema) -> Schema:
         """Adapts the schema to the engine. This should be implemented if the
         engine needs to modify the schema in some way before generating.
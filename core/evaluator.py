@@ -1,31 +1,124 @@
 import numpy as np
+from math import ceil
 from uuid import UUID
 from json import loads
-from typing import List, Tuple
+from copy import deepcopy
+from threading import Lock
+from dataclasses import dataclass, fields
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 from ipaddress import IPv4Address, IPv6Address
 from jsonschema import Draft202012Validator, FormatChecker, SchemaError
 
-from core.utils import bootstrap
+from core.utils import (
+    BOOTSTRAP_SAMPLES,
+    BOOTSTRAP_SEED,
+    bootstrap,
+    schema_hash,
+    unpack_float32,
+)
 from core.types import (
     Schema,
     CompileStatusCode,
     GenerationOutput,
     AggregatedPerfMetrics,
+    GenerationPhases,
+    TokenLatencyStats,
+    CompilationMetrics,
     Metric,
+    optional_metric,
 )
 
+VALIDATOR_CACHE_SIZE = 4096
 
-def is_json_schema_valid(schema: Schema):
-    try:
-        Draft202012Validator.check_schema(schema)
-        return True
-    except SchemaError:
-        return False
+# a token is stalled when it arrives this many times later than the median token
+# of its generation
+STALL_FACTOR = 5
 
 
 format_checker = FormatChecker()
 
 
+@dataclass
+class ValidatorCacheInfo:
+    hits: int = 0
+    misses: int = 0
+    size: int = 0
+    max_size: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"validator cache: {self.hits:,} hits, {self.misses:,} misses, "
+            f"{self.size:,}/{self.max_size:,} entries."
+        )
+
+
+class ValidatorCache:
+    def __init__(self, max_size: int = VALIDATOR_CACHE_SIZE):
+        """Bounded LRU cache of checked and built validators keyed by the
+        canonical hash of the schema. Invalid schemas are cached as None so
+        that they are not checked again either.
+
+        :param max_size: int
+            The maximum number of validators kept in the cache.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = Lock()
+        self._validators: OrderedDict[str, Optional[Draft202012Validator]] = (
+            OrderedDict()
+        )
+
+    def get(self, schema: Schema) -> Optional[Draft202012Validator]:
+        key = schema_hash(schema)
+        with self._lock:
+            if key in self._validators:
+                self.hits += 1
+                self._validators.move_to_end(key)
+                return self._validators[key]
+            self.misses += 1
+
+        try:
+            Draft202012Validator.check_schema(schema)
+            # the validator keeps a reference to the schema, which callers may
+            # mutate afterwards (e.g. `adapt_schema`), so it is built on a copy
+            validator = Draft202012Validator(
+                deepcopy(schema), format_checker=format_checker
+            )
+        except SchemaError:
+            validator = None
+
+        with self._lock:
+            self._validators[key] = validator
+            if len(self._validators) > self.max_size:
+                self._validators.popitem(last=False)
+        return validator
+
+    def info(self) -> ValidatorCacheInfo:
+        return ValidatorCacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            size=len(self._validators),
+            max_size=self.max_size,
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._validators.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+validator_cache = ValidatorCache()
+
+
+def is_json_schema_valid(schema: Schema):
+    return validator_cache.get(schema) is not None
+
+
 @format_checker.checks("ipv4")
 def ipv4_check(value):
     IPv4Address(value)
@@ -42,9 +135,9 @@ def uuid_check(value):
 
 
 def validate_json_schema(instance: Schema, schema: Schema) -> bool:
-    if not is_json_schema_valid(schema):
+    validator = validator_cache.get(schema)
+    if validator is None:
         return False
-    validator = Draft202012Validator(schema, format_checker=format_checker)
     try:
         validator.validate(instance)
 
@@ -54,124 +147,386 @@ def validate_json_schema(instance: Schema, schema: Schema) -> bool:
     return True
 
 
-def evaluate(
-    outputs: List[GenerationOutput],
-) -> Tuple[Metric, Metric, Metric, AggregatedPerfMetrics, Metric]:
-    output_tokens_list = []
-    declared_coverage_list = []
-    empirical_coverage_list = []
+def is_generation_valid(generation: str, schema: Schema) -> bool:
+    try:
+        json_object = loads(generation)
+    except Exception:
+        return False
+    return validate_json_schema(json_object, schema)
 
-    for generation_output in outputs:
-        generation = generation_output.generation
-        schema = generation_output.schema
 
-        if schema is None or generation is None:
-            continue
+# schemas shipped once to each worker of the evaluation pool
+_worker_schemas: List[Schema] = []
+
+
+def _init_evaluation_worker(schemas: List[Schema]) -> None:
+    global _worker_schemas
+    _worker_schemas = schemas
+
+
+def _evaluate_chunk(chunk: List[Tuple[str, int]]) -> Tuple[List[bool], int, int]:
+    hits, misses = validator_cache.hits, validator_cache.misses
+    valid = [
+        is_generation_valid(generation, _worker_schemas[schema_index])
+        for generation, schema_index in chunk
+    ]
+    return valid, validator_cache.hits - hits, validator_cache.misses - misses
+
+
+def are_generations_valid(
+    generations: List[str],
+    schemas: List[Schema],
+    num_workers: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+) -> List[bool]:
+    """Checks that each generation is a JSON object matching its schema.
+
+    With more than one worker, the generations are sharded in chunks across a
+    process pool. Each distinct schema is shipped once per worker and chunks
+    only reference it by index. The results are returned in the input order.
+
+    :param generations: List[str]
+        The generations to check.
+    :param schemas: List[Schema]
+        The schema of each generation.
+    :param num_workers: Optional[int]
+        The number of processes to use, the check is done serially if None.
+    :param chunk_size: Optional[int]
+        The number of generations sent to a worker at once.
+    :return: List[bool]
+        Whether each generation is valid.
+    """
+    if num_workers is None or num_workers <= 1 or len(generations) <= 1:
+        return [
+            is_generation_valid(generation, schema)
+            for generation, schema in zip(generations, schemas)
+        ]
+
+    unique_schemas: List[Schema] = []
+    schema_indices: Dict[str, int] = {}
+    items: List[Tuple[str, int]] = []
+    for generation, schema in zip(generations, schemas):
+        key = schema_hash(schema)
+        if key not in schema_indices:
+            schema_indices[key] = len(unique_schemas)
+            unique_schemas.append(schema)
+        items.append((generation, schema_indices[key]))
+
+    if chunk_size is None:
+        chunk_size = max(1, ceil(len(items) / (num_workers * 4)))
+    chunks = [items[i : i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    valid: List[bool] = []
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=_init_evaluation_worker,
+        initargs=(unique_schemas,),
+    ) as executor:
+        for chunk_valid, hits, misses in executor.map(_evaluate_chunk, chunks):
+            valid.extend(chunk_valid)
+            validator_cache.hits += hits
+            validator_cache.misses += misses
+    return valid
 
-        if generation_output.metadata.compile_status.code == CompileStatusCode.OK:
-            declared_coverage_list.append(1)
+
+class TaskEvaluation:
+    def __init__(self):
+        """Running aggregates of the outputs of a task. Outputs can be added one
+        at a time as they are generated, so that they do not need to be kept in
+        memory until the end of the benchmark.
+        """
+        self.output_tokens_list: List[float] = []
+        self.declared_coverage_list: List[int] = []
+        self.empirical_coverage_list: List[int] = []
+        self.ttft_list: List[float] = []
+        self.tpot_list: List[float] = []
+        self.tgt_list: List[float] = []
+        self.gct_list: List[float] = []
+        self.cold_gct_list: List[float] = []
+        self.warm_gct_list: List[float] = []
+        # durations of the phases of `GenerationPhases` in ms
+        self.phase_lists: Dict[str, List[float]] = {
+            f.name: [] for f in fields(GenerationPhases)
+        }
+        self.token_intervals_list: List[np.ndarray] = []
+        self.mask_times_list: List[np.ndarray] = []
+        self.stalled_tokens = 0
+        self.peak_memory_list: List[float] = []
+        self.peak_gpu_memory_list: List[float] = []
+        self.grammar_memory_list: List[float] = []
+        self.cached_prompt_tokens_list: List[float] = []
+
+    def add(self, output: GenerationOutput, valid: Optional[bool] = None) -> None:
+        """Adds an output to the aggregates.
+
+        :param output: GenerationOutput
+            The output to add.
+        :param valid: Optional[bool]
+            Whether the generation matches the schema, checked here if None.
+        """
+        if output.perf_metrics.ttft is not None:
+            self.ttft_list.append(output.perf_metrics.ttft)
+        if output.perf_metrics.tpot is not None:
+            self.tpot_list.append(output.perf_metrics.tpot)
+        if output.perf_metrics.tgt is not None:
+            self.tgt_list.append(output.perf_metrics.tgt)
+        if output.perf_metrics.gct is not None:
+            self.gct_list.append(output.perf_metrics.gct)
+            if output.metadata.grammar_cache_hit is True:
+                self.warm_gct_list.append(output.perf_metrics.gct)
+            elif output.metadata.grammar_cache_hit is False:
+                self.cold_gct_list.append(output.perf_metrics.gct)
+
+        for phase, phase_list in self.phase_lists.items():
+            duration = getattr(output.metadata.phases, phase)
+            if duration is not None:
+                phase_list.append(duration * 1000)
+
+        if output.metadata.token_intervals is not None:
+            token_intervals = unpack_float32(output.metadata.token_intervals)
+            self.token_intervals_list.append(token_intervals)
+            self.stalled_tokens += int(
+                np.sum(token_intervals > STALL_FACTOR * np.median(token_intervals))
+            )
+        if output.metadata.mask_times is not None:
+            self.mask_times_list.append(unpack_float32(output.metadata.mask_times))
+
+        if output.perf_metrics.peak_memory is not None:
+            self.peak_memory_list.append(output.perf_metrics.peak_memory)
+        if output.perf_metrics.peak_gpu_memory is not None:
+            self.peak_gpu_memory_list.append(output.perf_metrics.peak_gpu_memory)
+        if output.perf_metrics.grammar_memory is not None:
+            self.grammar_memory_list.append(output.perf_metrics.grammar_memory)
+        if output.metadata.cached_prompt_tokens is not None:
+            self.cached_prompt_tokens_list.append(output.metadata.cached_prompt_tokens)
+
+        if output.schema is None or output.generation is None:
+            return
+
+        if output.metadata.compile_status.code == CompileStatusCode.OK:
+            self.declared_coverage_list.append(1)
         else:
-            declared_coverage_list.append(0)
+            self.declared_coverage_list.append(0)
 
-        try:
-            json_object = loads(generation)
-        except Exception:
-            empirical_coverage_list.append(0)
-            continue
+        if valid is None:
+            valid = is_generation_valid(output.generation, output.schema)
 
-        if not validate_json_schema(json_object, schema):
-            empirical_coverage_list.append(0)
-            continue
+        if not valid:
+            self.empirical_coverage_list.append(0)
+            return
 
-        empirical_coverage_list.append(1)
-        output_tokens_list.append(generation_output.token_usage.output_tokens)
+        self.empirical_coverage_list.append(1)
+        self.output_tokens_list.append(output.token_usage.output_tokens)
 
-    ttft_list = [
-        generation_output.perf_metrics.ttft
-        for generation_output in outputs
-        if generation_output.perf_metrics.ttft is not None
-    ]
-    tpot_list = [
-        generation_output.perf_metrics.tpot
-        for generation_output in outputs
-        if generation_output.perf_metrics.tpot is not None
-    ]
-    tgt_list = [
-        generation_output.perf_metrics.tgt
-        for generation_output in outputs
-        if generation_output.perf_metrics.tgt is not None
-    ]
-    gct_list = [
-        generation_output.perf_metrics.gct
-        for generation_output in outputs
-        if generation_output.perf_metrics.gct is not None
-    ]
+    def _token_latency_stats(self) -> TokenLatencyStats:
+        stats = TokenLatencyStats()
+        if self.token_intervals_list:
+            token_intervals = np.concatenate(self.token_intervals_list)
+            if len(token_intervals) > 0:
+                stats.p50, stats.p90, stats.p99 = (
+                    float(p) for p in np.percentile(token_intervals, [50, 90, 99])
+                )
+                stats.stall_rate = self.stalled_tokens / len(token_intervals)
+        if self.mask_times_list:
+            mask_times = np.concatenate(self.mask_times_list)
+            if len(mask_times) > 0:
+                stats.mask_p50, stats.mask_p99 = (
+                    float(p) for p in np.percentile(mask_times, [50, 99])
+                )
+        return stats
 
-    compliance_list = [
-        ec for ec, dc in zip(empirical_coverage_list, declared_coverage_list) if dc == 1
-    ]
+    def result(
+        self,
+        n_bootstrap_samples: int = BOOTSTRAP_SAMPLES,
+        seed: Optional[int] = BOOTSTRAP_SEED,
+    ) -> Tuple[Metric, Metric, Metric, AggregatedPerfMetrics, Metric]:
+        output_tokens_list = self.output_tokens_list
+        declared_coverage_list = self.declared_coverage_list
+        empirical_coverage_list = self.empirical_coverage_list
+        ttft_list = self.ttft_list
+        tpot_list = self.tpot_list
+        tgt_list = self.tgt_list
+        gct_list = self.gct_list
+
+        compliance_list = [
+            ec
+            for ec, dc in zip(empirical_coverage_list, declared_coverage_list)
+            if dc == 1
+        ]
+
+        dc_mean_list = bootstrap(
+            declared_coverage_list, np.mean, n_bootstrap_samples, seed
+        )
+        ec_mean_list = bootstrap(
+            empirical_coverage_list, np.mean, n_bootstrap_samples, seed
+        )
+        c_mean_list = bootstrap(compliance_list, np.mean, n_bootstrap_samples, seed)
 
-    dc_mean_list = bootstrap(declared_coverage_list, np.mean)
-    ec_mean_list = bootstrap(empirical_coverage_list, np.mean)
-    c_mean_list = bootstrap(compliance_list, np.mean)
-
-    return (
-        Metric(
-            values=dc_mean_list,
-            median=np.median(dc_mean_list),
-            min=min(dc_mean_list),
-            max=max(dc_mean_list),
-            std=np.std(dc_mean_list),
-        ),
-        Metric(
-            values=ec_mean_list,
-            median=np.median(ec_mean_list),
-            min=min(ec_mean_list),
-            max=max(ec_mean_list),
-            std=np.std(ec_mean_list),
-        ),
-        Metric(
-            values=c_mean_list,
-            median=np.median(c_mean_list),
-            min=min(c_mean_list),
-            max=max(c_mean_list),
-            std=np.std(c_mean_list),
-        ),
-        AggregatedPerfMetrics(
-            ttft=Metric(
-                values=ttft_list,
-                median=np.median(ttft_list),
-                min=min(ttft_list),
-                max=max(ttft_list),
-                std=np.std(ttft_list),
+        return (
+            Metric(
+                values=dc_mean_list,
+                median=np.median(dc_mean_list),
+                min=min(dc_mean_list),
+                max=max(dc_mean_list),
+                std=np.std(dc_mean_list),
             ),
-            tpot=Metric(
-                values=tpot_list,
-                median=np.median(tpot_list),
-                min=min(tpot_list),
-                max=max(tpot_list),
-                std=np.std(tpot_list),
+            Metric(
+                values=ec_mean_list,
+                median=np.median(ec_mean_list),
+                min=min(ec_mean_list),
+                max=max(ec_mean_list),
+                std=np.std(ec_mean_list),
             ),
-            tgt=Metric(
-                values=tgt_list,
-                median=np.median(tgt_list),
-                min=min(tgt_list),
-                max=max(tgt_list),
-                std=np.std(tgt_list),
+            Metric(
+                values=c_mean_list,
+                median=np.median(c_mean_list),
+                min=min(c_mean_list),
+                max=max(c_mean_list),
+                std=np.std(c_mean_list),
             ),
-            gct=Metric(
-                values=gct_list,
-                median=np.median(gct_list),
-                min=min(gct_list),
-                max=max(gct_list),
-                std=np.std(gct_list),
+            AggregatedPerfMetrics(
+                ttft=Metric(
+                    values=ttft_list,
+                    median=np.median(ttft_list),
+                    min=min(ttft_list),
+                    max=max(ttft_list),
+                    std=np.std(ttft_list),
+                ),
+                tpot=Metric(
+                    values=tpot_list,
+                    median=np.median(tpot_list),
+                    min=min(tpot_list),
+                    max=max(tpot_list),
+                    std=np.std(tpot_list),
+                ),
+                tgt=Metric(
+                    values=tgt_list,
+                    median=np.median(tgt_list),
+                    min=min(tgt_list),
+                    max=max(tgt_list),
+                    std=np.std(tgt_list),
+                ),
+                # the API engines have no grammar compilation time
+                gct=optional_metric(gct_list),
+                cold_gct=optional_metric(self.cold_gct_list),
+                warm_gct=optional_metric(self.warm_gct_list),
+                phases={
+                    phase: optional_metric(phase_list)
+                    for phase, phase_list in self.phase_lists.items()
+                },
+                itl=self._token_latency_stats(),
+                peak_memory=optional_metric(self.peak_memory_list),
+                peak_gpu_memory=optional_metric(self.peak_gpu_memory_list),
+                grammar_memory=optional_metric(self.grammar_memory_list),
+                cached_prompt_tokens=optional_metric(self.cached_prompt_tokens_list),
             ),
-        ),
-        Metric(
-            values=output_tokens_list,
-            median=np.median(output_tokens_list),
-            min=min(output_tokens_list),
-            max=max(output_tokens_list),
-            std=np.std(output_tokens_list),
-        ),
+            Metric(
+                values=output_tokens_list,
+                median=np.median(output_tokens_list),
+                min=min(output_tokens_list),
+                max=max(output_tokens_list),
+                std=np.std(output_tokens_list),
+            ),
+        )
+
+
+class CompilationEvaluation:
+    def __init__(self):
+        """Running aggregates of the outputs of a task in compile-only mode, see
+        `Engine.compile`."""
+        self.gct_list: List[float] = []
+        self.cold_gct_list: List[float] = []
+        self.warm_gct_list: List[float] = []
+        self.status_counts: Dict[str, int] = {}
+
+    def add(self, output: GenerationOutput) -> None:
+        code = output.metadata.compile_status.code.name
+        self.status_counts[code] = self.status_counts.get(code, 0) + 1
+
+        if output.perf_metrics.gct is None:
+            return
+        gct = output.perf_metrics.gct * 1000
+        self.gct_list.append(gct)
+        if output.metadata.grammar_cache_hit is True:
+            self.warm_gct_list.append(gct)
+        elif output.metadata.grammar_cache_hit is False:
+            self.cold_gct_list.append(gct)
+
+    def result(self, duration: float) -> CompilationMetrics:
+        """Summarizes the compilations of the task.
+
+        :param duration: float
+            The wall time spent compiling the schemas of the task, in s.
+        :return: CompilationMetrics
+            The compilation metrics of the task.
+        """
+        total = sum(self.status_counts.values())
+        metrics = CompilationMetrics(
+            success_rate=(
+                self.status_counts.get(CompileStatusCode.OK.name, 0) / total
+                if total > 0
+                else None
+            ),
+            throughput=total / duration if duration > 0 else None,
+            gct=optional_metric(self.gct_list),
+            cold_gct=optional_metric(self.cold_gct_list),
+            warm_gct=optional_metric(self.warm_gct_list),
+            status_counts=dict(self.status_counts),
+        )
+        if self.gct_list:
+            metrics.gct_p90, metrics.gct_p99 = (
+                float(p) for p in np.percentile(self.gct_list, [90, 99])
+            )
+        return metrics
+
+
+def evaluate(
+    outputs: List[GenerationOutput],
+    num_workers: Optional[int] = None,
+    n_bootstrap_samples: int = BOOTSTRAP_SAMPLES,
+    seed: Optional[int] = BOOTSTRAP_SEED,
+    on_validated: Optional[Callable[[GenerationOutput, Optional[bool]], None]] = None,
+) -> Tuple[Metric, Metric, Metric, AggregatedPerfMetrics, Metric]:
+    """Validates the outputs of a task and aggregates their scores.
+
+    :param outputs: List[GenerationOutput]
+        The outputs of the task.
+    :param num_workers: Optional[int]
+        The number of processes to validate the generations with.
+    :param n_bootstrap_samples: int
+        The number of bootstrap samples of the confidence intervals.
+    :param seed: Optional[int]
+        The seed of the bootstrap, None for a random one.
+    :param on_validated: Optional[Callable[[GenerationOutput, Optional[bool]], None]]
+        Called with each output and whether its generation matches its schema,
+        None if it has no schema or no generation, to reuse the validation.
+    :return: Tuple[Metric, Metric, Metric, AggregatedPerfMetrics, Metric]
+        The declared coverage, the empirical coverage, the compliance, the perf
+        metrics and the number of output tokens.
+    """
+    evaluation = TaskEvaluation()
+
+    evaluated_outputs = [
+        generation_output
+        for generation_output in outputs
+        if generation_output.schema is not None
+        and generation_output.generation is not None
+    ]
+    valid_list = are_generations_valid(
+        [generation_output.generation for generation_output in evaluated_outputs],
+        [generation_output.schema for generation_output in evaluated_outputs],
+        num_workers=num_workers,
     )
+    for generation_output, valid in zip(evaluated_outputs, valid_list):
+        evaluation.add(generation_output, valid)
+        if on_validated is not None:
+            on_validated(generation_output, valid)
+
+    # outputs without a schema or a generation only contribute perf metrics
+    for generation_output in outputs:
+        if generation_output.schema is None or generation_output.generation is None:
+            evaluation.add(generation_output)
+            if on_validated is not None:
+                on_validated(generation_output, None)
+
+    return evaluation.result(n_bootstrap_samples, seed)
@@ -0,0 +1,155 @@
+import os
+from uuid import uuid4
+from threading import Lock
+from dataclasses import dataclass
+from typing import Any, Iterator, Optional, Tuple
+
+from core.types import Schema
+from core.utils import schema_hash
+
+GRAMMAR_CACHE_DIR = os.getenv(
+    "JSB_GRAMMAR_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "jsb", "grammars"),
+)
+
+# maximum size of the whole cache directory, shared by all engines
+GRAMMAR_CACHE_MAX_BYTES = int(os.getenv("JSB_GRAMMAR_CACHE_MAX_BYTES", 2 * 1024**3))
+
+
+def tokenizer_fingerprint(*parts: Any) -> str:
+    """Hashes everything a compiled grammar depends on besides the schema, e.g.
+    the version of the library and the vocabulary of the tokenizer."""
+    return schema_hash(list(parts))
+
+
+@dataclass
+class GrammarCacheInfo:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    size: int = 0
+    max_size: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"grammar cache: {self.hits:,} hits, {self.misses:,} misses, "
+            f"{self.evictions:,} evictions, "
+            f"{self.size / 1024**2:,.1f}/{self.max_size / 1024**2:,.1f} MB."
+        )
+
+
+class GrammarCache:
+    def __init__(
+        self,
+        engine: str,
+        fingerprint: str,
+        directory: str = GRAMMAR_CACHE_DIR,
+        max_size: int = GRAMMAR_CACHE_MAX_BYTES,
+    ):
+        """Disk cache of compiled grammars shared across runs, keyed by the
+        engine, the fingerprint of its tokenizer and the canonical hash of the
+        schema. Engines store whatever serialized form of the grammar they can
+        load back faster than compiling it. When the cache directory grows over
+        `max_size`, the least recently used grammars of all engines are evicted.
+
+        :param engine: str
+            The name of the engine.
+        :param fingerprint: str
+            The fingerprint of the tokenizer, see `tokenizer_fingerprint`.
+        :param directory: str
+            The root directory of the cache.
+        :param max_size: int
+            The maximum size of the root directory, in bytes.
+        """
+        self.root = directory
+        self.directory = os.path.join(directory, engine, fingerprint)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = Lock()
+        self._size = 0
+        for _, path in self._entries():
+            self._size += os.path.getsize(path)
+
+    def _path(self, schema: Schema) -> str:
+        return os.path.join(self.directory, f"{schema_hash(schema)}.bin")
+
+    def _entries(self) -> Iterator[Tuple[float, str]]:
+        for directory, _, files in os.walk(self.root):
+            for file in files:
+                if not file.endswith(".bin"):
+                    continue
+                path = os.path.join(directory, file)
+                try:
+                    yield os.path.getmtime(path), path
+                except OSError:
+                    # evicted by another process in the meantime
+                    continue
+
+    def get(self, schema: Schema) -> Optional[bytes]:
+        path = self._path(schema)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # the modification time orders the entries for eviction
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, schema: Schema, data: bytes) -> None:
+        path = self._path(schema)
+        # unique across the threads and processes writing the same grammar
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            try:
+                # the grammar replaces the one of another thread or run
+                self._size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+            self._size += len(data)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self) -> None:
+        # other runs may have added or evicted grammars since the last scan
+        entries = sorted(self._entries())
+        sizes = {}
+        for _, path in entries:
+            try:
+                sizes[path] = os.path.getsize(path)
+            except OSError:
+                sizes[path] = 0
+        self._size = sum(sizes.values())
+
+        for _, path in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= sizes[path]
+            self.evictions += 1
+
+    def info(self) -> GrammarCacheInfo:
+        with self._lock:
+            return GrammarCacheInfo(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                size=self._size,
+                max_size=self.max_size,
+            )
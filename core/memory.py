@@ -0,0 +1,61 @@
+import sys
+import resource
+from typing import Optional, Tuple
+
+# resetting the peak RSS is only supported by Linux
+CLEAR_REFS_PATH = "/proc/self/clear_refs"
+STATUS_PATH = "/proc/self/status"
+
+MB = 1024**2
+
+
+def _cuda() -> Optional[object]:
+    """Returns the `torch.cuda` module if torch is already imported by an engine
+    and a GPU is available, without importing torch for the other engines."""
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return torch.cuda
+
+
+def reset_peak_memory() -> None:
+    """Resets the peak RSS of the process, where supported, and the peak of the
+    torch CUDA allocator, so that the next call to `peak_memory` only covers
+    what happened in between."""
+    try:
+        with open(CLEAR_REFS_PATH, "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+    cuda = _cuda()
+    if cuda is not None:
+        cuda.reset_peak_memory_stats()
+
+
+def _peak_rss() -> float:
+    try:
+        with open(STATUS_PATH, "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024 / MB
+    except OSError:
+        pass
+
+    # the peak over the lifetime of the process, in kB on Linux and B on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / MB if sys.platform == "darwin" else max_rss * 1024 / MB
+
+
+def peak_memory() -> Tuple[float, Optional[float]]:
+    """Returns the peak RSS of the process and the peak memory allocated by the
+    torch CUDA allocator since the last call to `reset_peak_memory`, in MB. The
+    peaks are those of the whole process, so they include the generations that
+    run concurrently. Where the peak RSS cannot be reset, it is the peak over the
+    lifetime of the process.
+
+    :return: Tuple[float, Optional[float]]
+        The peak RSS and the peak GPU memory, None without torch or a GPU.
+    """
+    cuda = _cuda()
+    return _peak_rss(), cuda.max_memory_allocated() / MB if cuda is not None else None
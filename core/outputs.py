@@ -0,0 +1,171 @@
+import os
+from enum import Enum
+from threading import Lock
+from json import dumps, loads
+from dataclasses import asdict
+from dacite import from_dict, Config
+from typing import Any, Dict, Iterator, Optional, Sequence, Set
+
+from core.types import GenerationOutput
+
+DACITE_CONFIG = Config(check_types=False)
+
+# fields of `GenerationOutput` needed to compute the metrics
+METRIC_FIELDS = (
+    "task",
+    "generation",
+    "schema",
+    "sample_index",
+    "token_usage",
+    "perf_metrics",
+    "metadata",
+)
+
+
+class FlushPolicy(str, Enum):
+    # let the file buffer decide when to write
+    NONE = "none"
+    # flush the buffer after each output
+    FLUSH = "flush"
+    # flush the buffer and sync the file to disk after each output
+    FSYNC = "fsync"
+
+
+class OutputsWriter:
+    def __init__(
+        self,
+        path: str,
+        header: Dict[str, Any],
+        flush_policy: FlushPolicy = FlushPolicy.FLUSH,
+        resume: bool = False,
+    ):
+        """Appends generation outputs to a JSONL file as they are generated, so
+        that a crash during the benchmark does not lose the completed outputs.
+        The first line of the file is a header describing the engine.
+
+        :param path: str
+            The path of the JSONL file.
+        :param header: Dict[str, Any]
+            The header written on the first line of the file.
+        :param flush_policy: FlushPolicy
+            When the written outputs are pushed to disk.
+        :param resume: bool
+            Whether to append to an existing file instead of overwriting it. A
+            partially written last line is discarded.
+        """
+        self.path = path
+        self.flush_policy = flush_policy
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if resume and os.path.exists(path):
+            truncate_partial_line(path)
+        resume = resume and os.path.exists(path) and os.path.getsize(path) > 0
+
+        self._lock = Lock()
+        self._file = open(path, "a" if resume else "w")
+        if not resume:
+            self._write_line(dumps(header))
+
+    def _write_line(self, line: str) -> None:
+        with self._lock:
+            self._file.write(f"{line}\n")
+            if self.flush_policy != FlushPolicy.NONE:
+                self._file.flush()
+            if self.flush_policy == FlushPolicy.FSYNC:
+                os.fsync(self._file.fileno())
+
+    def write(self, output: GenerationOutput) -> None:
+        self._write_line(dumps(asdict(output)))
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self) -> "OutputsWriter":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+
+def truncate_partial_line(path: str, block_size: int = 4096) -> None:
+    """Removes the last line of a file if it is not terminated by a newline,
+    which happens when the process is killed while writing it."""
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                # the last byte is a newline: the file is complete
+                if start + newline + 1 == end:
+                    return
+                f.truncate(start + newline + 1)
+                return
+            position = start
+        f.truncate(0)
+
+
+def read_header(path: str) -> Dict[str, Any]:
+    with open(path, "r") as f:
+        return loads(f.readline())
+
+
+def iter_outputs(
+    path: str, fields: Optional[Sequence[str]] = None
+) -> Iterator[GenerationOutput]:
+    """Streams the outputs of an outputs file line by line. Lines that cannot be
+    parsed, such as a partially written last line, are skipped.
+
+    :param path: str
+        The path of the JSONL file.
+    :param fields: Optional[Sequence[str]]
+        The fields of `GenerationOutput` to load, e.g. `METRIC_FIELDS`. The
+        other fields keep their default value, and the messages are empty. All
+        the fields are loaded if None.
+    :return: Iterator[GenerationOutput]
+        The outputs, in the order of the file.
+    """
+    with open(path, "r") as f:
+        f.readline()
+        for line in f:
+            try:
+                data = loads(line)
+            except ValueError:
+                continue
+            if fields is not None:
+                data = {"messages": [], **{k: data[k] for k in fields if k in data}}
+            yield from_dict(GenerationOutput, data, config=DACITE_CONFIG)
+
+
+def completed_sample_indices(path: str) -> Dict[str, Set[int]]:
+    """Streams the indices of the samples of each task of an outputs file,
+    without keeping the outputs in memory. Lines that cannot be parsed are
+    skipped, as in `iter_outputs`.
+
+    :param path: str
+        The path of the JSONL file.
+    :return: Dict[str, Set[int]]
+        The indices of the samples whose output is in the file, by task.
+    """
+    indices: Dict[str, Set[int]] = {}
+    with open(path, "r") as f:
+        f.readline()
+        for line in f:
+            try:
+                data = loads(line)
+            except ValueError:
+                continue
+            if data.get("sample_index") is None:
+                raise ValueError(
+                    f"Cannot resume from {path}: its outputs have no sample index"
+                )
+            indices.setdefault(data["task"], set()).add(data["sample_index"])
+    return indices
+
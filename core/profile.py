@@ -1,14 +1,127 @@
-from time import time
 from functools import wraps
-from typing import Callable, Dict, Any, TYPE_CHECKING, List
+from time import perf_counter_ns
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional
+from typing import Sequence, Tuple, TYPE_CHECKING
 
 from core.messages import Message
+from core.utils import pack_float32, safe_divide, safe_subtract
 from core.types import PerfMetrics
+from core.memory import peak_memory, reset_peak_memory
 
 if TYPE_CHECKING:
     from core.engine import Engine, GenerationOutput
 
 
+def timestamp() -> float:
+    """Returns a monotonic timestamp in s with nanosecond resolution. Unlike
+    `time.time`, it is not affected by clock adjustments, and is only meaningful
+    relative to other timestamps of the same process."""
+    return perf_counter_ns() / 1e9
+
+
+@contextmanager
+def measure_phase(phase: str, *outputs: "GenerationOutput") -> Iterator[None]:
+    """Adds the time spent in the block to a phase of `GenerationPhases` of the
+    outputs. A phase measured several times is accumulated, and the outputs of a
+    batch share the time of the phases run for the whole batch."""
+    start_time = timestamp()
+    try:
+        yield
+    finally:
+        duration = timestamp() - start_time
+        for output in outputs:
+            previous = getattr(output.metadata.phases, phase)
+            setattr(output.metadata.phases, phase, (previous or 0.0) + duration)
+
+
+def record_token_timestamps(
+    output: "GenerationOutput",
+    timestamps: Sequence[float],
+    mask_end_timestamps: Optional[Sequence[float]] = None,
+) -> None:
+    """Stores the intervals between the arrival of consecutive tokens of an
+    output. If the engine also records when the grammar mask of each token is
+    applied, the time spent computing each mask is stored as well.
+
+    :param output: GenerationOutput
+        The output the tokens belong to.
+    :param timestamps: Sequence[float]
+        The arrival time of each token.
+    :param mask_end_timestamps: Optional[Sequence[float]]
+        When the mask of each token was applied, relative to `timestamps`.
+    """
+    if len(timestamps) > 1:
+        output.metadata.token_intervals = pack_float32(
+            [(b - a) * 1000 for a, b in zip(timestamps, timestamps[1:])]
+        )
+    if mask_end_timestamps:
+        output.metadata.mask_times = pack_float32(
+            [(b - a) * 1000 for a, b in zip(timestamps, mask_end_timestamps)]
+        )
+
+
+def _complete_phases(output: "GenerationOutput", end_time: float) -> None:
+    """Derives the phases that are delimited by the timestamps of the output."""
+    metadata = output.metadata
+    phases = metadata.phases
+
+    # the GCT runs from the start of the generation, so it only stands for the
+    # compilation when no other phase was measured in the meantime
+    if (
+        phases.compilation is None
+        and output.perf_metrics.gct is not None
+        and phases.prompt_formatting is None
+        and phases.tokenization is None
+    ):
+        phases.compilation = output.perf_metrics.gct - (phases.safety_check or 0.0)
+
+    phases.prefill = safe_subtract(
+        metadata.first_token_arrival_time, metadata.decoding_start_time
+    )
+
+    decoding_end_time = metadata.last_token_arrival_time
+    if decoding_end_time is None:
+        decoding_end_time = end_time - (phases.post_processing or 0.0)
+    phases.decoding = safe_subtract(
+        decoding_end_time, metadata.first_token_arrival_time
+    )
+
+
+def _exclude_compile_wait(output: "GenerationOutput") -> None:
+    """Leaves the time spent waiting for a compile worker out of the GCT."""
+    wait_time = output.metadata.compile_wait_time
+    if wait_time is not None and output.perf_metrics.gct is not None:
+        output.perf_metrics.gct -= wait_time
+
+
+def _set_perf_metrics(
+    output: "GenerationOutput", gen_start_time: float, gen_end_time: float
+) -> None:
+    peak_rss, peak_gpu_memory = peak_memory()
+
+    # a retried request is measured from its last attempt, the failed attempts
+    # and the waits between them are left out
+    start_time = output.metadata.attempt_start_time
+    if start_time is None:
+        start_time = gen_start_time
+
+    perf_metrics: PerfMetrics = PerfMetrics.from_timestamps(
+        start_time=start_time,
+        grammar_compilation_end_time=output.metadata.grammar_compilation_end_time,
+        first_token_arrival_time=output.metadata.first_token_arrival_time,
+        end_time=gen_end_time,
+        num_output_tokens=output.token_usage.output_tokens,
+    )
+    perf_metrics.peak_memory = peak_rss
+    perf_metrics.peak_gpu_memory = peak_gpu_memory
+    perf_metrics.grammar_memory = safe_divide(output.metadata.grammar_size, 1024)
+
+    output.perf_metrics = perf_metrics
+    _exclude_compile_wait(output)
+    _complete_phases(output, gen_end_time)
+
+
 def profile_generation(
     generate: Callable[
         ["Engine", str, List[Message], Dict[str, Any]], "GenerationOutput"
@@ -18,19 +131,106 @@ def profile_generation(
     def wrapper(
         engine: "Engine", task: str, messages: List[Message], schema: Dict[str, Any]
     ) -> "GenerationOutput":
-        gen_start_time: float = time()
+        reset_peak_memory()
+        gen_start_time: float = timestamp()
         output: "GenerationOutput" = generate(engine, task, messages, schema)
-        gen_end_time: float = time()
-
-        perf_metrics: PerfMetrics = PerfMetrics.from_timestamps(
-            start_time=gen_start_time,
-            grammar_compilation_end_time=output.metadata.grammar_compilation_end_time,
-            first_token_arrival_time=output.metadata.first_token_arrival_time,
-            end_time=gen_end_time,
-            num_output_tokens=output.token_usage.output_tokens,
-        )
+        gen_end_time: float = timestamp()
 
-        output.perf_metrics = perf_metrics
+        _set_perf_metrics(output, gen_start_time, gen_end_time)
+        return output
+
+    return wrapper
+
+
+def profile_async_generation(
+    agenerate: Callable[
+        ["Engine", str, List[Message], Dict[str, Any]],
+        Awaitable["GenerationOutput"],
+    ],
+) -> Callable[
+    ["Engine", str, List[Message], Dict[str, Any]], Awaitable["GenerationOutput"]
+]:
+    """Same as `profile_generation` for coroutines. The generations awaited
+    concurrently on an event loop share the process, so their peak memory
+    covers all of them."""
+
+    @wraps(agenerate)
+    async def wrapper(
+        engine: "Engine", task: str, messages: List[Message], schema: Dict[str, Any]
+    ) -> "GenerationOutput":
+        reset_peak_memory()
+        gen_start_time: float = timestamp()
+        output: "GenerationOutput" = await agenerate(engine, task, messages, schema)
+        gen_end_time: float = timestamp()
+
+        _set_perf_metrics(output, gen_start_time, gen_end_time)
+        return output
+
+    return wrapper
+
+
+def profile_batch_generation(
+    generate_batch: Callable[
+        ["Engine", str, List[Tuple[List[Message], Dict[str, Any]]]],
+        List["GenerationOutput"],
+    ],
+) -> Callable[
+    ["Engine", str, List[Tuple[List[Message], Dict[str, Any]]]],
+    List["GenerationOutput"],
+]:
+    @wraps(generate_batch)
+    def wrapper(
+        engine: "Engine",
+        task: str,
+        samples: List[Tuple[List[Message], Dict[str, Any]]],
+    ) -> List["GenerationOutput"]:
+        reset_peak_memory()
+        gen_start_time: float = timestamp()
+        outputs: List["GenerationOutput"] = generate_batch(engine, task, samples)
+        gen_end_time: float = timestamp()
+        peak_rss, peak_gpu_memory = peak_memory()
+
+        # every sequence of the batch starts with the batch, but ends with its
+        # own last token
+        for output in outputs:
+            output.perf_metrics = PerfMetrics.from_timestamps(
+                start_time=gen_start_time,
+                grammar_compilation_start_time=output.metadata.grammar_compilation_start_time,
+                grammar_compilation_end_time=output.metadata.grammar_compilation_end_time,
+                first_token_arrival_time=output.metadata.first_token_arrival_time,
+                end_time=output.metadata.last_token_arrival_time or gen_end_time,
+                num_output_tokens=output.token_usage.output_tokens,
+            )
+            # the peaks are those of the whole batch
+            output.perf_metrics.peak_memory = peak_rss
+            output.perf_metrics.peak_gpu_memory = peak_gpu_memory
+            output.perf_metrics.grammar_memory = safe_divide(
+                output.metadata.grammar_size, 1024
+            )
+            _exclude_compile_wait(output)
+            _complete_phases(output, gen_end_time)
+
+        return outputs
+
+    return wrapper
+
+
+def profile_compilation(
+    compile: Callable[["Engine", str, Dict[str, Any]], "GenerationOutput"],
+) -> Callable[["Engine", str, Dict[str, Any]], "GenerationOutput"]:
+    @wraps(compile)
+    def wrapper(
+        engine: "Engine", task: str, schema: Dict[str, Any]
+    ) -> "GenerationOutput":
+        compile_start_time: float = timestamp()
+        output: "GenerationOutput" = compile(engine, task, schema)
+
+        output.perf_metrics = PerfMetrics(
+            gct=safe_subtract(
+                output.metadata.grammar_compilation_end_time, compile_start_time
+            ),
+            grammar_memory=safe_divide(output.metadata.grammar_size, 1024),
+        )
         return output
 
     return wrapper
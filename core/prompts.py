@@ -0,0 +1,100 @@
+from threading import Lock
+from dataclasses import dataclass
+from collections import OrderedDict
+from typing import Callable, List, Tuple
+
+from core.messages import Message
+from core.utils import schema_hash
+
+PROMPT_CACHE_SIZE = 4096
+
+
+@dataclass
+class PreparedPrompt:
+    """A prompt rendered with the chat template of a model and tokenized."""
+
+    text: str
+    token_ids: List[int]
+
+
+@dataclass
+class PromptCacheInfo:
+    hits: int = 0
+    misses: int = 0
+    size: int = 0
+    max_size: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"prompt cache: {self.hits:,} hits, {self.misses:,} misses, "
+            f"{self.size:,}/{self.max_size:,} entries."
+        )
+
+
+class PromptCache:
+    def __init__(self, max_size: int = PROMPT_CACHE_SIZE):
+        """Bounded LRU cache of prepared prompts keyed by the chat template and
+        tokenizer that prepared them and by the canonical hash of the messages.
+        Engines that share a tokenizer and a chat template, e.g. two engines
+        running the same Hugging Face model, share their prompts.
+
+        :param max_size: int
+            The maximum number of prompts kept in the cache.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = Lock()
+        self._prompts: OrderedDict[Tuple[str, str], PreparedPrompt] = OrderedDict()
+
+    def get(
+        self,
+        tokenizer_key: str,
+        messages: List[Message],
+        prepare: Callable[[], PreparedPrompt],
+    ) -> Tuple[PreparedPrompt, bool]:
+        """Returns the prompt of the messages, prepared with `prepare` if it is
+        not in the cache yet.
+
+        :param tokenizer_key: str
+            Identifies the chat template and the tokenizer of the engine.
+        :param messages: List[Message]
+            The messages of the prompt.
+        :param prepare: Callable[[], PreparedPrompt]
+            Renders and tokenizes the prompt of the messages.
+        :return: Tuple[PreparedPrompt, bool]
+            The prompt, and whether it was in the cache.
+        """
+        key = (tokenizer_key, schema_hash(messages))
+        with self._lock:
+            if key in self._prompts:
+                self.hits += 1
+                self._prompts.move_to_end(key)
+                return self._prompts[key], True
+            self.misses += 1
+
+        prompt = prepare()
+
+        with self._lock:
+            self._prompts[key] = prompt
+            if len(self._prompts) > self.max_size:
+                self._prompts.popitem(last=False)
+        return prompt, False
+
+    def info(self) -> PromptCacheInfo:
+        return PromptCacheInfo(
+            hits=self.hits,
+            misses=self.misses,
+            size=len(self._prompts),
+            max_size=self.max_size,
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._prompts.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+prompt_cache = PromptCache()
@@ -0,0 +1,161 @@
+import random
+import asyncio
+from time import sleep
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Mapping, Optional, TypeVar
+
+from core.profile import measure_phase, timestamp
+from core.scheduler import RateLimiter
+from core.types import GenerationOutput
+
+R = TypeVar("R")
+
+
+@dataclass
+class RetryConfig:
+    # number of retries of a request after its first attempt, 0 to never retry
+    max_retries: int = 6
+    # in s, the n-th retry waits a random time between 0 and
+    # `min(max_backoff, initial_backoff * 2 ** n)`
+    initial_backoff: float = 1.0
+    max_backoff: float = 60.0
+
+
+class TransientError(Exception):
+    def __init__(self, error: Exception, retry_after: Optional[float] = None):
+        """Wraps an error that may not happen again if the request is retried,
+        e.g. a rate limit, an overloaded server or a dropped connection.
+
+        :param error: Exception
+            The error of the request.
+        :param retry_after: Optional[float]
+            How long the server asked to wait before retrying, in s.
+        """
+        super().__init__(str(error))
+        self.error = error
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Reads how long to wait before retrying, in s, from the `retry-after-ms`
+    or the `retry-after` header of a response. The latter is either a number of
+    seconds or an HTTP date."""
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return max(float(retry_after_ms) / 1000, 0.0)
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(retry_after)
+        return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryGovernor:
+    def __init__(self, config: RetryConfig):
+        """Retries the requests that fail with a `TransientError`, after an
+        exponential backoff with full jitter so that the requests that failed
+        together do not retry together. A `retry-after` of the server is a
+        limit of the whole account, so it also holds back the other requests
+        admitted by the rate limiter, and each retry is admitted by the rate
+        limiter like a new request. The time spent waiting is measured as the
+        `backoff` phase of the output, and the start of each retry is recorded
+        so that the latency metrics only cover the last attempt.
+
+        :param config: RetryConfig
+            The number of retries and the bounds of the backoff.
+        """
+        self.config = config
+
+    def _wait_time(
+        self,
+        retry: int,
+        error: TransientError,
+        rate_limiter: Optional[RateLimiter],
+    ) -> float:
+        wait_time = random.uniform(
+            0, min(self.config.max_backoff, self.config.initial_backoff * 2**retry)
+        )
+        if error.retry_after is not None:
+            wait_time = max(wait_time, error.retry_after)
+            if rate_limiter is not None:
+                rate_limiter.defer(error.retry_after)
+        return wait_time
+
+    def call(
+        self,
+        attempt: Callable[[], R],
+        output: GenerationOutput,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> R:
+        """Calls `attempt` until it does not raise a `TransientError`, or until
+        the retries are exhausted, in which case the last error is raised.
+
+        :param attempt: Callable[[], R]
+            Sends the request, raises a `TransientError` if it may be retried.
+        :param output: GenerationOutput
+            The output of the request, whose retries are counted.
+        :param rate_limiter: Optional[RateLimiter]
+            The rate limiter the request was admitted by, if any.
+        :return: R
+            The result of the first successful attempt.
+        """
+        retry = 0
+        while True:
+            try:
+                return attempt()
+            except TransientError as e:
+                if retry >= self.config.max_retries:
+                    raise
+                with measure_phase("backoff", output):
+                    sleep(self._wait_time(retry, e, rate_limiter))
+                    if rate_limiter is not None:
+                        rate_limiter.acquire()
+                retry += 1
+                output.metadata.retries = retry
+                output.metadata.attempt_start_time = timestamp()
+
+    async def acall(
+        self,
+        attempt: Callable[[], Awaitable[R]],
+        output: GenerationOutput,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> R:
+        """Coroutine version of `call`, which waits without blocking the event
+        loop.
+
+        :param attempt: Callable[[], Awaitable[R]]
+            Sends the request, raises a `TransientError` if it may be retried.
+        :param output: GenerationOutput
+            The output of the request, whose retries are counted.
+        :param rate_limiter: Optional[RateLimiter]
+            The rate limiter the request was admitted by, if any.
+        :return: R
+            The result of the first successful attempt.
+        """
+        retry = 0
+        while True:
+            try:
+                return await attempt()
+            except TransientError as e:
+                if retry >= self.config.max_retries:
+                    raise
+                with measure_phase("backoff", output):
+                    await asyncio.sleep(self._wait_time(retry, e, rate_limiter))
+                    if rate_limiter is not None:
+                        await rate_limiter.aacquire()
+                retry += 1
+                output.metadata.retries = retry
+                output.metadata.attempt_start_time = timestamp()
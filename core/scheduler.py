@@ -0,0 +1,290 @@
+import asyncio
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from dataclasses import dataclass
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Deque, Iterable, Iterator
+from typing import Optional, TypeVar
+
+from core.types import GenerationOutput
+
+S = TypeVar("S")
+
+# number of samples submitted ahead per request in flight
+SUBMISSION_WINDOW = 4
+
+
+@dataclass
+class SchedulerConfig:
+    max_in_flight: int = 1
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return (
+            self.max_in_flight > 1
+            or self.requests_per_minute is not None
+            or self.tokens_per_minute is not None
+        )
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+    ):
+        """Token bucket that limits the number of requests and tokens per minute.
+        Requests are admitted one at a time with `acquire`, while tokens are
+        debited after the fact with `consume` since the usage of a request is
+        only known once it completes. `defer` holds back all requests, e.g. when
+        the server asks to retry later.
+
+        :param requests_per_minute: Optional[int]
+            The maximum number of requests per minute, unlimited if None.
+        :param tokens_per_minute: Optional[int]
+            The maximum number of tokens per minute, unlimited if None.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+        self._lock = Lock()
+        self._last_refill = monotonic()
+        self._request_allowance = float(requests_per_minute or 0)
+        self._token_allowance = float(tokens_per_minute or 0)
+        # no request is admitted before this time, see `defer`
+        self._resume_time = 0.0
+
+    def _refill(self) -> None:
+        now = monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+
+        if self.requests_per_minute is not None:
+            self._request_allowance = min(
+                self.requests_per_minute,
+                self._request_allowance + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute is not None:
+            self._token_allowance = min(
+                self.tokens_per_minute,
+                self._token_allowance + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _wait_time(self) -> float:
+        wait_time = max(self._resume_time - self._last_refill, 0.0)
+        if self.requests_per_minute is not None and self._request_allowance < 1:
+            wait_time = max(
+                wait_time,
+                (1 - self._request_allowance) * 60 / self.requests_per_minute,
+            )
+        if self.tokens_per_minute is not None and self._token_allowance < 0:
+            wait_time = max(
+                wait_time, -self._token_allowance * 60 / self.tokens_per_minute
+            )
+        return wait_time
+
+    def _try_acquire(self) -> float:
+        """Admits a request if the budget allows it, otherwise returns how long
+        to wait before trying again."""
+        with self._lock:
+            self._refill()
+            wait_time = self._wait_time()
+            if wait_time == 0 and self.requests_per_minute is not None:
+                self._request_allowance -= 1
+            return wait_time
+
+    def acquire(self) -> None:
+        """Blocks until a request can be sent within the budget."""
+        while (wait_time := self._try_acquire()) > 0:
+            sleep(wait_time)
+
+    async def aacquire(self) -> None:
+        """Waits until a request can be sent within the budget, without blocking
+        the event loop."""
+        while (wait_time := self._try_acquire()) > 0:
+            await asyncio.sleep(wait_time)
+
+    def defer(self, seconds: float) -> None:
+        """Admits no request for the next `seconds`, on top of the budget."""
+        with self._lock:
+            self._resume_time = max(self._resume_time, monotonic() + seconds)
+
+    def consume(self, tokens: int) -> None:
+        """Debits the tokens used by a completed request from the budget."""
+        if self.tokens_per_minute is None:
+            return
+        with self._lock:
+            self._refill()
+            self._token_allowance -= tokens
+
+
+class Scheduler:
+    def __init__(self, config: SchedulerConfig):
+        """Runs generations concurrently with a bounded number of in-flight
+        requests and a requests/tokens per minute budget. This is meant for
+        engines that spend most of their time waiting on the network.
+
+        :param config: SchedulerConfig
+            The configuration for the scheduler.
+        """
+        self.config = config
+        self.rate_limiter = RateLimiter(
+            config.requests_per_minute, config.tokens_per_minute
+        )
+
+        # started by the first call to `map_async`
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[Thread] = None
+
+    def map(
+        self,
+        generate: Callable[[S], GenerationOutput],
+        samples: Iterable[S],
+    ) -> Iterator[GenerationOutput]:
+        """Generates the outputs for all samples.
+
+        The rate limiter is acquired before calling `generate` so that the time
+        spent waiting for the budget is not attributed to the generation. At most
+        `SUBMISSION_WINDOW` times `max_in_flight` samples are submitted ahead of
+        the output being consumed, so that completed outputs are not held in
+        memory until the end.
+
+        :param generate: Callable[[S], GenerationOutput]
+            The function generating the output of a sample.
+        :param samples: Iterable[S]
+            The samples to generate the outputs for.
+        :return: Iterator[GenerationOutput]
+            The outputs, in the same order as the samples.
+        """
+
+        def run(sample: S) -> GenerationOutput:
+            self.rate_limiter.acquire()
+            output = generate(sample)
+            self.rate_limiter.consume(
+                output.token_usage.input_tokens + output.token_usage.output_tokens
+            )
+            return output
+
+        window = SUBMISSION_WINDOW * self.config.max_in_flight
+        with ThreadPoolExecutor(max_workers=self.config.max_in_flight) as executor:
+            futures: Deque[Future] = deque()
+            for sample in samples:
+                futures.append(executor.submit(run, sample))
+                if len(futures) >= window:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    async def amap(
+        self,
+        agenerate: Callable[[S], Awaitable[GenerationOutput]],
+        samples: Iterable[S],
+    ) -> AsyncIterator[GenerationOutput]:
+        """Coroutine version of `map`, where the generations in flight are
+        coroutines of a single event loop rather than threads.
+
+        :param agenerate: Callable[[S], Awaitable[GenerationOutput]]
+            The coroutine function generating the output of a sample.
+        :param samples: Iterable[S]
+            The samples to generate the outputs for.
+        :return: AsyncIterator[GenerationOutput]
+            The outputs, in the same order as the samples.
+        """
+        in_flight = asyncio.Semaphore(self.config.max_in_flight)
+
+        async def run(sample: S) -> GenerationOutput:
+            async with in_flight:
+                await self.rate_limiter.aacquire()
+                output = await agenerate(sample)
+            self.rate_limiter.consume(
+                output.token_usage.input_tokens + output.token_usage.output_tokens
+            )
+            return output
+
+        window = SUBMISSION_WINDOW * self.config.max_in_flight
+        tasks: Deque[asyncio.Task] = deque()
+        try:
+            for sample in samples:
+                tasks.append(asyncio.ensure_future(run(sample)))
+                if len(tasks) >= window:
+                    yield await tasks.popleft()
+            while tasks:
+                yield await tasks.popleft()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def map_async(
+        self,
+        agenerate: Callable[[S], Awaitable[GenerationOutput]],
+        samples: Iterable[S],
+    ) -> Iterator[GenerationOutput]:
+        """Runs `amap` on the event loop of the scheduler, in a background
+        thread, and yields its outputs. The outputs are consumed (e.g. evaluated
+        and saved) in the calling thread, so that the loop keeps receiving the
+        responses of the generations in flight meanwhile. Engines without
+        `agenerate` generate in the default executor of the loop, which has one
+        thread per generation in flight.
+
+        :param agenerate: Callable[[S], Awaitable[GenerationOutput]]
+            The coroutine function generating the output of a sample.
+        :param samples: Iterable[S]
+            The samples to generate the outputs for.
+        :return: Iterator[GenerationOutput]
+            The outputs, in the same order as the samples.
+        """
+        loop = self._event_loop()
+        results: Queue = Queue()
+        # outputs waiting to be consumed, beyond which the loop stops submitting
+        # samples
+        pending = asyncio.Semaphore(SUBMISSION_WINDOW * self.config.max_in_flight)
+
+        async def produce() -> None:
+            try:
+                async for output in self.amap(agenerate, samples):
+                    await pending.acquire()
+                    results.put((output, None))
+            except Exception as e:
+                results.put((None, e))
+                return
+            results.put((None, None))
+
+        future = asyncio.run_coroutine_threadsafe(produce(), loop)
+        try:
+            while True:
+                output, error = results.get()
+                if error is not None:
+                    raise error
+                if output is None:
+                    return
+                loop.call_soon_threadsafe(pending.release)
+                yield output
+        finally:
+            future.cancel()
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.set_default_executor(
+                ThreadPoolExecutor(max_workers=self.config.max_in_flight)
+            )
+            self._loop_thread = Thread(target=self._loop.run_forever, daemon=True)
+            self._loop_thread.start()
+        return self._loop
+
+    def close(self) -> None:
+        """Stops the event loop of the scheduler, if it was started."""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._loop.shutdown_default_executor(), self._loop
+        ).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        self._loop = None
+        self._loop_thread = None
@@ -1,3 +1,4 @@
+import numpy as np
 from enum import Enum
 from uuid import uuid4
 from dataclasses import dataclass, field
@@ -67,10 +68,57 @@ class Token:
     logprob: Optional[float] = None
 
 
+@dataclass
+class GenerationPhases:
+    """Time spent in each phase of a generation, in s."""
+
+    # rendering the messages with the chat template
+    prompt_formatting: Optional[float] = None
+    tokenization: Optional[float] = None
+    # isolating the grammar compilation in a worker process, on top of it
+    safety_check: Optional[float] = None
+    compilation: Optional[float] = None
+    prefill: Optional[float] = None
+    # from the first to the last token
+    decoding: Optional[float] = None
+    # detokenization, extraction of the JSON object and token counting
+    post_processing: Optional[float] = None
+    # waiting to retry a request that failed with a transient error
+    backoff: Optional[float] = None
+
+
 @dataclass
 class GenerationMetadata:
     first_token_arrival_time: Optional[float] = None
     grammar_compilation_end_time: Optional[float] = None
+    # only set when the grammar compilation does not start with the generation,
+    # e.g. when the grammars of a batch are compiled one after the other
+    grammar_compilation_start_time: Optional[float] = None
+    # time spent waiting for a compile worker, e.g. one restarted after the
+    # previous compilation crashed, which is left out of the GCT
+    compile_wait_time: Optional[float] = None
+    # only set when the generation ends before the call, e.g. in a batch
+    last_token_arrival_time: Optional[float] = None
+    # only set when the engine uses the disk grammar cache
+    grammar_cache_hit: Optional[bool] = None
+    # memory footprint of the compiled grammar in bytes, set by the engine
+    grammar_size: Optional[int] = None
+    # number of prompt tokens whose prefill was reused from a previous prompt
+    cached_prompt_tokens: Optional[int] = None
+    # when the prompt is submitted to the model, after compilation and
+    # tokenization, used to separate the prefill from the other phases
+    decoding_start_time: Optional[float] = None
+    # number of times the request was retried after a transient error, only set
+    # by the engines that retry their requests
+    retries: Optional[int] = None
+    # when the last attempt of a retried request started, the latency metrics
+    # are measured from it, the waits before it are the `backoff` phase
+    attempt_start_time: Optional[float] = None
+    phases: GenerationPhases = field(default_factory=GenerationPhases)
+    # time between consecutive tokens and time spent computing the grammar mask
+    # of each token in ms, packed with `pack_float32`
+    token_intervals: Optional[str] = None
+    mask_times: Optional[str] = None
     compile_status: Optional[CompileStatus] = field(default_factory=CompileStatus)
     decoding_status: Optional[DecodingStatus] = field(default_factory=DecodingStatus)
 
@@ -89,8 +137,12 @@ class PerfMetrics:
     gct: Optional[float] = None
     # Prefilling time in s
     prft: Optional[float] = None
-    # Peak memory in MB
+    # Peak RSS of the process in MB
     peak_memory: Optional[float] = None
+    # Peak memory allocated by torch on the GPU in MB
+    peak_gpu_memory: Optional[float] = None
+    # Memory footprint of the compiled grammar in KB
+    grammar_memory: Optional[float] = None
 
     @classmethod
     def from_timestamps(
@@ -100,6 +152,7 @@ class PerfMetrics:
         first_token_arrival_time: Optional[float],
         end_time: float,
         num_output_tokens: int,
+        grammar_compilation_start_time: Optional[float] = None,
     ):
         ttft = safe_subtract(first_token_arrival_time, start_time)
         tpot = (
@@ -111,7 +164,14 @@ class PerfMetrics:
             else None
         )
         tgt = safe_subtract(end_time, start_time)
-        gct = safe_subtract(grammar_compilation_end_time, start_time)
+        gct = safe_subtract(
+            grammar_compilation_end_time,
+            (
+                grammar_compilation_start_time
+                if grammar_compilation_start_time is not None
+                else start_time
+            ),
+        )
         prft = safe_subtract(first_token_arrival_time, grammar_compilation_end_time)
         return cls(
             ttft=ttft,
@@ -131,6 +191,34 @@ class Metric:
     median: Optional[float] = None
 
 
+def optional_metric(values: List[float]) -> Metric:
+    """Summarizes values that are only recorded by some outputs, empty if none."""
+    if not values:
+        return Metric()
+    return Metric(
+        values=values,
+        median=np.median(values),
+        min=min(values),
+        max=max(values),
+        std=np.std(values),
+    )
+
+
+@dataclass
+class TokenLatencyStats:
+    """Distribution of the inter-token latency of a task, in ms."""
+
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    p99: Optional[float] = None
+    # fraction of the tokens that arrived `STALL_FACTOR` times later than the
+    # median token of their generation
+    stall_rate: Optional[float] = None
+    # only for engines that measure the grammar mask computation
+    mask_p50: Optional[float] = None
+    mask_p99: Optional[float] = None
+
+
 @dataclass
 class AggregatedPerfMetrics:
     ttft: Metric = field(default_factory=Metric)
@@ -138,6 +226,38 @@ class AggregatedPerfMetrics:
     tgt: Metric = field(default_factory=Metric)
     gct: Metric = field(default_factory=Metric)
     prft: Metric = field(default_factory=Metric)
+    # grammar compilation time of the cache misses and hits of the disk cache
+    cold_gct: Metric = field(default_factory=Metric)
+    warm_gct: Metric = field(default_factory=Metric)
+    # duration of each phase of `GenerationPhases` in ms
+    phases: Dict[str, Metric] = field(default_factory=dict)
+    itl: TokenLatencyStats = field(default_factory=TokenLatencyStats)
+    # see `PerfMetrics` for the units
+    peak_memory: Metric = field(default_factory=Metric)
+    peak_gpu_memory: Metric = field(default_factory=Metric)
+    grammar_memory: Metric = field(default_factory=Metric)
+    # number of prompt tokens whose prefill was reused, for the engines that
+    # report it
+    cached_prompt_tokens: Metric = field(default_factory=Metric)
+
+
+@dataclass
+class CompilationMetrics:
+    """Grammar compilation metrics of a task in compile-only mode."""
+
+    # fraction of the schemas whose grammar compiled
+    success_rate: Optional[float] = None
+    # number of schemas compiled per second of wall time
+    throughput: Optional[float] = None
+    # grammar compilation time of the compiled schemas in ms
+    gct: Metric = field(default_factory=Metric)
+    gct_p90: Optional[float] = None
+    gct_p99: Optional[float] = None
+    # grammar compilation time of the cache misses and hits of the disk cache
+    cold_gct: Metric = field(default_factory=Metric)
+    warm_gct: Metric = field(default_factory=Metric)
+    # number of schemas per compile status code
+    status_counts: Dict[str, int] = field(default_factory=dict)
 
 
 @dataclass
@@ -149,6 +269,8 @@ class GenerationOutput:
     generation: str
     schema: Schema
     id: str = field(default_factory=lambda: str(uuid4()))
+    # index of the schema in the dataset of the task
+    sample_index: Optional[int] = None
     generated_tokens: List[Token] = field(default_factory=list)
     token_usage: TokenUsage = field(default_factory=TokenUsage)
     perf_metrics: PerfMetrics = field(default_factory=PerfMetrics)
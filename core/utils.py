@@ -3,20 +3,30 @@ import sys
 import random
 import string
 import numpy as np
+from json import dumps
+from base64 import b64decode, b64encode
+from hashlib import sha256
 from dacite import from_dict
 from omegaconf import OmegaConf
 import matplotlib.pyplot as plt
 from prettytable import PrettyTable
 from contextlib import contextmanager
-from typing import List, Optional, TypeVar, Type, TYPE_CHECKING, Callable
-
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+from typing import Type, TypeVar, TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from core.types import Metric, AggregatedPerfMetrics
+    from core.complexity import ComplexityBin
+    from core.types import Metric, AggregatedPerfMetrics, CompilationMetrics
 
 GENERATION_TIMEOUT = 60
 COMPILATION_TIMEOUT = 10
 
+BOOTSTRAP_SAMPLES = 100
+# seed of the bootstrap resamples, so that the reported intervals are reproducible
+BOOTSTRAP_SEED = 0
+# maximum number of resampled values held in memory at once
+BOOTSTRAP_BLOCK_ELEMENTS = 10_000_000
+
 
 T = TypeVar("T")
 
@@ -39,6 +49,36 @@ def safe_subtract(a: Optional[float], b: Optional[float]) -> Optional[float]:
     return a - b
 
 
+def schema_hash(schema: Any) -> str:
+    """Hashes the canonical JSON form of a schema, independent of key order."""
+    return sha256(
+        dumps(schema, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def batched(iterable: Iterable[T], n: int) -> Iterator[List[T]]:
+    """Splits an iterable into lists of n items, the last one may be shorter."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def pack_float32(values: Sequence[float]) -> str:
+    """Packs values into a base64 string of little-endian float32, which takes
+    about four times less space than a JSON list of floats."""
+    return b64encode(np.asarray(values, dtype="<f4").tobytes()).decode("ascii")
+
+
+def unpack_float32(data: str) -> np.ndarray:
+    """Unpacks values packed with `pack_float32`."""
+    return np.frombuffer(b64decode(data), dtype="<f4")
+
+
 def safe_min(a: int, b: Optional[int]) -> int:
     if b is None:
         return a
@@ -58,6 +98,12 @@ def format_metric(metric: "Metric", details: bool = False) -> str:
     )
 
 
+def format_value(value: Optional[float], percentage: bool = False) -> str:
+    if value is None:
+        return "n/a"
+    return f"{value:.2%}" if percentage else f"{value:.2f}"
+
+
 @contextmanager
 def disable_print():
     stdout = sys.stdout
@@ -76,13 +122,41 @@ def nanoid(length: int = 4) -> str:
 
 
 def bootstrap(
-    data: List[float], func: Callable[[List[float]], float], n_samples: int = 100
+    data: List[float],
+    func: Callable[..., Any],
+    n_samples: int = BOOTSTRAP_SAMPLES,
+    seed: Optional[int] = BOOTSTRAP_SEED,
 ) -> List[float]:
+    """Computes the statistic `func` on `n_samples` resamples with replacement of
+    `data`. The resamples are drawn as an index matrix of shape
+    (n_samples, len(data)), in blocks of rows to bound the memory used.
+
+    :param data: List[float]
+        The data to resample.
+    :param func: Callable[..., Any]
+        The reducer, called with an `axis` argument when it supports it (e.g.
+        `np.mean`, `np.median`) and applied row by row otherwise.
+    :param n_samples: int
+        The number of bootstrap samples.
+    :param seed: Optional[int]
+        The seed of the random generator, unseeded if None.
+    :return: List[float]
+        The statistic of each bootstrap sample.
+    """
+    rng = np.random.default_rng(seed)
+    values = np.asarray(data, dtype=np.float64)
+    n = len(values)
+
+    block_size = max(1, BOOTSTRAP_BLOCK_ELEMENTS // max(n, 1))
     samples = []
-    for _ in range(n_samples):
-        sample = random.choices(data, k=len(data))
-        samples.append(func(sample))
-    return samples
+    for start in range(0, n_samples, block_size):
+        rows = min(block_size, n_samples - start)
+        resamples = values[rng.integers(0, max(n, 1), size=(rows, n))]
+        try:
+            samples.append(np.asarray(func(resamples, axis=1), dtype=np.float64))
+        except TypeError:
+            samples.append(np.apply_along_axis(func, 1, resamples))
+    return np.concatenate(samples).tolist()
 
 
 def print_scores(
@@ -106,6 +180,14 @@ def print_scores(
         "Output tokens",
     ]
 
+    # only reported when the disk grammar cache was used
+    has_grammar_cache = any(
+        pm.cold_gct.values or pm.warm_gct.values for pm in perf_metrics
+    )
+    if has_grammar_cache:
+        columns.insert(columns.index("GCT (s)") + 1, "Cold GCT (s)")
+        columns.insert(columns.index("Cold GCT (s)") + 1, "Warm GCT (s)")
+
     table = PrettyTable(columns)
     for task, dc, ec, cl, pm, ot in zip(
         tasks,
@@ -126,10 +208,195 @@ def print_scores(
             format_metric(pm.gct, details),
             format_metric(ot, details),
         ]
+        if has_grammar_cache:
+            row.insert(-1, format_metric(pm.cold_gct, details))
+            row.insert(-1, format_metric(pm.warm_gct, details))
+
+        table.add_row(row, divider=details)
+    print(table)
+
+    # where the latency goes, for the phases measured by the engine
+    phases = [
+        phase
+        for phase in (perf_metrics[0].phases if perf_metrics else {})
+        if any(pm.phases[phase].values for pm in perf_metrics)
+    ]
+    # the prefill is shorter when the prompt prefix was already evaluated
+    has_cached_prompt_tokens = any(
+        pm.cached_prompt_tokens.values for pm in perf_metrics
+    )
+    if phases:
+        columns = ["Task"] + [
+            f"{phase.replace('_', ' ').capitalize()} (ms)" for phase in phases
+        ]
+        if has_cached_prompt_tokens:
+            columns.insert(
+                phases.index("prefill") + 2 if "prefill" in phases else len(columns),
+                "Cached prompt tokens",
+            )
+        phase_table = PrettyTable(columns)
+        for task, pm in zip(tasks, perf_metrics):
+            row = [task] + [
+                format_metric(pm.phases[phase], details) for phase in phases
+            ]
+            if has_cached_prompt_tokens:
+                row.insert(
+                    columns.index("Cached prompt tokens"),
+                    format_metric(pm.cached_prompt_tokens, details),
+                )
+            phase_table.add_row(row, divider=details)
+        print(phase_table)
+
+    # tail latency of the decoding, for the engines that record every token
+    if any(pm.itl.p50 is not None for pm in perf_metrics):
+        itl_table = PrettyTable(
+            [
+                "Task",
+                "ITL p50 (ms)",
+                "ITL p90 (ms)",
+                "ITL p99 (ms)",
+                "Stalled tokens",
+                "Mask p50 (ms)",
+                "Mask p99 (ms)",
+            ]
+        )
+        for task, pm in zip(tasks, perf_metrics):
+            itl_table.add_row(
+                [
+                    task,
+                    format_value(pm.itl.p50),
+                    format_value(pm.itl.p90),
+                    format_value(pm.itl.p99),
+                    format_value(pm.itl.stall_rate, percentage=True),
+                    format_value(pm.itl.mask_p50),
+                    format_value(pm.itl.mask_p99),
+                ]
+            )
+        print(itl_table)
+
+    # memory footprint, the median and the max over the generations of a task
+    memory_metrics = [
+        (name, label, unit)
+        for name, label, unit in [
+            ("peak_memory", "Peak RSS", "MB"),
+            ("peak_gpu_memory", "Peak GPU", "MB"),
+            ("grammar_memory", "Grammar", "KB"),
+        ]
+        if any(getattr(pm, name).values for pm in perf_metrics)
+    ]
+    if memory_metrics:
+        memory_table = PrettyTable(
+            ["Task"]
+            + [
+                f"{label} {stat} ({unit})"
+                for _, label, unit in memory_metrics
+                for stat in ["median", "max"]
+            ]
+        )
+        for task, pm in zip(tasks, perf_metrics):
+            row = [task]
+            for name, _, _ in memory_metrics:
+                metric = getattr(pm, name)
+                row += [format_value(metric.median), format_value(metric.max)]
+            memory_table.add_row(row)
+        print(memory_table)
+
+
+def print_compilation_scores(
+    compilation_metrics: List["CompilationMetrics"],
+    tasks: List[str],
+    details: bool = False,
+) -> None:
+    columns = [
+        "Task",
+        "Compiled",
+        "GCT (ms)",
+        "GCT p90 (ms)",
+        "GCT p99 (ms)",
+        "Schemas/s",
+    ]
+
+    # only reported when the disk grammar cache was used
+    has_grammar_cache = any(
+        cm.cold_gct.values or cm.warm_gct.values for cm in compilation_metrics
+    )
+    if has_grammar_cache:
+        columns += ["Cold GCT (ms)", "Warm GCT (ms)"]
 
+    table = PrettyTable(columns)
+    for task, cm in zip(tasks, compilation_metrics):
+        row = [
+            task,
+            format_value(cm.success_rate, percentage=True),
+            format_metric(cm.gct, details),
+            format_value(cm.gct_p90),
+            format_value(cm.gct_p99),
+            format_value(cm.throughput),
+        ]
+        if has_grammar_cache:
+            row += [
+                format_metric(cm.cold_gct, details),
+                format_metric(cm.warm_gct, details),
+            ]
         table.add_row(row, divider=details)
     print(table)
 
+    # why the other schemas did not compile
+    codes = sorted(
+        {code for cm in compilation_metrics for code in cm.status_counts} - {"OK"}
+    )
+    if codes:
+        status_table = PrettyTable(["Task"] + codes)
+        for task, cm in zip(tasks, compilation_metrics):
+            status_table.add_row(
+                [task] + [f"{cm.status_counts.get(code, 0):,}" for code in codes]
+            )
+        print(status_table)
+
+
+def print_complexity_scores(
+    bins: List["ComplexityBin"],
+    feature: str,
+    correlations: Dict[str, Optional[float]],
+    details: bool = False,
+) -> None:
+    table = PrettyTable(
+        [
+            feature,
+            "Schemas",
+            "Declared coverage",
+            "Empirical coverage",
+            "GCT (s)",
+            "TGT (s)",
+        ]
+    )
+    for bin in bins:
+        table.add_row(
+            [
+                (
+                    f"{bin.low:g}"
+                    if bin.low == bin.high
+                    else f"{bin.low:g} - {bin.high:g}"
+                ),
+                f"{bin.count:,}",
+                format_value(bin.declared_coverage, percentage=True),
+                format_value(bin.empirical_coverage, percentage=True),
+                format_metric(bin.gct, details),
+                format_metric(bin.tgt, details),
+            ],
+            divider=details,
+        )
+    print(table)
+
+    # which features predict the compilation time
+    correlation_table = PrettyTable(["Feature", "GCT rank correlation"])
+    for name, correlation in sorted(
+        correlations.items(),
+        key=lambda item: -abs(item[1]) if item[1] is not None else 0,
+    ):
+        correlation_table.add_row([name, format_value(correlation)])
+    print(correlation_table)
+
 
 def plot_perf_metrics(
     perf_metrics: List["AggregatedPerfMetrics"],
@@ -1,4 +1,5 @@
 from engines.gemini import GeminiEngine
+from engines.mock import MockEngine, MockConfig
 from engines.openai import OpenAIEngine, OpenAIConfig
 from engines.guidance import GuidanceEngine, GuidanceConfig
 from engines.outlines import OutlinesEngine, OutlinesConfig
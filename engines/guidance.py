@@ -1,9 +1,10 @@
 import stopit
-from time import time
-from typing import List, Optional
 from dataclasses import dataclass
+from typing import List, Optional, TYPE_CHECKING
 
+from core.messages import Message
 from core.registry import register_engine
+from core.profile import measure_phase, timestamp
 from engines.llama_cpp import LlamaCppConfig
 from core.engine import Engine, EngineConfig
 from engines.llama_cpp import LlamaCppEngine
@@ -18,6 +19,9 @@ from core.types import (
     DecodingStatusCode,
 )
 
+if TYPE_CHECKING:
+    from guidance._grammar import GrammarFunction
+
 
 @dataclass
 class GuidanceConfig(EngineConfig):
@@ -42,59 +46,39 @@ class GuidanceEngine(Engine[GuidanceConfig]):
             verbose=self.config.model_engine_config.verbose,
             n_gpu_layers=self.config.model_engine_config.n_gpu_layers,
         )
+        self.formatter = LlamaCppEngine.get_chat_formatter(self.model)
+        self.prompt_cache_key = LlamaCppEngine.get_prompt_cache_key(
+            self.config.model_engine_config.model,
+            self.config.model_engine_config.filename,
+            add_bos=False,
+        )
 
         self.guidance_model_state = LlamaCpp(self.model, echo=False)
-
         self.tokenizer = self.guidance_model_state.engine.tokenizer
-        self.formatter = LlamaCppEngine.get_chat_formatter(self.model)
 
     def _generate(self, output: GenerationOutput) -> None:
-        from guidance import json as guidance_json
-
-        input = self.formatter(messages=output.messages)
-        output.token_usage.input_tokens = self.count_tokens(input)
-
-        try:
-            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    generation_op = guidance_json(
-                        schema=output.schema,
-                        name="generated_object",
-                        temperature=self.config.model_engine_config.temperature,
-                        max_tokens=safe_min(
-                            self.config.model_engine_config.n_ctx
-                            - self.count_tokens(input),
-                            self.config.max_tokens,
-                        ),
-                        whitespace_flexible=self.config.whitespace_flexible,
-                    )
-                    output.metadata.grammar_compilation_end_time = time()
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.OK
-                    )
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.compile_status = CompileStatus(
-                    code=CompileStatusCode.COMPILE_TIMEOUT,
-                    message="Schema compilation timed out",
-                )
-                return
-
-        except Exception as e:
-            output.metadata.compile_status = CompileStatus(
-                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
-            )
+        prompt = self.prepare_prompt(output)
+
+        generation_op = self._compile_grammar(
+            output,
+            safe_min(
+                self.config.model_engine_config.n_ctx - output.token_usage.input_tokens,
+                self.config.max_tokens,
+            ),
+        )
+        if generation_op is None:
             return
 
         try:
             with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
                 if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+                    output.metadata.decoding_start_time = timestamp()
                     state_iterator = (
-                        self.guidance_model_state.stream() + input + generation_op
+                        self.guidance_model_state.stream() + prompt.text + generation_op
                     )
                     for i, guidance_state in enumerate(state_iterator):
                         if i == 0:
-                            output.metadata.first_token_arrival_time = time()
+                            output.metadata.first_token_arrival_time = timestamp()
 
             if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
                 output.metadata.decoding_status = DecodingStatus(
@@ -112,20 +96,73 @@ class GuidanceEngine(Engine[GuidanceConfig]):
             )
             return
 
+        with measure_phase("post_processing", output):
+            try:
+                generation = guidance_state["generated_object"]
+                output.metadata.decoding_status = DecodingStatus(
+                    code=DecodingStatusCode.OK
+                )
+            except KeyError:
+                output.metadata.decoding_status = DecodingStatus(
+                    code=DecodingStatusCode.UNKOWN_ERROR,
+                    message="Failed to extract generated object",
+                )
+                generation = ""
+
+            output.generation = generation
+            output.token_usage.output_tokens = self.count_tokens(generation)
+
+        return
+
+    def _compile_grammar(
+        self, output: GenerationOutput, max_tokens: Optional[int]
+    ) -> Optional["GrammarFunction"]:
+        """Builds the guidance grammar of the schema of an output, and sets its
+        compile status. Returns None if the grammar could not be built. The
+        grammar is only turned into a parser for the tokenizer once the
+        generation starts, so the engine has no compile-only mode: the time to
+        build the grammar alone is not comparable to the GCT of the other
+        engines."""
+        from guidance import json as guidance_json
+
         try:
-            generation = guidance_state["generated_object"]
-            output.metadata.decoding_status = DecodingStatus(code=DecodingStatusCode.OK)
-        except KeyError:
-            output.metadata.decoding_status = DecodingStatus(
-                code=DecodingStatusCode.UNKOWN_ERROR,
-                message="Failed to extract generated object",
+            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
+                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+                    with measure_phase("compilation", output):
+                        generation_op = guidance_json(
+                            schema=output.schema,
+                            name="generated_object",
+                            temperature=self.config.model_engine_config.temperature,
+                            max_tokens=max_tokens,
+                            whitespace_flexible=self.config.whitespace_flexible,
+                        )
+                    output.metadata.grammar_compilation_end_time = timestamp()
+                    output.metadata.compile_status = CompileStatus(
+                        code=CompileStatusCode.OK
+                    )
+
+            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
+                output.metadata.compile_status = CompileStatus(
+                    code=CompileStatusCode.COMPILE_TIMEOUT,
+                    message="Schema compilation timed out",
+                )
+                return None
+
+        except Exception as e:
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
             )
-            generation = ""
+            return None
 
-        output.generation = generation
-        output.token_usage.output_tokens = self.count_tokens(generation)
+        return generation_op
 
-        return
+    def render_prompt(self, messages: List[Message]) -> str:
+        return self.formatter(messages=messages)
+
+    def tokenize_prompt(self, prompt: str) -> List[int]:
+        # guidance only takes text prompts, so the token ids are only counted,
+        # they are tokenized as in the llama.cpp engine to share its prompts
+        return self.model.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
 
     def encode(self, text: str) -> Optional[List[int]]:
         return self.tokenizer.encode(text.encode("utf-8"))
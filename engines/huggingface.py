@@ -1,12 +1,14 @@
 import torch
 import stopit
-from time import time
-from typing import List, Optional
+from typing import List, Optional, TYPE_CHECKING
 from dataclasses import dataclass
 from transformers.generation import LogitsProcessor
 
+from core.messages import Message
 from core.utils import GENERATION_TIMEOUT
+from core.prompts import PreparedPrompt
 from core.registry import register_engine
+from core.profile import measure_phase, record_token_timestamps, timestamp
 from core.engine import Engine, EngineConfig
 from core.types import (
     CompileStatus,
@@ -16,6 +18,9 @@ from core.types import (
     DecodingStatusCode,
 )
 
+if TYPE_CHECKING:
+    from transformers import BatchEncoding, PreTrainedModel, PreTrainedTokenizerBase
+
 
 class TimingLogitsProcessor(LogitsProcessor):
     """Logits processor that records timestamps for token generation."""
@@ -25,7 +30,7 @@ class TimingLogitsProcessor(LogitsProcessor):
         self.timestamps = []
 
     def __call__(self, _, scores):
-        self.timestamps.append(time())
+        self.timestamps.append(timestamp())
         return scores
 
 
@@ -38,6 +43,7 @@ class HuggingFaceConfig(EngineConfig):
 
 class HuggingFaceEngine(Engine[HuggingFaceConfig]):
     name = "huggingface"
+    supports_batching = True
 
     def __init__(self, config: HuggingFaceConfig):
         super().__init__(config)
@@ -50,12 +56,16 @@ class HuggingFaceEngine(Engine[HuggingFaceConfig]):
             self.config.model, torch_dtype=torch.bfloat16
         ).to(self.device)
         self.tokenizer.pad_token = self.tokenizer.eos_token
+        # batched generation appends the new tokens after the prompts
+        self.tokenizer.padding_side = "left"
+        # the engines running the same model share their prompts
+        self.prompt_cache_key = f"huggingface:{self.config.model}"
 
     def _generate(self, output: GenerationOutput) -> None:
         from transformers.generation import GenerationConfig
 
         # strictly speaking, HuggingFace does not have a grammar compilation step
-        output.metadata.grammar_compilation_end_time = time()
+        output.metadata.grammar_compilation_end_time = timestamp()
         output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
 
         timing_processor = TimingLogitsProcessor()
@@ -64,23 +74,15 @@ class HuggingFaceEngine(Engine[HuggingFaceConfig]):
             max_new_tokens=self.config.max_tokens,
         )
 
-        input = self.tokenizer.apply_chat_template(
-            output.messages, tokenize=False, add_generation_prompt=True
-        )
-
-        model_input = self.tokenizer(
-            input,
-            return_tensors="pt",
-            add_special_tokens=False,
-            padding=True,
-            truncation=True,
-        ).to(self.device)
+        prompt = self.prepare_prompt(output)
+        model_input = pad_prompts(self.tokenizer, [prompt]).to(self.device)
 
         input_length = model_input["input_ids"].shape[1]
 
         try:
             with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
                 if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+                    output.metadata.decoding_start_time = timestamp()
                     model_output = self.model.generate(
                         model_input["input_ids"],
                         generation_config=generation_config,
@@ -110,21 +112,95 @@ class HuggingFaceEngine(Engine[HuggingFaceConfig]):
             )
             return
 
-        generated_sequences = model_output[:, input_length:]
-        generated_texts = self.tokenizer.batch_decode(
-            generated_sequences, skip_special_tokens=True
-        )
-
-        output_text = generated_texts[0] if generated_texts else ""
-
         if timing_processor.timestamps:
             output.metadata.first_token_arrival_time = timing_processor.timestamps[0]
+        record_token_timestamps(output, timing_processor.timestamps)
 
-        output.generation = extract_json_text_from_text(output_text)
-        output.token_usage.output_tokens = self.count_tokens(output_text)
+        with measure_phase("post_processing", output):
+            generated_sequences = model_output[:, input_length:]
+            generated_texts = self.tokenizer.batch_decode(
+                generated_sequences, skip_special_tokens=True
+            )
+
+            output_text = generated_texts[0] if generated_texts else ""
+
+            output.generation = extract_json_text_from_text(output_text)
+            output.token_usage.output_tokens = self.count_tokens(output_text)
 
         return
 
+    def _generate_batch(self, outputs: List[GenerationOutput]) -> None:
+        from transformers.generation import GenerationConfig
+
+        for output in outputs:
+            output.metadata.grammar_compilation_end_time = timestamp()
+            output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+
+        timing_processor = TimingLogitsProcessor()
+        generation_config = GenerationConfig(
+            temperature=self.config.temperature,
+            max_new_tokens=self.config.max_tokens,
+        )
+
+        prompts = [self.prepare_prompt(output) for output in outputs]
+        model_input = pad_prompts(self.tokenizer, prompts).to(self.device)
+
+        input_length = model_input["input_ids"].shape[1]
+
+        try:
+            with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
+                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+                    decoding_start_time = timestamp()
+                    for output in outputs:
+                        output.metadata.decoding_start_time = decoding_start_time
+                    model_output = self.model.generate(
+                        model_input["input_ids"],
+                        generation_config=generation_config,
+                        attention_mask=model_input["attention_mask"],
+                        max_new_tokens=self.config.max_tokens,
+                        logits_processor=[timing_processor],
+                    )
+                    for output in outputs:
+                        output.metadata.decoding_status = DecodingStatus(
+                            code=DecodingStatusCode.OK
+                        )
+
+            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
+                for output in outputs:
+                    output.metadata.decoding_status = DecodingStatus(
+                        code=DecodingStatusCode.DECODING_TIMEOUT,
+                        message="Generation timed out",
+                    )
+                return
+
+        except Exception as e:
+            for output in outputs:
+                output.metadata.decoding_status = DecodingStatus(
+                    code=DecodingStatusCode.UNKOWN_ERROR, message=str(e)
+                )
+            return
+
+        with measure_phase("post_processing", *outputs):
+            output_texts = decode_batch(
+                self.tokenizer,
+                eos_token_ids(self.model, self.tokenizer),
+                outputs,
+                model_output[:, input_length:],
+                timing_processor.timestamps,
+            )
+
+            for output, output_text in zip(outputs, output_texts):
+                output.generation = extract_json_text_from_text(output_text)
+                output.token_usage.output_tokens = self.count_tokens(output_text)
+
+    def render_prompt(self, messages: List[Message]) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+
+    def tokenize_prompt(self, prompt: str) -> List[int]:
+        return self.tokenizer.encode(prompt, add_special_tokens=False, truncation=True)
+
     def encode(self, text: str) -> List[int]:
         return self.tokenizer.encode(text, add_special_tokens=False)
 
@@ -145,6 +221,93 @@ def get_best_device():
         return "cpu"
 
 
+def pad_prompts(
+    tokenizer: "PreTrainedTokenizerBase", prompts: List[PreparedPrompt]
+) -> "BatchEncoding":
+    """Pads the token ids of prepared prompts into the input of the model, on the
+    side of the tokenizer, without tokenizing them again.
+
+    :param tokenizer: PreTrainedTokenizerBase
+        The tokenizer of the engine.
+    :param prompts: List[PreparedPrompt]
+        The prompts of the batch.
+    :return: BatchEncoding
+        The input ids and the attention mask of the batch.
+    """
+    return tokenizer.pad(
+        {"input_ids": [prompt.token_ids for prompt in prompts]},
+        padding=True,
+        return_tensors="pt",
+    )
+
+
+def eos_token_ids(
+    model: "PreTrainedModel", tokenizer: "PreTrainedTokenizerBase"
+) -> List[int]:
+    """Returns the ids of the tokens that end a generation. The generation config
+    of chat models often lists several, e.g. the end of turn token besides the
+    eos token of the tokenizer."""
+    eos_token_id = model.generation_config.eos_token_id
+    if eos_token_id is None:
+        eos_token_id = tokenizer.eos_token_id
+    return (
+        list(eos_token_id)
+        if isinstance(eos_token_id, (list, tuple))
+        else [eos_token_id]
+    )
+
+
+def decode_batch(
+    tokenizer: "PreTrainedTokenizerBase",
+    eos_token_ids: List[int],
+    outputs: List[GenerationOutput],
+    generated_sequences: torch.Tensor,
+    timestamps: List[float],
+    mask_end_timestamps: Optional[List[float]] = None,
+) -> List[str]:
+    """Decodes the generated sequences of a batch and attributes the timestamps
+    of the decoding steps to each sequence. A sequence ends at its first eos
+    token, and is padded while the others keep decoding.
+
+    :param tokenizer: PreTrainedTokenizerBase
+        The tokenizer of the engine.
+    :param eos_token_ids: List[int]
+        The ids of the tokens that end a generation, see `eos_token_ids`.
+    :param outputs: List[GenerationOutput]
+        The generation outputs of the batch, modified in place.
+    :param generated_sequences: torch.Tensor
+        The generated tokens of each sequence, without the prompt.
+    :param timestamps: List[float]
+        The time at which each decoding step started.
+    :param mask_end_timestamps: Optional[List[float]]
+        The time at which the grammar masks of each decoding step were applied.
+    :return: List[str]
+        The generated text of each sequence.
+    """
+    is_eos = torch.isin(
+        generated_sequences,
+        torch.tensor(eos_token_ids, device=generated_sequences.device),
+    )
+    lengths = torch.where(
+        is_eos.any(dim=1),
+        is_eos.int().argmax(dim=1),
+        generated_sequences.shape[1],
+    ).tolist()
+
+    if timestamps:
+        for output, length in zip(outputs, lengths):
+            last_step = min(length, len(timestamps) - 1)
+            output.metadata.first_token_arrival_time = timestamps[0]
+            output.metadata.last_token_arrival_time = timestamps[last_step]
+            record_token_timestamps(
+                output,
+                timestamps[: last_step + 1],
+                (mask_end_timestamps[: last_step + 1] if mask_end_timestamps else None),
+            )
+
+    return tokenizer.batch_decode(generated_sequences, skip_special_tokens=True)
+
+
 def extract_json_text_from_text(text: str) -> str:
     if "```json" in text:
         return text.split("```json")[1].split("```")[0].strip()
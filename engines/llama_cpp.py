@@ -1,11 +1,19 @@
 import os
-import time
 import stopit
 from json import dumps
 from dataclasses import dataclass
-from typing import List, Dict, Any, Optional, TYPE_CHECKING
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple, TYPE_CHECKING
 
 from core.registry import register_engine
+from core.profile import measure_phase, record_token_timestamps, timestamp
+from core.grammar_cache import GrammarCache, tokenizer_fingerprint
+from core.compile_pool import (
+    CompileResultStatus,
+    CompileWorkerPool,
+    record_compile_phases,
+)
+from core.messages import Message
 from core.engine import Engine, EngineConfig
 from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT
 from core.types import (
@@ -18,7 +26,7 @@ from core.types import (
 )
 
 if TYPE_CHECKING:
-    from llama_cpp import Llama
+    from llama_cpp import Llama, LlamaState
     from llama_cpp.llama_grammar import LlamaGrammar
     from llama_cpp.llama_chat_format import ChatFormatter
 
@@ -26,11 +34,98 @@ if TYPE_CHECKING:
 class LlamaCppChatFormatter:
     def __init__(self, formatter: "ChatFormatter"):
         self.formatter = formatter
+        # the stop sequences and criteria the chat handler of llama-cpp-python
+        # adds to a completion, they only depend on the chat template
+        response = formatter(messages=[{"role": "user", "content": ""}])
+        stop = response.stop
+        self.stop: Optional[List[str]] = [stop] if isinstance(stop, str) else stop
+        self.stopping_criteria = response.stopping_criteria
 
     def __call__(self, messages: List[Dict[str, Any]]) -> str:
         return self.formatter(messages=messages).prompt
 
 
+class LlamaPrefixCache:
+    def __init__(
+        self,
+        model: "Llama",
+        formatter: LlamaCppChatFormatter,
+        max_size: int,
+        add_bos: bool = False,
+    ):
+        """Keeps the state of the model after the prefill of the prompt prefix
+        shared by the samples of a task, i.e. the system message and the few-shot
+        examples, so that only the schema-specific suffix of each prompt is
+        prefilled. The prefix of a prompt is what its messages render to up to
+        the content of the last message. The states of the `max_size` most
+        recently used prefixes are kept.
+
+        :param model: Llama
+            The model whose state is saved and restored.
+        :param formatter: LlamaCppChatFormatter
+            The chat formatter of the model.
+        :param max_size: int
+            The maximum number of prefix states kept in memory.
+        :param add_bos: bool
+            Whether the prompts are tokenized with a BOS token, which depends on
+            whether the generation formats the prompt itself.
+        """
+        self.model = model
+        self.formatter = formatter
+        self.max_size = max_size
+        self.add_bos = add_bos
+
+        self._states: OrderedDict[Tuple[int, ...], "LlamaState"] = OrderedDict()
+        self._prefixes: Dict[str, Tuple[int, ...]] = {}
+
+    def _prefix_tokens(self, messages: List[Message]) -> Tuple[int, ...]:
+        key = dumps(messages[:-1])
+        if key not in self._prefixes:
+            prompt = self.formatter(messages=messages)
+            # the same conversation with an empty last message, the rendered
+            # prompts only differ from the content of the last message onwards
+            template_prompt = self.formatter(
+                messages=messages[:-1] + [{**messages[-1], "content": ""}]
+            )
+            prefix = os.path.commonprefix([prompt, template_prompt])
+            tokens = self.model.tokenize(
+                prefix.encode("utf-8"), add_bos=self.add_bos, special=True
+            )
+            # the last token may merge with the suffix in the full prompt
+            self._prefixes[key] = tuple(tokens[:-1])
+        return self._prefixes[key]
+
+    def restore(self, messages: List[Message]) -> int:
+        """Sets the state of the model to the end of the prefix of the prompt of
+        the messages, prefilling and saving it the first time the prefix is
+        seen. The generation then only evaluates the rest of the prompt, since
+        llama.cpp reuses the evaluated tokens the prompt starts with.
+
+        :param messages: List[Message]
+            The messages of the prompt.
+        :return: int
+            The number of tokens of the prefix that were restored rather than
+            evaluated, 0 the first time the prefix is seen.
+        """
+        tokens = self._prefix_tokens(messages)
+        if not tokens:
+            return 0
+
+        if tokens in self._states:
+            self._states.move_to_end(tokens)
+            # already evaluated if the previous prompt had the same prefix
+            if tuple(self.model.input_ids[: len(tokens)].tolist()) != tokens:
+                self.model.load_state(self._states[tokens])
+            return len(tokens)
+
+        self.model.reset()
+        self.model.eval(list(tokens))
+        self._states[tokens] = self.model.save_state()
+        if len(self._states) > self.max_size:
+            self._states.popitem(last=False)
+        return 0
+
+
 @dataclass
 class LlamaCppConfig(EngineConfig):
     model: str
@@ -40,15 +135,24 @@ class LlamaCppConfig(EngineConfig):
     n_gpu_layers: int = -1
     temperature: float = 0.2
     llama_cpp_max_tokens: Optional[int] = None
+    # persist the GBNF grammars on disk across runs, see `core.grammar_cache`
+    grammar_disk_cache: bool = False
+    # number of processes compiling grammars, see `core.compile_pool`
+    compile_workers: int = 1
+    # keep the state of the model after the prompt prefix shared by the samples
+    # of a task, see `LlamaPrefixCache`
+    prefix_cache: bool = False
+    prefix_cache_size: int = 4
 
 
 class LlamaCppEngine(Engine[LlamaCppConfig]):
     name = "llama_cpp"
+    supports_compile_only = True
 
-    def __init__(self, config: LlamaCppConfig):
-        super().__init__(config)
+    def __init__(self, config: LlamaCppConfig, compile_only: bool = False):
+        super().__init__(config, compile_only)
 
-        from llama_cpp import Llama
+        from llama_cpp import Llama, __version__
 
         self.model = Llama.from_pretrained(
             repo_id=self.config.model,
@@ -56,64 +160,71 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
             n_ctx=self.config.n_ctx,
             verbose=self.config.verbose,
             n_gpu_layers=self.config.n_gpu_layers,
+            # the grammars only need the vocabulary, not the weights
+            vocab_only=self.compile_only,
         )
 
         self.formatter = self.get_chat_formatter(self.model)
+        self.prompt_cache_key = self.get_prompt_cache_key(
+            self.config.model, self.config.filename, add_bos=False
+        )
 
-    def _generate(self, output: GenerationOutput) -> None:
-        from llama_cpp.llama_grammar import LlamaGrammar
-
-        input = self.formatter(messages=output.messages)
-        output.token_usage.input_tokens = self.count_tokens(input)
+        self.prefix_cache = None
+        if self.config.prefix_cache and not self.compile_only:
+            self.prefix_cache = LlamaPrefixCache(
+                self.model, self.formatter, self.config.prefix_cache_size
+            )
 
-        grammar = None
-        try:
-            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    grammar = LlamaGrammar.from_json_schema(
-                        dumps(output.schema), verbose=False
-                    )
-                    output.metadata.grammar_compilation_end_time = time.time()
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.OK
-                    )
+        # grammars are checked in a separate process, since some of them crash
+        # llama.cpp when they are added to a sampler
+        self.compile_pool = CompileWorkerPool(
+            _init_compile_worker,
+            (self.config.model, self.config.filename),
+            _compile_json_schema,
+            num_workers=self.config.compile_workers,
+        )
 
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.compile_status = CompileStatus(
-                    code=CompileStatusCode.COMPILE_TIMEOUT,
-                    message="Grammar compilation timed out",
-                )
-                return
+        if self.config.grammar_disk_cache:
+            # GBNF grammars do not depend on the tokenizer
+            self.grammar_cache = GrammarCache(
+                self.name, tokenizer_fingerprint(__version__)
+            )
 
-            segfault_check = self._check_grammar_safety(grammar)
-            if not segfault_check["success"]:
-                output.metadata.compile_status = CompileStatus(
-                    code=CompileStatusCode.UNSUPPORTED_SCHEMA,
-                    message=f"Failed to add grammar to sampler: {segfault_check}",
-                )
-                return
+    def _generate(self, output: GenerationOutput) -> None:
+        prompt = self.prepare_prompt(output)
 
-        except Exception as e:
-            output.metadata.compile_status = CompileStatus(
-                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
-            )
+        grammar = self._compile_grammar(output)
+        if grammar is None:
             return
 
         try:
             with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
                 if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    generator = self.model.create_chat_completion(
-                        messages=output.messages,
+                    output.metadata.decoding_start_time = timestamp()
+                    # restoring the prefix is part of the prefill
+                    if self.prefix_cache is not None:
+                        self.prefix_cache.restore(output.messages)
+                    output.metadata.cached_prompt_tokens = reused_prompt_tokens(
+                        self.model, prompt.token_ids
+                    )
+                    # the prompt is already rendered and tokenized, so it is
+                    # completed directly rather than through the chat handler,
+                    # with the same stop sequences
+                    generator = self.model.create_completion(
+                        prompt=prompt.token_ids,
                         stream=True,
                         grammar=grammar,
+                        stop=self.formatter.stop,
+                        stopping_criteria=self.formatter.stopping_criteria,
                         temperature=self.config.temperature,
                         max_tokens=self.config.llama_cpp_max_tokens,
                     )
 
                     tokens_str = []
+                    token_arrival_times = []
                     for i, chunk in enumerate(generator):
                         if i == 0:
-                            output.metadata.first_token_arrival_time = time.time()
+                            output.metadata.first_token_arrival_time = timestamp()
 
                         if (
                             len(chunk["choices"]) == 0
@@ -121,10 +232,12 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
                         ):
                             continue
 
-                        chunk_content = chunk["choices"][0]["delta"].get("content", "")
+                        chunk_content = chunk["choices"][0]["text"]
                         if chunk_content:
                             tokens_str.append(chunk_content)
+                            token_arrival_times.append(timestamp())
 
+                    record_token_timestamps(output, token_arrival_times)
                     output.metadata.decoding_status = DecodingStatus(
                         code=DecodingStatusCode.OK
                     )
@@ -142,43 +255,86 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
 
             return
 
-        generation = "".join(tokens_str)
+        with measure_phase("post_processing", output):
+            generation = "".join(tokens_str)
 
-        output.generation = generation
-        output.token_usage.output_tokens = self.count_tokens(generation)
-        output.generated_tokens = [
-            Token(id=self.convert_token_to_id(token), text=token)
-            for token in tokens_str
-        ]
+            output.generation = generation
+            output.generated_tokens = read_generated_tokens(
+                self.model, len(prompt.token_ids), generation
+            )
+            output.token_usage.output_tokens = len(output.generated_tokens)
 
         return
 
-    def _check_grammar_safety(self, grammar: "LlamaGrammar") -> Dict[str, Any]:
-        def child_process():
-            import signal
-            from llama_cpp._internals import LlamaSampler
-
-            signal.signal(signal.SIGALRM, lambda _, __: os._exit(2))
-            signal.alarm(15)
-            try:
-                LlamaSampler().add_grammar(self.model._model, grammar)
-                os._exit(0)
-            except Exception:
-                os._exit(1)
-
-        id = os.fork()
-        if id == 0:
-            child_process()
-        else:
-            _, status = os.waitpid(id, 0)
-            if os.WIFEXITED(status):
-                exit_code = os.WEXITSTATUS(status)
-                return {"success": exit_code == 0, "exit_code": exit_code}
-            return {"success": False, "error": "Unknown status"}
+    def _compile(self, output: GenerationOutput) -> None:
+        self._compile_grammar(output)
+
+    def _compile_grammar(self, output: GenerationOutput) -> Optional["LlamaGrammar"]:
+        """Converts the schema of an output to a GBNF grammar and checks that it
+        can be added to a sampler in the compile worker pool, or reads the
+        grammar from the disk cache. Sets the compile status, and returns None
+        if the grammar could not be compiled."""
+        from llama_cpp.llama_grammar import LlamaGrammar
+
+        gbnf = None
+        if self.grammar_cache is not None:
+            data = self.grammar_cache.get(output.schema)
+            output.metadata.grammar_cache_hit = data is not None
+            if data is not None:
+                gbnf = data.decode("utf-8")
+
+        if gbnf is None:
+            compilation_start_time = timestamp()
+            result = self.compile_pool.compile(
+                dumps(output.schema), COMPILATION_TIMEOUT
+            )
+            record_compile_phases(output, result, timestamp() - compilation_start_time)
+            if result.status == CompileResultStatus.TIMEOUT:
+                output.metadata.compile_status = CompileStatus(
+                    code=CompileStatusCode.COMPILE_TIMEOUT, message=result.message
+                )
+                return None
+            if result.status == CompileResultStatus.CRASH:
+                output.metadata.compile_status = CompileStatus(
+                    code=CompileStatusCode.UNSUPPORTED_SCHEMA,
+                    message=f"Failed to add grammar to sampler: {result.message}",
+                )
+                return None
+            if result.status != CompileResultStatus.OK:
+                output.metadata.compile_status = CompileStatus(
+                    code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=result.message
+                )
+                return None
+
+            gbnf = result.artifact
+            if self.grammar_cache is not None:
+                self.grammar_cache.put(output.schema, gbnf.encode("utf-8"))
+
+        try:
+            grammar = LlamaGrammar.from_string(gbnf, verbose=False)
+        except Exception as e:
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
+            )
+            return None
+
+        output.metadata.grammar_compilation_end_time = timestamp()
+        output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+        # the parsed grammar lives in llama.cpp, so its GBNF source is the closest
+        # measure of its size
+        output.metadata.grammar_size = len(gbnf.encode("utf-8"))
+        return grammar
+
+    def render_prompt(self, messages: List[Message]) -> str:
+        return self.formatter(messages=messages)
+
+    def tokenize_prompt(self, prompt: str) -> List[int]:
+        # the chat template already contains the special tokens, e.g. BOS
+        return self.model.tokenize(prompt.encode("utf-8"), add_bos=False, special=True)
 
     def encode(self, text: str) -> List[int]:
         byte_string = text.encode("utf-8")
-        return self.model.tokenize(byte_string)
+        return self.model.tokenize(byte_string, add_bos=False)
 
     def decode(self, ids: List[int]) -> str:
         byte_string = self.model.detokenize(ids)
@@ -189,9 +345,39 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
         return self.model.n_ctx()
 
     def close(self):
-        self.model._sampler.close()
+        self.compile_pool.close()
+        # the sampler is only created by the first generation, so there is none
+        # in compile-only mode
+        if self.model._sampler is not None:
+            self.model._sampler.close()
         self.model.close()
 
+    @staticmethod
+    def get_prompt_cache_key(
+        model: str,
+        filename: str,
+        add_bos: bool,
+        hf_tokenizer_id: Optional[str] = None,
+    ) -> str:
+        """The prompt cache key of the engines that render their prompts with
+        the chat template of a llama.cpp model, so that the engines tokenizing
+        them the same way share their prompts.
+
+        :param model: str
+            The repository of the model.
+        :param filename: str
+            The file of the model in the repository.
+        :param add_bos: bool
+            Whether the prompts are tokenized with a BOS token.
+        :param hf_tokenizer_id: Optional[str]
+            The Hugging Face tokenizer used instead of the llama.cpp one, if any.
+        :return: str
+            The key of the prompts in the prompt cache.
+        """
+        return ":".join(
+            ["llama_cpp", model, filename, hf_tokenizer_id or "", str(int(add_bos))]
+        )
+
     @staticmethod
     def get_chat_formatter(model: "Llama") -> LlamaCppChatFormatter:
         from llama_cpp.llama_chat_format import Jinja2ChatFormatter
@@ -214,4 +400,76 @@ class LlamaCppEngine(Engine[LlamaCppConfig]):
             raise ValueError("No chat template found in model metadata")
 
 
+def reused_prompt_tokens(model: "Llama", prompt_token_ids: List[int]) -> int:
+    """Counts the tokens of a prompt whose prefill llama.cpp reuses from the
+    context of the model, i.e. the longest common prefix of the evaluated
+    tokens and the prompt. The last token of the prompt is always evaluated to
+    sample the first generated token.
+
+    :param model: Llama
+        The model the prompt is about to be completed by.
+    :param prompt_token_ids: List[int]
+        The tokens of the prompt.
+    :return: int
+        The number of tokens of the prompt that are not evaluated again.
+    """
+    reused = 0
+    for evaluated, token in zip(model.input_ids.tolist(), prompt_token_ids[:-1]):
+        if evaluated != token:
+            break
+        reused += 1
+    return reused
+
+
+def read_generated_tokens(
+    model: "Llama", num_prompt_tokens: int, generation: str
+) -> List[Token]:
+    """Reads the generated tokens from the context of the model rather than
+    tokenizing the generation again. llama.cpp evaluates each sampled token
+    before sampling the next one, so the context holds all the generated tokens
+    but the last one. If the generation did not end with an end of sequence
+    token, the last one is left as text for `Engine.materialize_tokens`.
+
+    :param model: Llama
+        The model that generated the tokens.
+    :param num_prompt_tokens: int
+        The number of tokens of the prompt, that precede the generated tokens in
+        the context.
+    :param generation: str
+        The generated text.
+    :return: List[Token]
+        The generated tokens.
+    """
+    ids = model.input_ids[num_prompt_tokens:].tolist()
+    tokens = [
+        Token(id=id, text=model.detokenize([id]).decode("utf-8", errors="ignore"))
+        for id in ids
+    ]
+
+    text = model.detokenize(ids).decode("utf-8", errors="ignore")
+    if len(generation) > len(text) and generation.startswith(text):
+        tokens.append(Token(text=generation[len(text) :]))
+    return tokens
+
+
+def _init_compile_worker(model: str, filename: str) -> "Llama":
+    from llama_cpp import Llama
+
+    # the grammar only needs the vocabulary, not the weights
+    return Llama.from_pretrained(
+        repo_id=model, filename=filename, vocab_only=True, verbose=False
+    )
+
+
+def _compile_json_schema(model: "Llama", schema_str: str) -> str:
+    from llama_cpp._internals import LlamaSampler
+    from llama_cpp.llama_grammar import LlamaGrammar, json_schema_to_gbnf
+
+    gbnf = json_schema_to_gbnf(schema_str)
+    LlamaSampler().add_grammar(
+        model._model, LlamaGrammar.from_string(gbnf, verbose=False)
+    )
+    return gbnf
+
+
 register_engine(LlamaCppEngine, LlamaCppConfig)
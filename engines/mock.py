@@ -0,0 +1,482 @@
+import math
+from time import sleep
+from zlib import crc32
+from random import Random
+from json import dumps, loads
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from core.messages import Message
+from core.utils import schema_hash
+from core.registry import register_engine
+from core.profile import measure_phase, record_token_timestamps, timestamp
+from core.engine import Engine, EngineConfig
+from core.types import (
+    Token,
+    Schema,
+    CompileStatus,
+    DecodingStatus,
+    GenerationOutput,
+    CompileStatusCode,
+    DecodingStatusCode,
+)
+
+DISTRIBUTIONS = ("constant", "uniform", "normal", "lognormal", "exponential")
+
+# like models, instances fill the optional properties, except beyond this
+# depth where they are left out and arrays are kept to their minimum length, so
+# that recursive schemas yield finite instances. Past it, required properties
+# and items are not generated either, see `_minimal_instance`
+MAX_INSTANCE_DEPTH = 8
+
+FORMAT_EXAMPLES = {
+    "date-time": "2024-01-01T00:00:00Z",
+    "date": "2024-01-01",
+    "time": "00:00:00Z",
+    "email": "mock@example.com",
+    "hostname": "example.com",
+    "ipv4": "127.0.0.1",
+    "ipv6": "::1",
+    "uri": "https://example.com",
+    "uuid": "00000000-0000-4000-8000-000000000000",
+}
+WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel")
+# a value of each JSON type, to break the type of an instance
+TYPE_EXAMPLES = {
+    "object": {},
+    "array": [],
+    "string": "mock",
+    "number": 0.5,
+    "boolean": True,
+    "null": None,
+}
+
+
+@dataclass
+class LatencyDistribution:
+    """A latency distribution, in ms. `constant` always takes `mean`, the other
+    distributions have the given mean and standard deviation, except for
+    `exponential` whose standard deviation is its mean. Samples are clipped at
+    0."""
+
+    distribution: str = "constant"
+    mean: float = 0.0
+    std: float = 0.0
+
+    def __post_init__(self):
+        if self.distribution not in DISTRIBUTIONS:
+            raise ValueError(
+                f"Invalid distribution: {self.distribution}, available: {DISTRIBUTIONS}"
+            )
+
+    def sample(self, rng: Random) -> float:
+        """Draws a latency, in s."""
+        if self.mean <= 0:
+            return 0.0
+
+        if self.distribution == "uniform":
+            spread = math.sqrt(3) * self.std
+            value = rng.uniform(self.mean - spread, self.mean + spread)
+        elif self.distribution == "normal":
+            value = rng.gauss(self.mean, self.std)
+        elif self.distribution == "lognormal":
+            sigma = math.sqrt(math.log(1 + (self.std / self.mean) ** 2))
+            value = rng.lognormvariate(math.log(self.mean) - sigma**2 / 2, sigma)
+        elif self.distribution == "exponential":
+            value = rng.expovariate(1 / self.mean)
+        else:
+            value = self.mean
+        return max(value, 0.0) / 1000
+
+
+@dataclass
+class MockConfig(EngineConfig):
+    seed: int = 0
+    compile_latency: LatencyDistribution = field(default_factory=LatencyDistribution)
+    prefill_latency: LatencyDistribution = field(default_factory=LatencyDistribution)
+    token_latency: LatencyDistribution = field(default_factory=LatencyDistribution)
+    # fraction of the schemas reported as unsupported
+    unsupported_rate: float = 0.0
+    # fraction of the generations that are not valid JSON
+    malformed_rate: float = 0.0
+    # fraction of the generations that are valid JSON but do not match the
+    # schema, where the schema constrains the type of the root
+    nonconforming_rate: float = 0.0
+    chars_per_token: int = 4
+    vocab_size: int = 32_000
+    max_tokens: Optional[int] = None
+    context_length: int = 128_000
+
+
+class MockEngine(Engine[MockConfig]):
+    name = "mock"
+    supports_concurrency = True
+    supports_compile_only = True
+
+    def __init__(self, config: MockConfig, compile_only: bool = False):
+        """Deterministic stand-in for a model, to benchmark the harness itself
+        without a GPU, a model download or an API key. It generates an instance
+        of each schema, broken on purpose for a configurable fraction of the
+        samples, and sleeps to simulate the latency of the compilation, the
+        prefill and each token. The outcome of a sample only depends on the
+        seed, its messages and its schema, not on the order of the samples.
+        """
+        super().__init__(config, compile_only)
+        self.prompt_cache_key = f"{self.name}:{self.config.chars_per_token}"
+
+    def _rng(self, output: GenerationOutput) -> Random:
+        return Random(
+            f"{self.config.seed}:{schema_hash(output.messages)}:"
+            f"{schema_hash(output.schema)}"
+        )
+
+    def _generate(self, output: GenerationOutput) -> None:
+        rng = self._rng(output)
+        self._compile_grammar(output, rng)
+        if output.metadata.compile_status.code != CompileStatusCode.OK:
+            return
+
+        self.prepare_prompt(output)
+        try:
+            generation = self._generate_text(output.schema, rng)
+        except Exception as e:
+            output.metadata.decoding_status = DecodingStatus(
+                code=DecodingStatusCode.UNKOWN_ERROR, message=str(e)
+            )
+            return
+        tokens_str = self._split(generation)
+        if self.config.max_tokens is not None:
+            tokens_str = tokens_str[: self.config.max_tokens]
+
+        output.metadata.decoding_start_time = timestamp()
+        _sleep(self.config.prefill_latency.sample(rng))
+        token_arrival_times = []
+        for _ in tokens_str:
+            _sleep(self.config.token_latency.sample(rng))
+            token_arrival_times.append(timestamp())
+
+        if token_arrival_times:
+            output.metadata.first_token_arrival_time = token_arrival_times[0]
+        record_token_timestamps(output, token_arrival_times)
+        output.metadata.decoding_status = DecodingStatus(code=DecodingStatusCode.OK)
+
+        with measure_phase("post_processing", output):
+            output.generation = "".join(tokens_str)
+            output.token_usage.output_tokens = len(tokens_str)
+            output.generated_tokens = [
+                Token(id=self._token_id(token), text=token) for token in tokens_str
+            ]
+
+    def _compile(self, output: GenerationOutput) -> None:
+        self._compile_grammar(output, self._rng(output))
+
+    def _compile_grammar(self, output: GenerationOutput, rng: Random) -> None:
+        with measure_phase("compilation", output):
+            _sleep(self.config.compile_latency.sample(rng))
+        output.metadata.grammar_compilation_end_time = timestamp()
+
+        if rng.random() < self.config.unsupported_rate:
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA,
+                message="Schema rejected by the mock engine",
+            )
+            return
+        output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+        output.metadata.grammar_size = len(dumps(output.schema))
+
+    def _generate_text(self, schema: Schema, rng: Random) -> str:
+        # both draws are always made, so that the rates are independent
+        malformed = rng.random() < self.config.malformed_rate
+        nonconforming = rng.random() < self.config.nonconforming_rate
+
+        instance = generate_instance(schema, rng)
+        if nonconforming and not malformed:
+            wrong_type = _wrong_type_instance(schema)
+            if wrong_type is not None:
+                return dumps(wrong_type[0])
+            malformed = True
+
+        text = dumps(instance)
+        if malformed:
+            text = text[: rng.randrange(len(text))]
+            try:
+                loads(text)
+            except ValueError:
+                return text
+            # a prefix of a number can still be valid JSON
+            text += ","
+        return text
+
+    def _split(self, text: str) -> List[str]:
+        size = self.config.chars_per_token
+        return [text[i : i + size] for i in range(0, len(text), size)]
+
+    def _token_id(self, token: str) -> int:
+        return crc32(token.encode("utf-8")) % self.config.vocab_size
+
+    def render_prompt(self, messages: List[Message]) -> str:
+        return "".join(f"<{m['role']}>{m['content']}\n" for m in messages)
+
+    def tokenize_prompt(self, prompt: str) -> List[int]:
+        return self.encode(prompt)
+
+    def encode(self, text: str) -> List[int]:
+        return [self._token_id(token) for token in self._split(text)]
+
+    def count_tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.config.chars_per_token)
+
+    @property
+    def max_context_length(self) -> int:
+        return self.config.context_length
+
+
+def _sleep(duration: float) -> None:
+    if duration > 0:
+        sleep(duration)
+
+
+def _resolve(schema: Any, root: Schema) -> Any:
+    """Follows the local references of a schema, remote ones are left as is."""
+    seen = set()
+    while isinstance(schema, dict) and isinstance(schema.get("$ref"), str):
+        ref = schema["$ref"]
+        if not ref.startswith("#") or ref in seen:
+            break
+        seen.add(ref)
+
+        target: Any = root
+        for part in ref[1:].split("/")[1:]:
+            part = part.replace("~1", "/").replace("~0", "~")
+            if isinstance(target, list) and part.isdigit():
+                target = target[int(part)]
+            elif isinstance(target, dict) and part in target:
+                target = target[part]
+            else:
+                return {}
+        siblings = {k: v for k, v in schema.items() if k != "$ref"}
+        schema = {**target, **siblings} if isinstance(target, dict) else target
+    return schema
+
+
+def _merge_all_of(
+    schema: Dict[str, Any], root: Schema, depth: int = 0
+) -> Dict[str, Any]:
+    merged = {k: v for k, v in schema.items() if k != "allOf"}
+    for subschema in schema["allOf"]:
+        subschema = _resolve(subschema, root)
+        if not isinstance(subschema, dict):
+            continue
+        if "allOf" in subschema:
+            # a subschema may refer back to the schema itself
+            if depth >= MAX_INSTANCE_DEPTH:
+                continue
+            subschema = _merge_all_of(subschema, root, depth + 1)
+        for key, value in subschema.items():
+            if key == "properties" and isinstance(value, dict):
+                merged["properties"] = {**value, **merged.get("properties", {})}
+            elif key == "required" and isinstance(value, list):
+                merged["required"] = list(merged.get("required", [])) + value
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+
+def _infer_type(schema: Dict[str, Any]) -> Optional[str]:
+    types = schema.get("type")
+    if isinstance(types, list):
+        non_null = [t for t in types if t != "null"]
+        return non_null[0] if non_null else (types[0] if types else None)
+    if isinstance(types, str):
+        return types
+    if "properties" in schema or "required" in schema:
+        return "object"
+    if "items" in schema or "prefixItems" in schema:
+        return "array"
+    if any(k in schema for k in ("minLength", "maxLength", "pattern", "format")):
+        return "string"
+    if any(k in schema for k in ("minimum", "maximum", "multipleOf")):
+        return "number"
+    return None
+
+
+def _bounds(schema: Dict[str, Any], step: float) -> List[float]:
+    low = schema.get("minimum", 0)
+    high = schema.get("maximum", low + 100)
+    # draft 4 uses booleans, later drafts the bound itself
+    if isinstance(schema.get("exclusiveMinimum"), (int, float)) and not isinstance(
+        schema["exclusiveMinimum"], bool
+    ):
+        low = max(low, schema["exclusiveMinimum"] + step)
+    elif schema.get("exclusiveMinimum") is True:
+        low += step
+    if isinstance(schema.get("exclusiveMaximum"), (int, float)) and not isinstance(
+        schema["exclusiveMaximum"], bool
+    ):
+        high = min(high, schema["exclusiveMaximum"] - step)
+    elif schema.get("exclusiveMaximum") is True:
+        high -= step
+    return [low, max(low, high)]
+
+
+def _generate_number(schema: Dict[str, Any], rng: Random, integer: bool) -> Any:
+    low, high = _bounds(schema, 1 if integer else 0.01)
+    multiple_of = schema.get("multipleOf")
+    if isinstance(multiple_of, (int, float)) and multiple_of > 0:
+        return type(multiple_of)(math.ceil(low / multiple_of) * multiple_of)
+    if integer:
+        return rng.randint(math.ceil(low), max(math.ceil(low), math.floor(high)))
+    return round(rng.uniform(low, high), 2)
+
+
+def _generate_string(schema: Dict[str, Any], rng: Random) -> str:
+    # patterns are not followed, so instances of schemas with a pattern that
+    # the example does not match are rejected by the evaluator
+    value = FORMAT_EXAMPLES.get(schema.get("format"), rng.choice(WORDS))
+    min_length = schema.get("minLength", 0)
+    if len(value) < min_length:
+        value += "a" * (min_length - len(value))
+    if "maxLength" in schema:
+        value = value[: schema["maxLength"]]
+    return value
+
+
+def _allows_null(schema: Dict[str, Any]) -> bool:
+    types = schema.get("type")
+    return types == "null" or (isinstance(types, list) and "null" in types)
+
+
+def _minimal_instance(schema: Dict[str, Any], rng: Random) -> Any:
+    """The smallest instance of a schema that does not require generating any
+    subschema: null if the schema allows it, else an empty object or array, or
+    a value of its scalar type."""
+    instance_type = _infer_type(schema)
+    if instance_type is None or _allows_null(schema):
+        return None
+    if instance_type == "object":
+        return {}
+    if instance_type == "array":
+        return []
+    if instance_type == "string":
+        return _generate_string(schema, rng)
+    if instance_type == "integer":
+        return _generate_number(schema, rng, integer=True)
+    if instance_type == "number":
+        return _generate_number(schema, rng, integer=False)
+    if instance_type == "boolean":
+        return False
+    return None
+
+
+def generate_instance(
+    schema: Any, rng: Random, root: Optional[Schema] = None, depth: int = 0
+) -> Any:
+    """Generates an instance of a schema, picking the values at random within
+    the constraints that are cheap to satisfy: types, required properties,
+    enums, bounds, lengths, numbers of items and common formats. Patterns and
+    the rarer keywords are ignored, so an instance may not match its schema.
+    Past `MAX_INSTANCE_DEPTH`, e.g. in a recursive schema whose recursion is
+    required, the instance is cut short with a minimal value.
+
+    :param schema: Any
+        The schema to generate an instance of.
+    :param rng: Random
+        The random number generator, seeded for the output to be deterministic.
+    :param root: Optional[Schema]
+        The root schema that local references are resolved against, the schema
+        itself if None.
+    :param depth: int
+        The depth of the schema in the root schema.
+    :return: Any
+        The instance.
+    """
+    if root is None:
+        root = schema
+    schema = _resolve(schema, root)
+    if not isinstance(schema, dict):
+        return None
+    if "allOf" in schema:
+        schema = _merge_all_of(schema, root)
+
+    if "const" in schema:
+        return schema["const"]
+    if isinstance(schema.get("enum"), list) and schema["enum"]:
+        return rng.choice(schema["enum"])
+    if depth > MAX_INSTANCE_DEPTH:
+        return _minimal_instance(schema, rng)
+    for keyword in ("anyOf", "oneOf"):
+        if isinstance(schema.get(keyword), list) and schema[keyword]:
+            branch = _resolve(rng.choice(schema[keyword]), root)
+            siblings = {k: v for k, v in schema.items() if k != keyword}
+            if isinstance(branch, dict):
+                siblings = {**siblings, **branch}
+            # a branch is a subschema, so that unions referring back to
+            # themselves are cut short as well
+            return generate_instance(siblings, rng, root, depth + 1)
+
+    instance_type = _infer_type(schema)
+    nested = depth < MAX_INSTANCE_DEPTH
+
+    if instance_type == "object":
+        properties = schema.get("properties", {})
+        required = schema.get("required", [])
+        instance = {}
+        for name, subschema in properties.items():
+            if name in required or nested:
+                instance[name] = generate_instance(subschema, rng, root, depth + 1)
+        for name in required:
+            if name not in instance:
+                additional = schema.get("additionalProperties")
+                instance[name] = generate_instance(
+                    additional if isinstance(additional, dict) else {"type": "string"},
+                    rng,
+                    root,
+                    depth + 1,
+                )
+        return instance
+    if instance_type == "array":
+        prefix_items = schema.get("prefixItems")
+        items = schema.get("items")
+        if isinstance(items, list):
+            # draft 4 tuples
+            prefix_items, items = items, schema.get("additionalItems")
+        instance = [
+            generate_instance(subschema, rng, root, depth + 1)
+            for subschema in prefix_items or []
+        ]
+        min_items = schema.get("minItems", 0)
+        count = max(min_items - len(instance), 0)
+        if nested and items is not False:
+            count = max(count, min(1, schema.get("maxItems", 1)))
+        instance += [
+            generate_instance(items if items is not None else {}, rng, root, depth + 1)
+            for _ in range(count)
+        ]
+        return instance
+    if instance_type == "string":
+        return _generate_string(schema, rng)
+    if instance_type == "integer":
+        return _generate_number(schema, rng, integer=True)
+    if instance_type == "number":
+        return _generate_number(schema, rng, integer=False)
+    if instance_type == "boolean":
+        return rng.random() < 0.5
+    return None
+
+
+def _wrong_type_instance(schema: Schema) -> Optional[List[Any]]:
+    """Returns a value whose type the root of the schema does not allow, wrapped
+    in a list to tell a null value apart from none, or None if the root does not
+    constrain its type."""
+    types = schema.get("type") if isinstance(schema, dict) else None
+    if isinstance(types, str):
+        types = [types]
+    if not isinstance(types, list) or not types:
+        return None
+    for instance_type, value in TYPE_EXAMPLES.items():
+        if instance_type not in types:
+            return [value]
+    return None
+
+
+register_engine(MockEngine, MockConfig)
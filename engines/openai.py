@@ -1,11 +1,13 @@
 import os
-from time import time
-from dataclasses import dataclass
-from typing import Dict, Any, List, Optional
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, TYPE_CHECKING
 
 from core.registry import register_engine
+from core.profile import measure_phase, record_token_timestamps, timestamp
 from core.engine import Engine, EngineConfig
 from core.evaluator import is_json_schema_valid
+from core.retry import RetryConfig, RetryGovernor, TransientError, parse_retry_after
 from core.types import (
     Token,
     CompileStatus,
@@ -15,16 +17,33 @@ from core.types import (
     DecodingStatusCode,
 )
 
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from openai.types import CompletionUsage
+    from openai.types.chat import ChatCompletionChunk
+
+# statuses worth retrying besides the server errors, as for the OpenAI client
+RETRYABLE_STATUS_CODES = (408, 409, 429)
+# statuses of a request rejected for its content, e.g. an unsupported schema
+REJECTED_STATUS_CODES = (400, 422)
+
 
 @dataclass
 class OpenAIConfig(EngineConfig):
     model: str
     max_tokens: Optional[int] = None
     temperature: Optional[float] = None
+    # overrides the endpoint of the engine, e.g. a local server speaking the
+    # same API, see `tests/openai_stub.py`
+    base_url: Optional[str] = None
+    # rate limits, overloaded servers and dropped connections are retried
+    retry: RetryConfig = field(default_factory=RetryConfig)
 
 
 class OpenAIEngine(Engine[OpenAIConfig]):
     name = "openai"
+    supports_concurrency = True
+    supports_async = True
 
     def __init__(
         self,
@@ -37,59 +56,142 @@ class OpenAIEngine(Engine[OpenAIConfig]):
         from openai import OpenAI
         from tiktoken import encoding_for_model
 
-        self.client = OpenAI(
-            api_key=os.getenv(api_key_variable_name),
-            base_url=base_url,
-        )
+        self._client_kwargs = {
+            "api_key": os.getenv(api_key_variable_name),
+            "base_url": self.config.base_url or base_url,
+            # the retries are left to the governor, which honors `retry-after`
+            # across all the requests in flight
+            "max_retries": 0,
+        }
+        self.client = OpenAI(**self._client_kwargs)
+        # created on first use by `_agenerate`, see `_async_client`
+        self._async_client_instance: Optional["AsyncOpenAI"] = None
+        self._async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self.retry_governor = RetryGovernor(self.config.retry)
+        # the models of other providers and of the servers in `config.base_url`
+        # may have no tiktoken encoding, which is downloaded on first use
         self.tokenizer = (
-            encoding_for_model(self.config.model) if base_url is None else None
+            encoding_for_model(self.config.model)
+            if self._client_kwargs["base_url"] is None
+            else None
         )
 
     def _generate(self, output: GenerationOutput) -> None:
+        stream = StreamCollector()
+
+        def attempt() -> None:
+            stream.reset()
+            output.metadata.decoding_start_time = timestamp()
+            try:
+                response = self.client.chat.completions.create(**self._request(output))
+                for chunk in response:
+                    stream.add(chunk)
+            except Exception as e:
+                transient = transient_error(e)
+                if transient is None:
+                    raise
+                raise transient from e
+
         try:
-            response = self.client.chat.completions.create(
-                model=self.config.model,
-                messages=output.messages,
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {"schema": output.schema, "name": "json_schema"},
-                },
-                stream=True,
-                temperature=self.config.temperature,
-                max_tokens=self.config.max_tokens,
-                stream_options={"include_usage": True},
-            )
+            self.retry_governor.call(attempt, output, self.rate_limiter)
         except Exception as e:
-            output.metadata.compile_status = CompileStatus(
-                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
-            )
+            self._fail(output, stream, e)
             return
+        self._finish(output, stream)
 
-        tokens_str: List[str] = []
-        for i, chunk in enumerate(response):
-            if i == 0:
-                first_token_arrival_time = time()
+    async def _agenerate(self, output: GenerationOutput) -> None:
+        stream = StreamCollector()
 
-            if len(chunk.choices) == 0 or chunk.choices[0].finish_reason is not None:
-                continue
+        async def attempt() -> None:
+            stream.reset()
+            output.metadata.decoding_start_time = timestamp()
+            try:
+                response = await self._async_client().chat.completions.create(
+                    **self._request(output)
+                )
+                async for chunk in response:
+                    stream.add(chunk)
+            except Exception as e:
+                transient = transient_error(e)
+                if transient is None:
+                    raise
+                raise transient from e
 
-            chunk_content = chunk.choices[0].delta.content
-            if chunk_content == "":
-                continue
+        try:
+            await self.retry_governor.acall(attempt, output, self.rate_limiter)
+        except Exception as e:
+            self._fail(output, stream, e)
+            return
+        self._finish(output, stream)
+
+    def _async_client(self) -> "AsyncOpenAI":
+        """Returns the async client of the running event loop. The connections of
+        an async client belong to the loop that opened them, so a client is
+        created for each loop the engine is used from."""
+        from openai import AsyncOpenAI
+
+        loop = asyncio.get_running_loop()
+        if self._async_client_loop is not loop:
+            self._async_client_instance = AsyncOpenAI(**self._client_kwargs)
+            self._async_client_loop = loop
+        return self._async_client_instance
 
-            tokens_str.append(chunk_content)
+    def _request(self, output: GenerationOutput) -> Dict[str, Any]:
+        return dict(
+            model=self.config.model,
+            messages=output.messages,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"schema": output.schema, "name": "json_schema"},
+            },
+            stream=True,
+            temperature=self.config.temperature,
+            max_tokens=self.config.max_tokens,
+            stream_options={"include_usage": True},
+        )
+
+    def _fail(
+        self, output: GenerationOutput, stream: "StreamCollector", error: Exception
+    ) -> None:
+        """Records why a request failed, once it is not retried anymore. Only the
+        requests rejected for their content count as unsupported schemas."""
+        from openai import APIError, APIStatusError
+
+        if stream.first_token_arrival_time is not None:
+            # the schema was accepted, the stream broke or errored afterwards
+            output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+            output.metadata.decoding_status = DecodingStatus(
+                code=DecodingStatusCode.BAD_API_RESPONSE, message=str(error)
+            )
+        elif isinstance(error, TransientError) or (
+            isinstance(error, APIError)
+            and not (
+                isinstance(error, APIStatusError)
+                and error.status_code in REJECTED_STATUS_CODES
+            )
+        ):
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.API_BAD_RESPONSE, message=str(error)
+            )
+        else:
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(error)
+            )
 
-        output.token_usage.output_tokens = chunk.usage.completion_tokens
-        output.metadata.first_token_arrival_time = first_token_arrival_time
+    def _finish(self, output: GenerationOutput, stream: "StreamCollector") -> None:
+        if stream.usage is not None:
+            output.token_usage.input_tokens = stream.usage.prompt_tokens
+            output.token_usage.output_tokens = stream.usage.completion_tokens
+        output.metadata.first_token_arrival_time = stream.first_token_arrival_time
+        record_token_timestamps(output, stream.token_arrival_times)
         output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
         output.metadata.decoding_status = DecodingStatus(code=DecodingStatusCode.OK)
 
-        output.generation = "".join(tokens_str)
-        output.generated_tokens = [
-            Token(id=self.convert_token_to_id(token), text=token)
-            for token in tokens_str
-        ]
-        return
+        with measure_phase("post_processing", output):
+            output.generation = "".join(stream.tokens_str)
+            # the API only streams text, the ids are filled in by
+            # `materialize_tokens` once the output leaves the generation
+            output.generated_tokens = [Token(text=token) for token in stream.tokens_str]
 
     def adapt_schema(self, schema: Dict[str, Any]) -> Dict[str, Any]:
         recursively_set_additional_properties_false(schema)
@@ -99,10 +201,14 @@ class OpenAIEngine(Engine[OpenAIConfig]):
             print("The JSON schema after adaptation is no longer valid.")
         return schema
 
-    def encode(self, text: str) -> List[int]:
+    def encode(self, text: str) -> Optional[List[int]]:
+        if self.tokenizer is None:
+            return None
         return self.tokenizer.encode(text)
 
-    def decode(self, ids: List[int]) -> str:
+    def decode(self, ids: List[int]) -> Optional[str]:
+        if self.tokenizer is None:
+            return None
         return self.tokenizer.decode(ids)
 
     @property
@@ -114,6 +220,54 @@ class OpenAIEngine(Engine[OpenAIConfig]):
         return max_context_length_dict[self.config.model]
 
 
+class StreamCollector:
+    def __init__(self):
+        """Collects the chunks of a streamed chat completion as they arrive."""
+        self.reset()
+
+    def reset(self) -> None:
+        """Drops the chunks of a previous attempt of the request."""
+        self.tokens_str: List[str] = []
+        self.token_arrival_times: List[float] = []
+        self.first_token_arrival_time: Optional[float] = None
+        self.usage: Optional["CompletionUsage"] = None
+
+    def add(self, chunk: "ChatCompletionChunk") -> None:
+        if self.first_token_arrival_time is None:
+            self.first_token_arrival_time = timestamp()
+        # the usage comes with the last chunk, which has no choices
+        if chunk.usage is not None:
+            self.usage = chunk.usage
+
+        if len(chunk.choices) == 0 or chunk.choices[0].finish_reason is not None:
+            return
+
+        chunk_content = chunk.choices[0].delta.content
+        if chunk_content == "":
+            return
+
+        self.tokens_str.append(chunk_content)
+        self.token_arrival_times.append(timestamp())
+
+
+def transient_error(error: Exception) -> Optional[TransientError]:
+    """Wraps the error of a request in a `TransientError`, with the
+    `retry-after` of the response if any, if the request may succeed when
+    retried. Returns None for the other errors."""
+    from httpx import TransportError
+    from openai import APIConnectionError, APIStatusError
+
+    if isinstance(error, APIStatusError):
+        if error.status_code in RETRYABLE_STATUS_CODES or error.status_code >= 500:
+            return TransientError(error, parse_retry_after(error.response.headers))
+        return None
+    # connection errors include the timeouts, and a stream cut before its end
+    # surfaces as a transport error of httpx
+    if isinstance(error, (APIConnectionError, TransportError)):
+        return TransientError(error)
+    return None
+
+
 def add_root_type_if_missing(schema: dict):
     if "type" not in schema:
         schema["type"] = "object"
@@ -1,16 +1,19 @@
+import pickle
 import stopit
-from time import time
 from json import dumps
 from dataclasses import dataclass
 from typing import List, Optional, TYPE_CHECKING
 
+from core.messages import Message
 from core.registry import register_engine
+from core.profile import measure_phase, record_token_timestamps, timestamp
+from core.grammar_cache import GrammarCache, tokenizer_fingerprint
 from engines.llama_cpp import LlamaCppConfig
 from core.engine import Engine, EngineConfig
-from engines.llama_cpp import LlamaCppEngine
+from engines.llama_cpp import LlamaCppEngine, LlamaPrefixCache
+from engines.llama_cpp import read_generated_tokens, reused_prompt_tokens
 from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT, safe_min
 from core.types import (
-    Token,
     Schema,
     CompileStatus,
     DecodingStatus,
@@ -28,15 +31,18 @@ if TYPE_CHECKING:
 class OutlinesConfig(EngineConfig):
     model_engine_config: LlamaCppConfig
     grammar_cache_enabled: bool = False
+    # persist the compiled guides on disk across runs, see `core.grammar_cache`
+    grammar_disk_cache: bool = False
     max_tokens: Optional[int] = None
     hf_tokenizer_id: Optional[str] = None
 
 
 class OutlinesEngine(Engine[OutlinesConfig]):
     name = "outlines"
+    supports_compile_only = True
 
-    def __init__(self, config: OutlinesConfig):
-        super().__init__(config)
+    def __init__(self, config: OutlinesConfig, compile_only: bool = False):
+        super().__init__(config, compile_only)
 
         from llama_cpp.llama_tokenizer import LlamaHFTokenizer
         from outlines.models import llamacpp as outlines_llamacpp
@@ -52,6 +58,8 @@ class OutlinesEngine(Engine[OutlinesConfig]):
             tokenizer=tokenizer,
             n_ctx=self.config.model_engine_config.n_ctx,
             n_gpu_layers=self.config.model_engine_config.n_gpu_layers,
+            # the guides only need the vocabulary, not the weights
+            vocab_only=self.compile_only,
         )
 
         self.config.max_tokens = safe_min(
@@ -59,9 +67,36 @@ class OutlinesEngine(Engine[OutlinesConfig]):
         )
 
         self.formatter = LlamaCppEngine.get_chat_formatter(self.model.model)
+        # the prompts are tokenized with a BOS token, unlike in the llama.cpp
+        # engine, and with the Hugging Face tokenizer if there is one
+        self.prompt_cache_key = LlamaCppEngine.get_prompt_cache_key(
+            self.config.model_engine_config.model,
+            self.config.model_engine_config.filename,
+            add_bos=True,
+            hf_tokenizer_id=self.config.hf_tokenizer_id,
+        )
+
+        self.prefix_cache = None
+        if self.config.model_engine_config.prefix_cache and not self.compile_only:
+            # the prompt is passed as text, tokenized with a BOS token
+            self.prefix_cache = LlamaPrefixCache(
+                self.model.model,
+                self.formatter,
+                self.config.model_engine_config.prefix_cache_size,
+                add_bos=True,
+            )
+
+        if self.config.grammar_disk_cache:
+            from outlines import __version__
+
+            self.grammar_cache = GrammarCache(
+                self.name,
+                tokenizer_fingerprint(__version__, self.model.tokenizer.vocabulary),
+            )
 
     def _generate(self, output: GenerationOutput) -> None:
-        generator = self._compile_grammar(output.schema, output.metadata)
+        with measure_phase("compilation", output):
+            generator = self._compile_grammar(output.schema, output.metadata)
 
         if (
             output.metadata.compile_status.code != CompileStatusCode.OK
@@ -69,28 +104,42 @@ class OutlinesEngine(Engine[OutlinesConfig]):
         ):
             return
 
-        input = self.formatter(messages=output.messages)
-        output.token_usage.input_tokens = self.count_tokens(input)
+        prompt = self.prepare_prompt(output)
 
         try:
             with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
                 if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+                    output.metadata.decoding_start_time = timestamp()
+                    # restoring the prefix is part of the prefill
+                    if self.prefix_cache is not None:
+                        self.prefix_cache.restore(output.messages)
+                    output.metadata.cached_prompt_tokens = reused_prompt_tokens(
+                        self.model.model, prompt.token_ids
+                    )
+                    # outlines only takes text prompts, so the prompt is
+                    # tokenized again by llama.cpp
                     token_iterator = generator.stream(
-                        input,
+                        prompt.text,
                         temperature=self.config.model_engine_config.temperature,
                         max_tokens=safe_min(
                             self.config.model_engine_config.n_ctx
-                            - self.count_tokens(input),
+                            - output.token_usage.input_tokens,
                             self.config.max_tokens,
                         ),
                     )
 
                     tokens_str = []
+                    token_arrival_times = []
                     for i, token in enumerate(token_iterator):
+                        token_arrival_times.append(timestamp())
                         if i == 0:
-                            output.metadata.first_token_arrival_time = time()
+                            output.metadata.first_token_arrival_time = (
+                                token_arrival_times[0]
+                            )
                         tokens_str.append(token)
 
+                    record_token_timestamps(output, token_arrival_times)
+
                     output.metadata.decoding_status = DecodingStatus(
                         code=DecodingStatusCode.OK
                     )
@@ -108,17 +157,22 @@ class OutlinesEngine(Engine[OutlinesConfig]):
 
             return
 
-        generation = "".join(tokens_str)
-        output.token_usage.output_tokens = self.count_tokens(generation)
+        with measure_phase("post_processing", output):
+            generation = "".join(tokens_str)
 
-        output.generation = generation
-        output.generated_tokens = [
-            Token(id=self.convert_token_to_id(token), text=token)
-            for token in tokens_str
-        ]
+            output.generation = generation
+            # outlines generates with llama.cpp, whose context holds the tokens
+            output.generated_tokens = read_generated_tokens(
+                self.model.model, output.token_usage.input_tokens, generation
+            )
+            output.token_usage.output_tokens = len(output.generated_tokens)
 
         return
 
+    def _compile(self, output: GenerationOutput) -> None:
+        with measure_phase("compilation", output):
+            self._compile_grammar(output.schema, output.metadata)
+
     def _compile_grammar(
         self, schema: Schema, metadata: GenerationMetadata
     ) -> Optional["SequenceGeneratorAdapter"]:
@@ -128,7 +182,9 @@ class OutlinesEngine(Engine[OutlinesConfig]):
         try:
             with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
                 if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    if not self.config.grammar_cache_enabled:
+                    if self.grammar_cache is not None:
+                        generator = self._load_generator(schema, metadata)
+                    elif not self.config.grammar_cache_enabled:
                         with cache_disabled():
                             generator = outlines_json(
                                 self.model, schema_object=dumps(schema)
@@ -138,7 +194,7 @@ class OutlinesEngine(Engine[OutlinesConfig]):
                             self.model, schema_object=dumps(schema)
                         )
 
-                    metadata.grammar_compilation_end_time = time()
+                    metadata.grammar_compilation_end_time = timestamp()
                     metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
 
             if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
@@ -156,8 +212,44 @@ class OutlinesEngine(Engine[OutlinesConfig]):
 
         return generator
 
+    def _load_generator(
+        self, schema: Schema, metadata: GenerationMetadata
+    ) -> "SequenceGeneratorAdapter":
+        """Builds the generator from the guide stored in the disk cache, or
+        compiles the guide and stores it. The guide holds the index of the
+        regular expression of the schema, which is what takes time to build.
+        The size of the pickled guide is recorded as the size of the grammar."""
+        from outlines.samplers import multinomial
+        from outlines.processors import GuideLogitsProcessor
+        from outlines.generate import json as outlines_json
+        from outlines.generate.api import SequenceGeneratorAdapter
+
+        data = self.grammar_cache.get(schema)
+        metadata.grammar_cache_hit = data is not None
+        if data is not None:
+            metadata.grammar_size = len(data)
+            logits_processor = GuideLogitsProcessor(
+                tokenizer=self.model.tokenizer, guide=pickle.loads(data)
+            )
+            return SequenceGeneratorAdapter(self.model, logits_processor, multinomial())
+
+        generator = outlines_json(self.model, schema_object=dumps(schema))
+        data = pickle.dumps(
+            generator.logits_processor.guide, protocol=pickle.HIGHEST_PROTOCOL
+        )
+        metadata.grammar_size = len(data)
+        self.grammar_cache.put(schema, data)
+        return generator
+
+    def render_prompt(self, messages: List[Message]) -> str:
+        return self.formatter(messages=messages)
+
+    def tokenize_prompt(self, prompt: str) -> List[int]:
+        # as llama.cpp tokenizes the text prompts, with a BOS token
+        return self.model.model.tokenize(prompt.encode("utf-8"), special=True)
+
     def encode(self, text: str) -> List[int]:
-        return self.model.model.tokenizer().encode(text)
+        return self.model.model.tokenizer().encode(text, add_bos=False)
 
     def decode(self, ids: List[int]) -> str:
         return self.model.model.tokenizer().decode(ids)
@@ -1,13 +1,20 @@
-import os
 import torch
 import stopit
-from time import time
 from json import dumps
 from dataclasses import dataclass
 from transformers.generation import LogitsProcessor
-from typing import List, Optional, TYPE_CHECKING, Dict, Any
+from typing import List, Optional, TYPE_CHECKING
 
 from core.registry import register_engine
+from core.profile import measure_phase, record_token_timestamps, timestamp
+from core.messages import Message
+from engines.huggingface import decode_batch, eos_token_ids, pad_prompts
+from core.grammar_cache import GrammarCache, tokenizer_fingerprint
+from core.compile_pool import (
+    CompileResultStatus,
+    CompileWorkerPool,
+    record_compile_phases,
+)
 from core.engine import Engine, EngineConfig
 from core.utils import COMPILATION_TIMEOUT, GENERATION_TIMEOUT
 from core.types import (
@@ -18,9 +25,9 @@ from core.types import (
     DecodingStatusCode,
 )
 
-
 if TYPE_CHECKING:
-    from xgrammar import GrammarCompiler
+    from transformers.generation import GenerationConfig
+    from xgrammar import CompiledGrammar, GrammarCompiler
 
 
 class TimingLogitsProcessor(LogitsProcessor):
@@ -31,7 +38,7 @@ class TimingLogitsProcessor(LogitsProcessor):
         self.timestamps = []
 
     def __call__(self, _, scores):
-        self.timestamps.append(time())
+        self.timestamps.append(timestamp())
         return scores
 
 
@@ -41,113 +48,91 @@ class XGrammarConfig(EngineConfig):
     temperature: float = 0
     max_tokens: Optional[int] = 4096
     grammar_cache_enabled: bool = False
+    # persist the compiled grammars on disk across runs, see `core.grammar_cache`
+    grammar_disk_cache: bool = False
+    # number of processes compiling grammars, see `core.compile_pool`
+    compile_workers: int = 1
 
 
 class XGrammarEngine(Engine[XGrammarConfig]):
     name = "xgrammar"
+    supports_batching = True
+    supports_compile_only = True
 
-    def __init__(self, config: XGrammarConfig):
-        super().__init__(config)
+    def __init__(self, config: XGrammarConfig, compile_only: bool = False):
+        super().__init__(config, compile_only)
         add_environment_variables()
 
-        from xgrammar import TokenizerInfo, GrammarCompiler
-        from transformers import AutoModelForCausalLM, AutoTokenizer
+        from xgrammar import TokenizerInfo, __version__
+        from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
 
         self.tokenizer = AutoTokenizer.from_pretrained(self.config.model)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            self.config.model, torch_dtype=torch.bfloat16
-        ).to(get_best_device())
+        if self.compile_only:
+            # the grammars only need the vocabulary size, not the weights
+            self.model = None
+            vocab_size = AutoConfig.from_pretrained(self.config.model).vocab_size
+        else:
+            self.model = AutoModelForCausalLM.from_pretrained(
+                self.config.model, torch_dtype=torch.bfloat16
+            ).to(get_best_device())
+            vocab_size = self.model.config.vocab_size
         self.tokenizer.pad_token = self.tokenizer.eos_token
+        # batched generation appends the new tokens after the prompts
+        self.tokenizer.padding_side = "left"
+        # shared with the Hugging Face engine running the same model
+        self.prompt_cache_key = f"huggingface:{self.config.model}"
 
-        tokenizer_info = TokenizerInfo.from_huggingface(
-            self.tokenizer, vocab_size=self.model.config.vocab_size
+        self.tokenizer_info = TokenizerInfo.from_huggingface(
+            self.tokenizer, vocab_size=vocab_size
         )
-        self.grammar_compiler = GrammarCompiler(
-            tokenizer_info, cache_enabled=self.config.grammar_cache_enabled
+        # grammars are compiled in a separate process, since some schemas crash
+        # the compiler, and sent back serialized
+        self.compile_pool = CompileWorkerPool(
+            _init_compile_worker,
+            (self.config.model, vocab_size, self.config.grammar_cache_enabled),
+            _compile_json_schema,
+            num_workers=self.config.compile_workers,
         )
 
+        if self.config.grammar_disk_cache:
+            self.grammar_cache = GrammarCache(
+                self.name,
+                tokenizer_fingerprint(
+                    __version__,
+                    self.tokenizer.get_vocab(),
+                    vocab_size,
+                ),
+            )
+
     def _generate(self, output: GenerationOutput) -> None:
-        from transformers.generation import GenerationConfig
         from xgrammar.contrib.hf import LogitsProcessor as XGrammarLogitsProcessor
 
         timing_processor = TimingLogitsProcessor()
-        logits_processors = [timing_processor]
+        # records when the grammar mask is applied, right after the timing
+        # processor, to measure the time spent computing it
+        mask_timing_processor = TimingLogitsProcessor()
 
-        try:
-            json_schema_str = dumps(output.schema)
-
-            seg_fault_check = self._check_grammar_safety(
-                self.grammar_compiler, json_schema_str, COMPILATION_TIMEOUT
-            )
-            if not seg_fault_check["success"]:
-                if "exit_code" in seg_fault_check and seg_fault_check["exit_code"] == 2:
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.UNSUPPORTED_SCHEMA,
-                        message="Grammar compilation timed out",
-                    )
-                    return
-                else:
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.UNSUPPORTED_SCHEMA,
-                        message=seg_fault_check.get(
-                            "error",
-                            f"Unknown error with exit code {seg_fault_check.get('exit_code', 'unknown')}",
-                        ),
-                    )
-                    return
-
-            with stopit.ThreadingTimeout(COMPILATION_TIMEOUT) as to_ctx_mgr:
-                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
-                    compiled_grammar = self.grammar_compiler.compile_json_schema(
-                        json_schema_str
-                    )
-
-                    output.metadata.grammar_compilation_end_time = time()
-                    output.metadata.compile_status = CompileStatus(
-                        code=CompileStatusCode.OK
-                    )
-                    logits_processors.append(XGrammarLogitsProcessor(compiled_grammar))
-
-            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
-                output.metadata.compile_status = CompileStatus(
-                    code=CompileStatusCode.COMPILE_TIMEOUT,
-                    message="Grammar compilation timed out",
-                )
-                return
-
-        except Exception as e:
-            output.metadata.compile_status = CompileStatus(
-                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
-            )
+        compiled_grammar = self._compile_grammar(output)
+        if compiled_grammar is None:
             return
+        logits_processors = [
+            timing_processor,
+            XGrammarLogitsProcessor(compiled_grammar),
+            mask_timing_processor,
+        ]
 
-        input = self.tokenizer.apply_chat_template(
-            output.messages, tokenize=False, add_generation_prompt=True
-        )
-
-        model_input = self.tokenizer(
-            input,
-            return_tensors="pt",
-            add_special_tokens=False,
-            padding=True,
-            truncation=True,
-        ).to("cuda")
+        prompt = self.prepare_prompt(output)
+        model_input = pad_prompts(self.tokenizer, [prompt]).to(self.model.device)
 
         input_length = model_input["input_ids"].shape[1]
 
         try:
             with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
                 if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+                    output.metadata.decoding_start_time = timestamp()
                     model_output = self.model.generate(
                         model_input["input_ids"],
-                        generation_config=GenerationConfig(
-                            max_new_tokens=self.config.max_tokens,
-                            temperature=self.config.temperature
-                            if self.config.temperature > 0
-                            else None,
-                            do_sample=self.config.temperature > 0,
-                            pad_token_id=self.tokenizer.eos_token_id,
-                        ),
+                        generation_config=self._generation_config(),
                         attention_mask=model_input["attention_mask"],
                         tokenizer=self.tokenizer,
                         logits_processor=logits_processors,
@@ -174,51 +159,193 @@ class XGrammarEngine(Engine[XGrammarConfig]):
             )
             return
 
-        generated_sequences = model_output[:, input_length:]
-        generated_texts = self.tokenizer.batch_decode(
-            generated_sequences, skip_special_tokens=True
+        if timing_processor.timestamps:
+            output.metadata.first_token_arrival_time = timing_processor.timestamps[0]
+        record_token_timestamps(
+            output, timing_processor.timestamps, mask_timing_processor.timestamps
         )
 
-        output_text = generated_texts[0] if generated_texts else ""
+        with measure_phase("post_processing", output):
+            generated_sequences = model_output[:, input_length:]
+            generated_texts = self.tokenizer.batch_decode(
+                generated_sequences, skip_special_tokens=True
+            )
 
-        if timing_processor.timestamps:
-            output.metadata.first_token_arrival_time = timing_processor.timestamps[0]
+            output_text = generated_texts[0] if generated_texts else ""
 
-        output.generation = output_text
-        output.token_usage.output_tokens = self.count_tokens(output_text)
+            output.generation = output_text
+            output.token_usage.output_tokens = self.count_tokens(output_text)
 
         return
 
-    def _check_grammar_safety(
-        self, grammar_compiler: "GrammarCompiler", schema_str: str, timeout: int
-    ) -> Dict[str, Any]:
-        def child_process():
-            import signal
-
-            signal.signal(signal.SIGALRM, lambda _, __: os._exit(2))
-            signal.alarm(timeout)
-            try:
-                grammar_compiler.compile_json_schema(schema_str)
-                os._exit(0)
-            except Exception:
-                os._exit(1)
-
-        id = os.fork()
-        if id == 0:
-            child_process()
-        else:
-            _, status = os.waitpid(id, 0)
-            if os.WIFEXITED(status):
-                exit_code = os.WEXITSTATUS(status)
-                return {"success": exit_code == 0, "exit_code": exit_code}
-            elif os.WIFSIGNALED(status):
-                signal_num = os.WTERMSIG(status)
-                return {
-                    "success": False,
-                    "error": f"Process terminated by signal {signal_num}",
-                    "exit_code": -signal_num,
-                }
-            return {"success": False, "error": "Unknown status"}
+    def _generate_batch(self, outputs: List[GenerationOutput]) -> None:
+        from xgrammar.contrib.hf import LogitsProcessor as XGrammarLogitsProcessor
+
+        # the grammars are compiled one after the other, and the samples whose
+        # grammar cannot be compiled are left out of the batch
+        compiled_outputs = []
+        compiled_grammars = []
+        for output in outputs:
+            output.metadata.grammar_compilation_start_time = timestamp()
+            compiled_grammar = self._compile_grammar(output)
+            if compiled_grammar is not None:
+                compiled_outputs.append(output)
+                compiled_grammars.append(compiled_grammar)
+
+        if not compiled_outputs:
+            return
+
+        timing_processor = TimingLogitsProcessor()
+        mask_timing_processor = TimingLogitsProcessor()
+        # one grammar matcher per sequence of the batch
+        logits_processors = [
+            timing_processor,
+            XGrammarLogitsProcessor(compiled_grammars),
+            mask_timing_processor,
+        ]
+
+        prompts = [self.prepare_prompt(output) for output in compiled_outputs]
+        model_input = pad_prompts(self.tokenizer, prompts).to(self.model.device)
+
+        input_length = model_input["input_ids"].shape[1]
+
+        try:
+            with stopit.ThreadingTimeout(GENERATION_TIMEOUT) as to_ctx_mgr:
+                if to_ctx_mgr.state == to_ctx_mgr.EXECUTING:
+                    decoding_start_time = timestamp()
+                    for output in compiled_outputs:
+                        output.metadata.decoding_start_time = decoding_start_time
+                    model_output = self.model.generate(
+                        model_input["input_ids"],
+                        generation_config=self._generation_config(),
+                        attention_mask=model_input["attention_mask"],
+                        tokenizer=self.tokenizer,
+                        logits_processor=logits_processors,
+                    )
+                    for output in compiled_outputs:
+                        output.metadata.decoding_status = DecodingStatus(
+                            code=DecodingStatusCode.OK
+                        )
+
+            if to_ctx_mgr.state == to_ctx_mgr.TIMED_OUT:
+                for output in compiled_outputs:
+                    output.metadata.decoding_status = DecodingStatus(
+                        code=DecodingStatusCode.DECODING_TIMEOUT,
+                        message="Generation timed out",
+                    )
+                return
+
+        except Exception as e:
+            for output in compiled_outputs:
+                output.metadata.decoding_status = DecodingStatus(
+                    code=DecodingStatusCode.UNKOWN_ERROR, message=str(e)
+                )
+            return
+
+        with measure_phase("post_processing", *compiled_outputs):
+            output_texts = decode_batch(
+                self.tokenizer,
+                eos_token_ids(self.model, self.tokenizer),
+                compiled_outputs,
+                model_output[:, input_length:],
+                timing_processor.timestamps,
+                mask_timing_processor.timestamps,
+            )
+
+            for output, output_text in zip(compiled_outputs, output_texts):
+                output.generation = output_text
+                output.token_usage.output_tokens = self.count_tokens(output_text)
+
+    def _generation_config(self) -> "GenerationConfig":
+        from transformers.generation import GenerationConfig
+
+        return GenerationConfig(
+            max_new_tokens=self.config.max_tokens,
+            temperature=(
+                self.config.temperature if self.config.temperature > 0 else None
+            ),
+            do_sample=self.config.temperature > 0,
+            pad_token_id=self.tokenizer.eos_token_id,
+        )
+
+    def _compile(self, output: GenerationOutput) -> None:
+        self._compile_grammar(output)
+
+    def _compile_grammar(self, output: GenerationOutput) -> Optional["CompiledGrammar"]:
+        """Compiles the grammar of the schema of an output in the compile worker
+        pool, and sets its compile status. Returns None if the grammar could not
+        be compiled."""
+        from xgrammar import CompiledGrammar
+
+        if self.grammar_cache is not None:
+            compiled_grammar = self._load_cached_grammar(output)
+            if compiled_grammar is not None:
+                return compiled_grammar
+
+        compilation_start_time = timestamp()
+        result = self.compile_pool.compile(dumps(output.schema), COMPILATION_TIMEOUT)
+        record_compile_phases(output, result, timestamp() - compilation_start_time)
+        if result.status == CompileResultStatus.TIMEOUT:
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.COMPILE_TIMEOUT, message=result.message
+            )
+            return None
+        if result.status != CompileResultStatus.OK:
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=result.message
+            )
+            return None
+
+        try:
+            compiled_grammar = CompiledGrammar.deserialize_json(
+                result.artifact, self.tokenizer_info
+            )
+        except Exception as e:
+            output.metadata.compile_status = CompileStatus(
+                code=CompileStatusCode.UNSUPPORTED_SCHEMA, message=str(e)
+            )
+            return None
+
+        output.metadata.grammar_compilation_end_time = timestamp()
+        output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+        output.metadata.grammar_size = compiled_grammar.memory_size_bytes
+
+        if self.grammar_cache is not None:
+            self.grammar_cache.put(output.schema, result.artifact.encode("utf-8"))
+
+        return compiled_grammar
+
+    def _load_cached_grammar(
+        self, output: GenerationOutput
+    ) -> Optional["CompiledGrammar"]:
+        from xgrammar import CompiledGrammar
+
+        data = self.grammar_cache.get(output.schema)
+        output.metadata.grammar_cache_hit = False
+        if data is None:
+            return None
+
+        try:
+            compiled_grammar = CompiledGrammar.deserialize_json(
+                data.decode("utf-8"), self.tokenizer_info
+            )
+        except Exception:
+            # written by an incompatible version, compiled again and overwritten
+            return None
+
+        output.metadata.grammar_cache_hit = True
+        output.metadata.grammar_compilation_end_time = timestamp()
+        output.metadata.compile_status = CompileStatus(code=CompileStatusCode.OK)
+        output.metadata.grammar_size = compiled_grammar.memory_size_bytes
+        return compiled_grammar
+
+    def render_prompt(self, messages: List[Message]) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=True
+        )
+
+    def tokenize_prompt(self, prompt: str) -> List[int]:
+        return self.tokenizer.encode(prompt, add_special_tokens=False, truncation=True)
 
     def encode(self, text: str) -> List[int]:
         return self.tokenizer.encode(text, add_special_tokens=False)
@@ -230,6 +357,25 @@ class XGrammarEngine(Engine[XGrammarConfig]):
     def max_context_length(self) -> int:
         return self.tokenizer.model_max_length
 
+    def close(self) -> None:
+        self.compile_pool.close()
+
+
+def _init_compile_worker(
+    model: str, vocab_size: int, cache_enabled: bool
+) -> "GrammarCompiler":
+    from xgrammar import TokenizerInfo, GrammarCompiler
+    from transformers import AutoTokenizer
+
+    tokenizer_info = TokenizerInfo.from_huggingface(
+        AutoTokenizer.from_pretrained(model), vocab_size=vocab_size
+    )
+    return GrammarCompiler(tokenizer_info, cache_enabled=cache_enabled)
+
+
+def _compile_json_schema(grammar_compiler: "GrammarCompiler", schema_str: str) -> str:
+    return grammar_compiler.compile_json_schema(schema_str).serialize_json()
+
 
 def add_environment_variables():
     import os
@@ -1,7 +1,9 @@
 import os
-from core.bench import bench
+from core.bench import bench, bench_compilation
 from argparse import ArgumentParser
+from core.outputs import FlushPolicy
 from core.dataset import DATASET_NAMES
+from core.scheduler import SchedulerConfig
 from core.utils import load_config, disable_print
 from core.registry import ENGINE_TO_CLASS, ENGINE_TO_CONFIG
 
@@ -16,7 +18,24 @@ if __name__ == "__main__":
         "--tasks", type=str, required=True, choices=DATASET_NAMES, nargs="+"
     )
     parser.add_argument("--limit", type=int, required=False)
+    parser.add_argument(
+        "--snapshot_dir", type=str, default=os.getenv("JSB_SNAPSHOT_DIR")
+    )
     parser.add_argument("--save_outputs", action="store_true")
+    parser.add_argument(
+        "--flush_policy",
+        type=str,
+        default=FlushPolicy.FLUSH.value,
+        choices=[policy.value for policy in FlushPolicy],
+    )
+    parser.add_argument("--save_columnar", action="store_true")
+    parser.add_argument("--resume", type=str, required=False)
+    parser.add_argument("--max_in_flight", type=int, default=1)
+    parser.add_argument("--requests_per_minute", type=int, required=False)
+    parser.add_argument("--tokens_per_minute", type=int, required=False)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--compile_only", action="store_true")
+    parser.add_argument("--asynchronous", action="store_true")
     args = parser.parse_args()
 
     tasks = args.tasks
@@ -26,15 +45,48 @@ if __name__ == "__main__":
     if args.config is None:
         args.config = os.path.join("tests/configs", f"{args.engine}.yaml")
 
-    with disable_print():
-        engine = ENGINE_TO_CLASS[args.engine](
-            load_config(ENGINE_TO_CONFIG[args.engine], args.config)
+    engine_class = ENGINE_TO_CLASS[args.engine]
+    config = load_config(ENGINE_TO_CONFIG[args.engine], args.config)
+
+    if args.compile_only:
+        if not engine_class.supports_compile_only:
+            raise ValueError(f"Engine {args.engine} does not support compile-only mode")
+
+        # one compile worker per schema compiled at once
+        if hasattr(config, "compile_workers"):
+            config.compile_workers = max(config.compile_workers, args.max_in_flight)
+        with disable_print():
+            engine = engine_class(config, compile_only=True)
+
+        bench_compilation(
+            engine=engine,
+            tasks=tasks,
+            limit=args.limit,
+            close_engine=True,
+            max_in_flight=args.max_in_flight,
+            retain_outputs=False,
+            snapshot_dir=args.snapshot_dir,
         )
+    else:
+        with disable_print():
+            engine = engine_class(config)
 
-    bench(
-        engine=engine,
-        tasks=tasks,
-        limit=args.limit,
-        save_outputs=args.save_outputs,
-        close_engine=True,
-    )
+        bench(
+            engine=engine,
+            tasks=tasks,
+            limit=args.limit,
+            save_outputs=args.save_outputs,
+            flush_policy=FlushPolicy(args.flush_policy),
+            retain_outputs=False,
+            resume_from=args.resume,
+            save_columnar=args.save_columnar,
+            snapshot_dir=args.snapshot_dir,
+            close_engine=True,
+            scheduler_config=SchedulerConfig(
+                max_in_flight=args.max_in_flight,
+                requests_per_minute=args.requests_per_minute,
+                tokens_per_minute=args.tokens_per_minute,
+            ),
+            batch_size=args.batch_size,
+            asynchronous=args.asynchronous,
+        )
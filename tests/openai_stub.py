@@ -0,0 +1,278 @@
+import math
+from time import sleep, time
+from random import Random
+from json import dumps, loads
+from threading import Lock, Thread
+from argparse import ArgumentParser
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from core.utils import load_config, nanoid, schema_hash
+from engines.mock import LatencyDistribution, generate_instance
+
+
+@dataclass
+class OpenAIStubConfig:
+    seed: int = 0
+    prefill_latency: LatencyDistribution = field(default_factory=LatencyDistribution)
+    token_latency: LatencyDistribution = field(default_factory=LatencyDistribution)
+    chars_per_token: int = 4
+    # fraction of the requests rejected with a 400, as for an unsupported schema
+    bad_request_rate: float = 0.0
+    # fraction of the requests rejected with a 429 and a `retry-after` header
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    # fraction of the requests that fail with `error_status`
+    error_rate: float = 0.0
+    error_status: int = 500
+    # fraction of the streams cut before their end
+    disconnect_rate: float = 0.0
+
+
+class OpenAIStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self, config: OpenAIStubConfig, host: str = "127.0.0.1", port: int = 0
+    ):
+        """Local stand-in for the OpenAI chat completions API, to profile and
+        test `OpenAIEngine` offline. It answers with an instance of the schema of
+        the `json_schema` response format, streamed in chunks of
+        `chars_per_token` characters, after the configured latencies. The
+        content only depends on the seed, the messages and the schema, while the
+        injected errors are drawn for each request, so that a retried request
+        can succeed.
+
+        :param config: OpenAIStubConfig
+            The latencies and the error rates of the server.
+        :param host: str
+            The host to listen on.
+        :param port: int
+            The port to listen on, any free port if 0.
+        """
+        super().__init__((host, port), _OpenAIStubHandler)
+        self.config = config
+
+        self._lock = Lock()
+        self._rng = Random(config.seed)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def start(self) -> Thread:
+        """Serves the requests in a background thread, until `shutdown`."""
+        thread = Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class _OpenAIStubHandler(BaseHTTPRequestHandler):
+    # keeps the connections alive like the API, the streams are chunked
+    protocol_version = "HTTP/1.1"
+    server: OpenAIStubServer
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        try:
+            self._handle_post()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, e.g. after a timeout
+            self.close_connection = True
+        except Exception as e:
+            # a failure of the stub itself, e.g. a schema it cannot generate an
+            # instance of, is answered like an error of the API
+            self._send_error(500, "server_error", f"{type(e).__name__}: {e}")
+
+    def _handle_post(self) -> None:
+        body = loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_error(404, "not_found", f"Unknown path: {self.path}")
+            return
+
+        config = self.server.config
+        draw = self.server.random()
+        if draw < config.bad_request_rate:
+            self._send_error(
+                400, "invalid_request_error", "Invalid schema for response_format"
+            )
+            return
+        draw -= config.bad_request_rate
+        if draw < config.rate_limit_rate:
+            self._send_error(
+                429,
+                "rate_limit_exceeded",
+                "Rate limit reached",
+                {"retry-after": f"{config.retry_after:g}"},
+            )
+            return
+        draw -= config.rate_limit_rate
+        if draw < config.error_rate:
+            self._send_error(config.error_status, "server_error", "Injected error")
+            return
+
+        messages = body.get("messages", [])
+        schema = _response_schema(body)
+        rng = Random(f"{config.seed}:{schema_hash(messages)}:{schema_hash(schema)}")
+        content = dumps(generate_instance(schema, rng))
+        tokens = [
+            content[i : i + config.chars_per_token]
+            for i in range(0, len(content), config.chars_per_token)
+        ]
+        if body.get("max_tokens") is not None:
+            tokens = tokens[: body["max_tokens"]]
+        usage = {
+            "prompt_tokens": math.ceil(
+                sum(len(str(m.get("content", ""))) for m in messages)
+                / config.chars_per_token
+            ),
+            "completion_tokens": len(tokens),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if body.get("stream"):
+            self._stream(body, tokens, usage, rng)
+        else:
+            _sleep(config.prefill_latency.sample(rng))
+            for _ in tokens:
+                _sleep(config.token_latency.sample(rng))
+            self._send_json(
+                200,
+                {
+                    **_completion(body, "chat.completion"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": "".join(tokens),
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+
+    def _stream(
+        self,
+        body: Dict[str, Any],
+        tokens: List[str],
+        usage: Dict[str, int],
+        rng: Random,
+    ) -> None:
+        config = self.server.config
+        # the stream is cut after a random number of tokens
+        disconnect_at = (
+            rng.randrange(len(tokens) + 1)
+            if self.server.random() < config.disconnect_rate
+            else None
+        )
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        chunk = _completion(body, "chat.completion.chunk")
+
+        def send(choices: List[Dict[str, Any]], **fields: Any) -> None:
+            self._send_chunk(f"data: {dumps({**chunk, 'choices': choices, **fields})}")
+
+        _sleep(config.prefill_latency.sample(rng))
+        send([_choice({"role": "assistant", "content": ""})])
+        for i, token in enumerate(tokens):
+            if i == disconnect_at:
+                self.close_connection = True
+                return
+            _sleep(config.token_latency.sample(rng))
+            send([_choice({"content": token})])
+        if disconnect_at == len(tokens):
+            self.close_connection = True
+            return
+
+        send([_choice({}, "stop")])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send([], usage=usage)
+        self._send_chunk("data: [DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_chunk(self, event: str) -> None:
+        data = f"{event}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(
+        self, status: int, body: Any, headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        data = dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(
+        self,
+        status: int,
+        error_type: str,
+        message: str,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self._send_json(
+            status,
+            {"error": {"message": message, "type": error_type, "code": error_type}},
+            headers,
+        )
+
+
+def _response_schema(body: Dict[str, Any]) -> Any:
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return response_format.get("json_schema", {}).get("schema", {})
+    return {"type": "object"}
+
+
+def _completion(body: Dict[str, Any], object_type: str) -> Dict[str, Any]:
+    return {
+        "id": f"chatcmpl-{nanoid()}",
+        "object": object_type,
+        "created": int(time()),
+        "model": body.get("model", "stub"),
+    }
+
+
+def _choice(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> Dict:
+    return {"index": 0, "delta": delta, "finish_reason": finish_reason}
+
+
+def _sleep(duration: float) -> None:
+    if duration > 0:
+        sleep(duration)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--config", type=str, default=None)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    config = (
+        load_config(OpenAIStubConfig, args.config)
+        if args.config is not None
+        else OpenAIStubConfig()
+    )
+    server = OpenAIStubServer(config, args.host, args.port)
+    print(f"Serving the OpenAI API stub on {server.base_url}")
+    server.serve_forever()
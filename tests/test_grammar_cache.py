@@ -0,0 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from core.grammar_cache import GrammarCache
+
+SCHEMA = {"type": "object"}
+
+
+def test_overwritten_grammar_is_counted_once(tmp_path):
+    cache = GrammarCache("engine", "fingerprint", directory=str(tmp_path))
+    cache.put(SCHEMA, b"a" * 10)
+    cache.put(SCHEMA, b"b" * 20)
+    assert cache.info().size == 20
+    assert cache.get(SCHEMA) == b"b" * 20
+
+
+def test_concurrent_puts_of_the_same_grammar(tmp_path):
+    cache = GrammarCache("engine", "fingerprint", directory=str(tmp_path))
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: cache.put(SCHEMA, b"a" * 10), range(64)))
+
+    assert cache.get(SCHEMA) == b"a" * 10
+    assert cache.info().size == 10
+    assert not list(tmp_path.rglob("*.tmp"))
@@ -0,0 +1,51 @@
+import pytest
+
+llama_cpp = pytest.importorskip("llama_cpp")
+
+import engines.llama_cpp
+from engines.llama_cpp import LlamaCppConfig, LlamaCppEngine
+
+
+class _VocabOnlyLlama:
+    """Stands in for a model loaded with `vocab_only`, which never generates."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        # created by llama-cpp-python on the first generation only
+        self._sampler = None
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class _CompilePool:
+    def __init__(self, *args, **kwargs):
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_compile_only_engine_closes(monkeypatch):
+    models = []
+
+    def from_pretrained(**kwargs):
+        models.append(_VocabOnlyLlama(**kwargs))
+        return models[-1]
+
+    monkeypatch.setattr(llama_cpp.Llama, "from_pretrained", from_pretrained)
+    monkeypatch.setattr(engines.llama_cpp, "CompileWorkerPool", _CompilePool)
+    monkeypatch.setattr(
+        LlamaCppEngine, "get_chat_formatter", staticmethod(lambda model: None)
+    )
+
+    engine = LlamaCppEngine(
+        LlamaCppConfig(model="model", filename="*.gguf"), compile_only=True
+    )
+    [model] = models
+    assert model.kwargs["vocab_only"]
+
+    engine.close()
+    assert model.closed
+    assert engine.compile_pool.closed
@@ -0,0 +1,107 @@
+from random import Random
+
+import engines.mock
+from core.types import DecodingStatusCode
+from core.evaluator import validate_json_schema
+from engines.mock import MAX_INSTANCE_DEPTH, MockConfig, MockEngine, generate_instance
+
+LINKED_LIST_SCHEMA = {
+    "$defs": {
+        "node": {
+            "type": ["object", "null"],
+            "properties": {"next": {"$ref": "#/$defs/node"}},
+            "required": ["next"],
+        }
+    },
+    "$ref": "#/$defs/node",
+}
+
+
+def _depth(instance) -> int:
+    """Number of nested containers, i.e. objects and arrays, of an instance."""
+    if isinstance(instance, dict):
+        return 1 + max((_depth(v) for v in instance.values()), default=0)
+    if isinstance(instance, list):
+        return 1 + max((_depth(v) for v in instance), default=0)
+    return 0
+
+
+def test_generate_instance_is_deterministic():
+    schema = {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "age": {"type": "integer", "minimum": 0, "maximum": 120},
+            "tags": {"type": "array", "items": {"enum": ["a", "b", "c"]}},
+        },
+    }
+    assert generate_instance(schema, Random(0)) == generate_instance(schema, Random(0))
+
+
+def test_generate_instance_follows_constraints():
+    schema = {
+        "type": "object",
+        "properties": {
+            "id": {"type": "integer", "minimum": 10, "maximum": 20},
+            "kind": {"const": "user"},
+            "role": {"enum": ["admin", "guest"]},
+            "email": {"type": "string", "format": "email"},
+            "code": {"type": "string", "minLength": 12, "maxLength": 12},
+            "items": {"type": "array", "items": {"type": "number"}, "minItems": 3},
+        },
+        "required": ["id", "kind"],
+    }
+    instance = generate_instance(schema, Random(0))
+    assert validate_json_schema(instance, schema)
+    assert instance["kind"] == "user"
+    assert len(instance["items"]) >= 3
+
+
+def test_generate_instance_resolves_references():
+    schema = {
+        "$defs": {"point": {"type": "object", "required": ["x", "y"]}},
+        "type": "object",
+        "properties": {"origin": {"$ref": "#/$defs/point"}},
+        "required": ["origin"],
+    }
+    instance = generate_instance(schema, Random(0))
+    assert set(instance["origin"]) == {"x", "y"}
+
+
+def test_generate_instance_bounds_required_recursion_with_null():
+    instance = generate_instance(LINKED_LIST_SCHEMA, Random(0))
+    assert validate_json_schema(instance, LINKED_LIST_SCHEMA)
+    # the containers up to the limit and an empty one past it
+    assert _depth(instance) <= MAX_INSTANCE_DEPTH + 2
+
+
+def test_generate_instance_bounds_required_recursion_without_null():
+    schema = {
+        "type": "object",
+        "properties": {
+            "children": {"type": "array", "items": {"$ref": "#"}, "minItems": 1}
+        },
+        "required": ["children"],
+    }
+    instance = generate_instance(schema, Random(0))
+    assert isinstance(instance, dict)
+    # the containers up to the limit and an empty one past it
+    assert _depth(instance) <= MAX_INSTANCE_DEPTH + 2
+
+
+def test_generate_instance_bounds_recursive_unions():
+    assert generate_instance({"anyOf": [{"$ref": "#"}]}, Random(0)) is None
+    schema = {"allOf": [{"$ref": "#"}], "type": "object"}
+    assert generate_instance(schema, Random(0)) == {}
+
+
+def test_generation_errors_are_decoding_failures(monkeypatch):
+    def fail(*args, **kwargs):
+        raise RecursionError("maximum recursion depth exceeded")
+
+    monkeypatch.setattr(engines.mock, "generate_instance", fail)
+    output = MockEngine(MockConfig()).generate(
+        "test", [{"role": "user", "content": "test"}], {"type": "object"}
+    )
+    assert output.metadata.decoding_status.code == DecodingStatusCode.UNKOWN_ERROR
+    assert output.generation == ""
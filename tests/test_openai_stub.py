@@ -0,0 +1,96 @@
+from json import dumps, loads
+from hashlib import sha256
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+import core.dataset
+import tests.openai_stub
+from core.bench import bench
+from core.types import CompileStatusCode, DecodingStatusCode
+from engines.openai import OpenAIConfig, OpenAIEngine
+from tests.openai_stub import OpenAIStubConfig, OpenAIStubServer
+
+SCHEMAS = [
+    {
+        "type": "object",
+        "properties": {"name": {"type": "string"}, "age": {"type": "integer"}},
+        "required": ["name", "age"],
+    },
+    {"type": "object", "properties": {"tags": {"type": "array", "items": {}}}},
+    # recursive, with the recursion required
+    {
+        "$defs": {
+            "node": {
+                "type": ["object", "null"],
+                "properties": {"next": {"$ref": "#/$defs/node"}},
+                "required": ["next"],
+            }
+        },
+        "$ref": "#/$defs/node",
+    },
+]
+
+
+@pytest.fixture
+def server():
+    server = OpenAIStubServer(OpenAIStubConfig())
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(core.dataset, "SCHEMA_CACHE_DIR", str(tmp_path / "cache"))
+    path = tmp_path / "Snowplow.jsonl"
+    path.write_text(
+        "".join(dumps({"json_schema": dumps(schema)}) + "\n" for schema in SCHEMAS)
+    )
+    (tmp_path / "index.json").write_text(
+        dumps(
+            {
+                "Snowplow": {
+                    "file": path.name,
+                    "num_rows": len(SCHEMAS),
+                    "sha256": sha256(path.read_bytes()).hexdigest(),
+                }
+            }
+        )
+    )
+    return str(tmp_path)
+
+
+def test_bench_openai_against_stub(server, snapshot_dir, monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "stub")
+    engine = OpenAIEngine(OpenAIConfig(model="stub", base_url=server.base_url))
+    # no tiktoken encoding is downloaded for the model of a local server
+    assert engine.tokenizer is None
+
+    [outputs] = bench(engine, ["Snowplow"], snapshot_dir=snapshot_dir)
+
+    assert len(outputs) == len(SCHEMAS)
+    for output in outputs:
+        assert output.metadata.compile_status.code == CompileStatusCode.OK
+        assert output.metadata.decoding_status.code == DecodingStatusCode.OK
+        loads(output.generation)
+        assert output.perf_metrics.ttft is not None
+        assert output.perf_metrics.gct is None
+
+
+def test_stub_failures_are_server_errors(server, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RecursionError("maximum recursion depth exceeded")
+
+    monkeypatch.setattr(tests.openai_stub, "generate_instance", fail)
+    request = Request(
+        f"{server.base_url}/chat/completions",
+        data=dumps({"model": "stub", "messages": []}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with pytest.raises(HTTPError) as error:
+        urlopen(request)
+    assert error.value.code == 500
+    assert "RecursionError" in loads(error.value.read())["error"]["message"]